@@ -0,0 +1,181 @@
+"""
+Admission control: per-device rate limits and a global concurrency cap.
+
+AdmissionMiddleware is plain ASGI and sits in front of the routes. Each
+request first takes a token from its client's bucket, keyed by the
+X-Device-Id header the app sends or, failing that, the client address; an
+empty bucket is answered 429. The address is the ASGI scope's client, so
+behind a proxy the server must be told to trust its X-Forwarded-For
+(uvicorn's FORWARDED_ALLOW_IPS, or serve.py --forwarded-allow-ips);
+otherwise every keyless client shares the proxy's bucket. It then needs one of a fixed number of
+in-flight slots. When none is free it waits in a short FIFO queue for up to
+`queue_timeout` seconds, and a full queue or an expired wait is answered
+503. Both carry Retry-After, so well-behaved clients back off instead of
+retrying in a tight loop.
+
+Bucket state is an LRU of at most `max_keys` entries: idle clients fall off
+the end, and a client returning after eviction simply starts with a full
+bucket, which is what it would have refilled to anyway.
+"""
+
+import asyncio
+import json
+import math
+import time
+from collections import OrderedDict, deque
+
+DEVICE_HEADER = b"x-device-id"
+MAX_DEVICE_ID_LENGTH = 128
+
+
+class TokenBuckets:
+    """Token buckets refilling at `rate` per second up to `burst`, one per key."""
+
+    def __init__(self, rate, burst, max_keys):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def take(self, key, now):
+        """Take a token for `key`; returns 0 on success, else seconds until one is available."""
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= self.max_keys:
+                self._buckets.popitem(last=False)
+            bucket = self._buckets[key] = [float(self.burst), now]
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return 0.0
+        return (1 - bucket[0]) / self.rate
+
+
+class ConcurrencyLimit:
+    """At most `limit` holders at a time, with up to `max_queued` waiting in FIFO order."""
+
+    def __init__(self, limit, max_queued, queue_timeout):
+        self.limit = limit
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self._waiters = deque()
+
+    @property
+    def queued(self):
+        return len(self._waiters)
+
+    async def acquire(self):
+        """Take a slot, waiting if needed; returns False if the queue is full or the wait timed out."""
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            return True
+        if len(self._waiters) >= self.max_queued:
+            return False
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait((waiter,), timeout=self.queue_timeout)
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release()  # a slot was handed over that can no longer be used
+            raise
+        finally:
+            if not waiter.done():
+                waiter.cancel()
+                self._waiters.remove(waiter)
+        if waiter.cancelled():
+            return False
+        # release() handed its slot over, so `active` already counts this request
+        return True
+
+    def release(self):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+
+class AdmissionMiddleware:
+    """Rate-limit each client and cap concurrent requests; `exempt_paths` always pass."""
+
+    def __init__(
+        self, app, registry, rate, burst, max_keys, max_concurrent, max_queued, queue_timeout,
+        exempt_paths=(),
+    ):
+        self.app = app
+        self.buckets = TokenBuckets(rate, burst, max_keys) if rate > 0 else None
+        self.limit = ConcurrencyLimit(max_concurrent, max_queued, queue_timeout) if max_concurrent > 0 else None
+        self.exempt_paths = frozenset(exempt_paths)
+        self.rejected = registry.counter(
+            "admission_rejected_total", "Requests refused by admission control.", ("reason",)
+        )
+        self.in_flight = registry.gauge(
+            "admission_in_flight", "Requests holding a concurrency slot."
+        ).labels()
+        self.queued = registry.gauge(
+            "admission_queued", "Requests waiting for a concurrency slot."
+        ).labels()
+        self.clients = registry.gauge(
+            "admission_tracked_clients", "Clients with rate limit state."
+        ).labels()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in self.exempt_paths:
+            await self.app(scope, receive, send)
+            return
+
+        if self.buckets is not None:
+            wait = self.buckets.take(self._client_key(scope), time.monotonic())
+            self.clients.set(len(self.buckets))
+            if wait:
+                self.rejected.labels("rate_limited").inc()
+                await self._refuse(send, 429, "Too many requests", wait)
+                return
+
+        if self.limit is None:
+            await self.app(scope, receive, send)
+            return
+        admitted = await self.limit.acquire()
+        self.queued.set(self.limit.queued)
+        if not admitted:
+            self.rejected.labels("overloaded").inc()
+            await self._refuse(send, 503, "Server is busy", self.limit.queue_timeout)
+            return
+        self.in_flight.set(self.limit.active)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.limit.release()
+            self.in_flight.set(self.limit.active)
+            self.queued.set(self.limit.queued)
+
+    @staticmethod
+    def _client_key(scope):
+        for name, value in scope["headers"]:
+            if name == DEVICE_HEADER and value:
+                return "device:" + value[:MAX_DEVICE_ID_LENGTH].decode("latin-1")
+        client = scope.get("client")
+        return "ip:" + (client[0] if client else "")
+
+    @staticmethod
+    async def _refuse(send, status, detail, retry_after):
+        body = json.dumps({"detail": detail}).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode("ascii")),
+                (b"retry-after", str(max(1, math.ceil(retry_after))).encode("ascii")),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,361 @@
+"""
+Backup archives and resumable restore uploads.
+
+A backup is an uncompressed tar stream (images are already compressed):
+manifest.json, then each referenced image once under images/<hash>, then
+records.ndjson in the export format of transfer.py. Images come before the
+records so a restore can read the archive front to back, publishing blobs
+before the prescriptions that reference them. The archive is generated
+piece by piece; only the records are spooled, to a temp file on disk, so
+their size is known for the tar header.
+
+Restores are uploaded in fixed-size chunks, each carrying its SHA-256, and
+written straight to their offset in a preallocated file. The set of
+received chunks is persisted next to it, so after a dropped connection the
+client asks which chunks are missing and sends only those. Changes to that
+state take a per-upload file lock, since chunks of one upload may arrive at
+different worker processes.
+"""
+
+import fcntl
+import hashlib
+import io
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+
+from blobs import IMAGE_CONTENT_TYPES
+from storage import PRESCRIPTION
+
+ARCHIVE_FORMAT = "optical-rx-backup"
+ARCHIVE_VERSION = 1
+MANIFEST_NAME = "manifest.json"
+RECORDS_NAME = "records.ndjson"
+IMAGES_DIR = "images/"
+MEDIA_TYPE = "application/x-tar"
+
+READ_BYTES = 64 * 1024
+BLOCK_SIZE = tarfile.BLOCKSIZE
+
+
+class BackupError(ValueError):
+    """The archive or an uploaded chunk is not acceptable."""
+
+
+# ==================== Backup ====================
+
+def backup_chunks(store, blob_store, tmp_dir):
+    """Yield a backup archive of every member, prescription and image as byte chunks."""
+    images = {}
+    counts = {"family_members": 0, "prescriptions": 0}
+    with tempfile.TemporaryFile(dir=tmp_dir) as records:
+        for entity, row in store.export_rows():
+            content_type = row.pop("image_content_type", None)
+            if entity == PRESCRIPTION:
+                counts["prescriptions"] += 1
+                image_hash = row.get("image_hash")
+                if image_hash and content_type and image_hash not in images:
+                    if blob_store.exists(image_hash):
+                        images[image_hash] = content_type
+            else:
+                counts["family_members"] += 1
+            records.write(json.dumps({"type": entity, **row}, ensure_ascii=False).encode("utf-8") + b"\n")
+
+        manifest = json.dumps({
+            "format": ARCHIVE_FORMAT,
+            "version": ARCHIVE_VERSION,
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            **counts,
+            "images": images,
+        }).encode("utf-8")
+        yield from _member(MANIFEST_NAME, len(manifest), io.BytesIO(manifest))
+        for image_hash in images:
+            path = blob_store.path(image_hash)
+            with open(path, "rb") as f:
+                yield from _member(IMAGES_DIR + image_hash, os.fstat(f.fileno()).st_size, f)
+        size = records.tell()
+        records.seek(0)
+        yield from _member(RECORDS_NAME, size, records)
+    # End-of-archive marker
+    yield b"\0" * (2 * BLOCK_SIZE)
+
+
+def _member(name, size, f):
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = int(time.time())
+    info.mode = 0o644
+    yield info.tobuf(format=tarfile.PAX_FORMAT)
+    remaining = size
+    while remaining:
+        data = f.read(min(READ_BYTES, remaining))
+        if not data:
+            raise BackupError(f"{name} shrank while being archived")
+        remaining -= len(data)
+        yield data
+    if size % BLOCK_SIZE:
+        yield b"\0" * (BLOCK_SIZE - size % BLOCK_SIZE)
+
+
+# ==================== Restore ====================
+
+def restore_archive(path, store, blob_store, importer, max_image_bytes):
+    """Restore a backup archive by streaming through it once.
+
+    Images are published first; records are then applied by `importer`
+    (a transfer.Importer), merging into existing data by id. Returns the
+    importer's summary plus the number of images restored.
+    """
+    restored_images = 0
+    try:
+        with tarfile.open(path, mode="r|") as archive:
+            members = iter(archive)
+            first = next(members, None)
+            if first is None or first.name != MANIFEST_NAME:
+                raise BackupError("Not a backup archive: missing manifest")
+            manifest = _read_manifest(archive.extractfile(first))
+            images = manifest.get("images") or {}
+            for member in members:
+                if member.name.startswith(IMAGES_DIR):
+                    image_hash = member.name[len(IMAGES_DIR):]
+                    content_type = images.get(image_hash)
+                    if content_type is None or not member.isfile():
+                        raise BackupError(f"Unexpected archive entry {member.name}")
+                    if member.size > max_image_bytes:
+                        raise BackupError(f"Image {image_hash} exceeds {max_image_bytes} bytes")
+                    if store.get_blob(image_hash) is None or not blob_store.exists(image_hash):
+                        _restore_image(store, blob_store, archive.extractfile(member), image_hash, content_type)
+                        restored_images += 1
+                elif member.name == RECORDS_NAME:
+                    records = archive.extractfile(member)
+                    summary = importer.run(iter(lambda: records.read(READ_BYTES), b""), "ndjson")
+                    return {**summary, "images": restored_images}
+                else:
+                    raise BackupError(f"Unexpected archive entry {member.name}")
+    except tarfile.TarError as exc:
+        raise BackupError(f"Corrupt archive: {exc}") from None
+    raise BackupError("Not a backup archive: missing records")
+
+
+def _read_manifest(f):
+    try:
+        manifest = json.loads(f.read())
+    except ValueError:
+        raise BackupError("Not a backup archive: unreadable manifest") from None
+    if not isinstance(manifest, dict) or manifest.get("format") != ARCHIVE_FORMAT:
+        raise BackupError("Not a backup archive")
+    if manifest.get("version") != ARCHIVE_VERSION:
+        raise BackupError(f"Unsupported backup version {manifest.get('version')!r}")
+    return manifest
+
+
+def _restore_image(store, blob_store, f, image_hash, content_type):
+    if content_type not in IMAGE_CONTENT_TYPES:
+        raise BackupError(f"Image {image_hash} has unsupported type {content_type!r}")
+    with blob_store.writer(content_type) as writer:
+        for data in iter(lambda: f.read(READ_BYTES), b""):
+            writer.write(data)
+        image = writer.finish()
+    with image:
+        if image.hash != image_hash:
+            raise BackupError(f"Image {image_hash} does not match its checksum")
+        store.add_blob(image)
+
+
+class ChunkedUploads:
+    """Resumable uploads of restore archives, kept under `root/<upload id>/`.
+
+    Each upload has a preallocated `archive` file and a `state.json` listing
+    the SHA-256 of every chunk received so far. Uploads untouched for
+    `expire_after` seconds are removed by prune().
+    """
+
+    def __init__(self, root, chunk_size, max_size, expire_after):
+        self.root = Path(root)
+        self.chunk_size = chunk_size
+        self.max_size = max_size
+        self.expire_after = expire_after
+
+    def open(self):
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def create(self, size, sha256=None):
+        if not 0 < size <= self.max_size:
+            raise BackupError(f"Archive size must be between 1 and {self.max_size} bytes")
+        upload_id = uuid.uuid4().hex
+        directory = self.root / upload_id
+        directory.mkdir()
+        with open(directory / "archive", "wb") as f:
+            f.truncate(size)
+        state = {
+            "upload_id": upload_id,
+            "size": size,
+            "chunk_size": self.chunk_size,
+            "sha256": sha256,
+            "chunks": {},
+            "restoring": False,
+        }
+        self._save(state)
+        return self.status(state)
+
+    def get(self, upload_id):
+        """The upload's state, or None if there is no such upload."""
+        if not upload_id.isalnum():
+            return None
+        try:
+            return json.loads((self.root / upload_id / "state.json").read_text())
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def status(state):
+        chunk_count = -(-state["size"] // state["chunk_size"])
+        received = sorted(int(index) for index in state["chunks"])
+        return {
+            "upload_id": state["upload_id"],
+            "size": state["size"],
+            "chunk_size": state["chunk_size"],
+            "chunk_count": chunk_count,
+            "received": received,
+            "missing": sorted(set(range(chunk_count)) - set(received)),
+        }
+
+    def has_chunk(self, state, index, sha256):
+        return state["chunks"].get(str(index)) == sha256
+
+    def chunk_writer(self, state, index, sha256):
+        chunk_count = -(-state["size"] // state["chunk_size"])
+        if not 0 <= index < chunk_count:
+            raise BackupError(f"Chunk index must be between 0 and {chunk_count - 1}")
+        if state["restoring"]:
+            raise BackupError("Upload is already being restored")
+        return ChunkWriter(self, state, index, sha256)
+
+    def complete(self, upload_id):
+        """Claim a fully received upload for restoring and return its archive path."""
+        if self.get(upload_id) is None:
+            return None
+        try:
+            with self._locked(upload_id):
+                state = self.get(upload_id)
+                if state is None:
+                    return None
+                missing = self.status(state)["missing"]
+                if missing:
+                    raise BackupError(f"{len(missing)} chunks are missing, starting with chunk {missing[0]}")
+                if state["restoring"]:
+                    raise BackupError("Upload is already being restored")
+                state["restoring"] = True
+                self._save(state)
+        except FileNotFoundError:
+            return None
+        path = self.root / upload_id / "archive"
+        if state["sha256"] and _file_sha256(path) != state["sha256"]:
+            with self._locked(upload_id):
+                state["restoring"] = False
+                self._save(state)
+            raise BackupError("Archive does not match its checksum")
+        return path
+
+    def delete(self, upload_id):
+        if self.get(upload_id) is None:
+            return False
+        shutil.rmtree(self.root / upload_id, ignore_errors=True)
+        return True
+
+    def prune(self, now=None):
+        """Remove uploads idle for longer than expire_after; returns how many."""
+        cutoff = (time.time() if now is None else now) - self.expire_after
+        removed = 0
+        for state_path in self.root.glob("*/state.json"):
+            if state_path.stat().st_mtime < cutoff:
+                shutil.rmtree(state_path.parent, ignore_errors=True)
+                removed += 1
+        return removed
+
+    @contextmanager
+    def _locked(self, upload_id):
+        """Hold the upload's lock; raises FileNotFoundError if it was removed."""
+        with open(self.root / upload_id / "lock", "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    def _record_chunk(self, upload_id, index, sha256):
+        try:
+            with self._locked(upload_id):
+                state = self.get(upload_id)
+                if state is not None:
+                    state["chunks"][str(index)] = sha256
+                    self._save(state)
+        except FileNotFoundError:
+            state = None
+        if state is None:
+            raise BackupError("Upload was removed")
+        return state
+
+    def _forget_chunk(self, upload_id, index):
+        try:
+            with self._locked(upload_id):
+                state = self.get(upload_id)
+                if state is not None and state["chunks"].pop(str(index), None) is not None:
+                    self._save(state)
+        except FileNotFoundError:
+            pass
+
+    def _save(self, state):
+        directory = self.root / state["upload_id"]
+        temp_path = directory / "state.json.tmp"
+        temp_path.write_text(json.dumps(state))
+        os.replace(temp_path, directory / "state.json")
+
+
+class ChunkWriter:
+    """Write one chunk in place, verifying its length and SHA-256 on finish."""
+
+    def __init__(self, uploads, state, index, sha256):
+        self.uploads = uploads
+        self.upload_id = state["upload_id"]
+        self.index = index
+        self.sha256 = sha256
+        offset = index * state["chunk_size"]
+        self.length = min(state["chunk_size"], state["size"] - offset)
+        self.written = 0
+        self._digest = hashlib.sha256()
+        # The region is about to be overwritten, so it no longer holds a verified chunk
+        uploads._forget_chunk(self.upload_id, index)
+        self._file = open(uploads.root / self.upload_id / "archive", "r+b")
+        self._file.seek(offset)
+
+    def write(self, data):
+        if self.written + len(data) > self.length:
+            raise BackupError(f"Chunk {self.index} must be {self.length} bytes")
+        self._digest.update(data)
+        self._file.write(data)
+        self.written += len(data)
+
+    def finish(self):
+        """Close the chunk and record it; returns the upload's new status."""
+        self._file.close()
+        if self.written != self.length:
+            raise BackupError(f"Chunk {self.index} must be {self.length} bytes, got {self.written}")
+        if self._digest.hexdigest() != self.sha256:
+            raise BackupError(f"Chunk {self.index} does not match its checksum")
+        return self.uploads.status(self.uploads._record_chunk(self.upload_id, self.index, self.sha256))
+
+    def abort(self):
+        self._file.close()
+
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for data in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(data)
+    return digest.hexdigest()
@@ -0,0 +1,239 @@
+"""
+Content-addressed image blob store.
+
+Images are stored once per distinct content under their SHA-256 digest, so
+the same photo uploaded twice shares one file. Prescriptions refer to blobs
+by hash and the bytes are served separately by BlobResponse.
+"""
+
+import hashlib
+import mmap
+import os
+import re
+import tempfile
+from email.utils import formatdate
+from pathlib import Path
+
+from starlette.responses import Response
+
+from cache import etag_matches
+
+HASH_RE = re.compile(r"^[0-9a-f]{64}$")
+DATA_URI_RE = re.compile(r"^data:([\w.+-]+/[\w.+-]+)?(?:;[\w=.+-]+)*;base64,", re.IGNORECASE)
+DEFAULT_CONTENT_TYPE = "image/jpeg"
+# Raster formats the app produces. Anything else (HTML, SVG) would be
+# rendered by a browser opening the blob URL, so it is never stored or served.
+IMAGE_CONTENT_TYPES = frozenset({"image/jpeg", "image/png", "image/webp", "image/heic"})
+
+
+class StagedBlob:
+    """A blob written to a temp file, waiting to be published under its hash.
+
+    Publishing happens inside the storage transaction that records the blob,
+    so it cannot interleave with garbage collection removing the same hash.
+    """
+
+    def __init__(self, blob_store, temp_path, blob_hash, size, content_type):
+        self.blob_store = blob_store
+        self.temp_path = temp_path
+        self.hash = blob_hash
+        self.size = size
+        self.content_type = content_type
+        # Perceptual hash, recorded with the blob when the uploader computed one
+        self.phash = None
+
+    def publish(self):
+        final_path = self.blob_store.path(self.hash)
+        if final_path.exists():
+            self.discard()
+            return
+        final_path.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(self.temp_path, final_path)
+
+    def discard(self):
+        try:
+            os.unlink(self.temp_path)
+        except FileNotFoundError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.discard()
+
+
+class BlobWriter:
+    """Incrementally write a blob to a temp file, hashing as it goes."""
+
+    def __init__(self, blob_store, content_type):
+        self.blob_store = blob_store
+        self.content_type = content_type
+        self.size = 0
+        self._digest = hashlib.sha256()
+        fd, self.temp_path = tempfile.mkstemp(dir=blob_store.tmp_dir)
+        self._file = os.fdopen(fd, "wb")
+
+    def write(self, data):
+        self._digest.update(data)
+        self._file.write(data)
+        self.size += len(data)
+
+    def finish(self):
+        """Close the temp file and hand it over as a StagedBlob."""
+        self._file.close()
+        staged = StagedBlob(self.blob_store, self.temp_path, self._digest.hexdigest(), self.size, self.content_type)
+        self.temp_path = None
+        return staged
+
+    def abort(self):
+        self._file.close()
+        if self.temp_path is not None:
+            os.unlink(self.temp_path)
+            self.temp_path = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.temp_path is not None:
+            self.abort()
+
+
+class BlobStore:
+    """Files on disk laid out as <root>/<hash[:2]>/<hash[2:]>."""
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.tmp_dir = self.root / "tmp"
+
+    def open(self):
+        self.tmp_dir.mkdir(parents=True, exist_ok=True)
+
+    def path(self, blob_hash):
+        return self.root / blob_hash[:2] / blob_hash[2:]
+
+    def exists(self, blob_hash):
+        return self.path(blob_hash).exists()
+
+    def writer(self, content_type):
+        return BlobWriter(self, content_type)
+
+    def stage(self, data, content_type):
+        with self.writer(content_type) as writer:
+            writer.write(data)
+            return writer.finish()
+
+    def delete(self, blob_hash):
+        try:
+            os.unlink(self.path(blob_hash))
+        except FileNotFoundError:
+            pass
+
+
+def parse_range(header, size):
+    """Return (start, end) for a single 'bytes=' range, or None to serve it all.
+
+    Raises ValueError for a range that cannot be satisfied.
+    """
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    start_text, _, end_text = header[6:].strip().partition("-")
+    try:
+        if not start_text:
+            length = int(end_text)
+            if length <= 0:
+                raise ValueError("empty suffix range")
+            return max(size - length, 0), size - 1
+        start = int(start_text)
+        end = int(end_text) if end_text else size - 1
+    except ValueError:
+        return None
+    if start >= size or end < start:
+        raise ValueError("range not satisfiable")
+    return start, min(end, size - 1)
+
+
+class BlobResponse(Response):
+    """Serve an immutable blob with ETag, single-range and zero-copy support.
+
+    Uses the ASGI zerocopysend/pathsend extensions when the server offers them
+    and otherwise streams slices of a memory-mapped file. Blobs recorded with
+    a type outside IMAGE_CONTENT_TYPES are served as opaque bytes.
+    """
+
+    chunk_size = 256 * 1024
+
+    def __init__(self, path, blob_hash, content_type, request_headers):
+        self.path = Path(path)
+        self.etag = f'"{blob_hash}"'
+        self.request_headers = request_headers
+        self.media_type = content_type if content_type in IMAGE_CONTENT_TYPES else "application/octet-stream"
+        self.background = None
+        self.status_code = 200
+        self.init_headers({
+            "etag": self.etag,
+            "x-content-type-options": "nosniff",
+            "accept-ranges": "bytes",
+            "cache-control": "public, max-age=31536000, immutable",
+        })
+
+    async def __call__(self, scope, receive, send):
+        try:
+            stat_result = os.stat(self.path)
+        except FileNotFoundError:
+            await Response(status_code=404)(scope, receive, send)
+            return
+        size = stat_result.st_size
+        self.headers["last-modified"] = formatdate(stat_result.st_mtime, usegmt=True)
+
+        if etag_matches(self.request_headers.get("if-none-match"), self.etag):
+            self.status_code = 304
+            del self.headers["content-type"]
+            await self._send_empty(send)
+            return
+
+        start, end = 0, size - 1
+        if_range = self.request_headers.get("if-range")
+        if size and (if_range is None or if_range == self.etag):
+            try:
+                requested = parse_range(self.request_headers.get("range"), size)
+            except ValueError:
+                self.status_code = 416
+                self.headers["content-range"] = f"bytes */{size}"
+                await self._send_empty(send)
+                return
+            if requested is not None:
+                start, end = requested
+                self.status_code = 206
+                self.headers["content-range"] = f"bytes {start}-{end}/{size}"
+        count = end - start + 1 if size else 0
+        self.headers["content-length"] = str(count)
+
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if scope["method"].upper() == "HEAD" or count == 0:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+
+        extensions = scope.get("extensions") or {}
+        if "http.response.zerocopysend" in extensions:
+            with open(self.path, "rb") as f:
+                await send({"type": "http.response.zerocopysend", "file": f.fileno(), "offset": start, "count": count})
+        elif "http.response.pathsend" in extensions and self.status_code == 200:
+            await send({"type": "http.response.pathsend", "path": str(self.path)})
+        else:
+            with open(self.path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                position = start
+                while position <= end:
+                    chunk_end = min(position + self.chunk_size, end + 1)
+                    await send({
+                        "type": "http.response.body",
+                        "body": mapped[position:chunk_end],
+                        "more_body": chunk_end <= end,
+                    })
+                    position = chunk_end
+
+    async def _send_empty(self, send):
+        self.headers["content-length"] = "0"
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
@@ -0,0 +1,50 @@
+"""
+Versioned cache of serialized list responses.
+
+Entries are keyed by the request's route and query, so every page and
+field projection is cached separately, and keep any extra response headers
+(such as the next-page cursor) alongside the body. Each is tagged with the
+version of the collection it was rendered from (see Store.version), so a
+write makes it stale without any explicit invalidation. The cache is a
+byte-bounded LRU, used only from the event loop.
+"""
+
+from collections import OrderedDict
+
+
+def etag_matches(if_none_match, etag):
+    """True if an If-None-Match header value matches `etag` (weak comparison)."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return any(
+        candidate.strip().removeprefix("W/") == etag for candidate in if_none_match.split(",")
+    )
+
+
+class ResponseCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+
+    def get(self, key, version):
+        """Cached (body, headers) for `key` rendered at `version`, or None."""
+        entry = self._entries.get(key)
+        if entry is None or entry[0] != version:
+            return None
+        self._entries.move_to_end(key)
+        return entry[1], entry[2]
+
+    def put(self, key, version, body, headers=None):
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self._size -= len(previous[1])
+        if len(body) > self.max_bytes:
+            return
+        self._entries[key] = (version, body, headers or {})
+        self._size += len(body)
+        while self._size > self.max_bytes:
+            _, (_, evicted, _) = self._entries.popitem(last=False)
+            self._size -= len(evicted)
@@ -0,0 +1,118 @@
+"""
+Date parsing and normalization, mirroring frontend/services/dateUtils.ts.
+
+Dates are reduced to integer day numbers (days since 1970-01-01, the same
+unit as NumPy's datetime64[D]) so they can be stored in indexed columns and
+compared without re-parsing strings. Single values go through a bounded
+memo cache; parse_days handles whole columns at once with NumPy.
+"""
+
+import re
+from datetime import date, datetime, timedelta, timezone
+from functools import lru_cache
+
+EPOCH = date(1970, 1, 1)
+EPOCH_ORDINAL = EPOCH.toordinal()
+EXPIRING_SOON_DAYS = 30
+
+US_DATE_RE = re.compile(r"^(\d{1,2})/(\d{1,2})/(\d{4})$")
+ISO_DATE_RE = re.compile(r"^(\d{4})-(\d{2})-(\d{2})$")
+# Display formats the app produces, e.g. "June 15, 2025"
+FALLBACK_FORMATS = ("%B %d, %Y", "%b %d, %Y")
+
+# Sentinel for unparseable entries in parse_days results
+NO_DAY = -(2 ** 63)
+
+
+def today_day():
+    return datetime.now(timezone.utc).date().toordinal() - EPOCH_ORDINAL
+
+
+def _calendar_day(year, month, day):
+    # Like JavaScript's Date(year, month - 1, day), an out-of-range day rolls
+    # over into the next month (02/31 -> 03/03) rather than failing.
+    if not (1 <= month <= 12 and 1 <= day <= 31) or year < 1:
+        return None
+    return date(year, month, 1).toordinal() - EPOCH_ORDINAL + day - 1
+
+
+@lru_cache(maxsize=8192)
+def parse_day(value):
+    """Day number for MM/DD/YYYY, YYYY-MM-DD or an ISO timestamp, else None."""
+    if not value:
+        return None
+    trimmed = value.strip()
+    match = US_DATE_RE.match(trimmed)
+    if match:
+        day = _calendar_day(int(match[3]), int(match[1]), int(match[2]))
+        if day is not None:
+            return day
+    match = ISO_DATE_RE.match(trimmed)
+    if match:
+        day = _calendar_day(int(match[1]), int(match[2]), int(match[3]))
+        if day is not None:
+            return day
+    try:
+        parsed = datetime.fromisoformat(trimmed.replace("Z", "+00:00"))
+    except ValueError:
+        for fmt in FALLBACK_FORMATS:
+            try:
+                parsed = datetime.strptime(trimmed, fmt)
+                break
+            except ValueError:
+                pass
+        else:
+            return None
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc)
+    return parsed.date().toordinal() - EPOCH_ORDINAL
+
+
+def day_to_iso(day):
+    return (EPOCH + timedelta(days=day)).isoformat()
+
+
+def parse_days(values):
+    """Parse a sequence of date strings into an int64 array of day numbers.
+
+    Fixed-width YYYY-MM-DD and MM/DD/YYYY values are decoded with vectorized
+    NumPy arithmetic; anything else falls back to the memoized parse_day.
+    Unparseable entries are NO_DAY.
+    """
+    import numpy as np
+
+    values = ["" if v is None else v.strip() for v in values]
+    n = len(values)
+    result = np.full(n, NO_DAY, dtype=np.int64)
+    if not n:
+        return result
+    raw = np.array([v.encode("ascii", "replace") if len(v) == 10 else b"" for v in values], dtype="S10")
+    chars = raw.view(np.uint8).reshape(n, 10)
+    digits = chars - ord("0")
+    is_digit = digits <= 9
+
+    iso = (
+        (chars[:, 4] == ord("-")) & (chars[:, 7] == ord("-"))
+        & is_digit[:, [0, 1, 2, 3, 5, 6, 8, 9]].all(axis=1)
+    )
+    us = (
+        (chars[:, 2] == ord("/")) & (chars[:, 5] == ord("/"))
+        & is_digit[:, [0, 1, 3, 4, 6, 7, 8, 9]].all(axis=1)
+    )
+    d = digits.astype(np.int64)
+    year = np.where(iso, d[:, 0] * 1000 + d[:, 1] * 100 + d[:, 2] * 10 + d[:, 3],
+                    d[:, 6] * 1000 + d[:, 7] * 100 + d[:, 8] * 10 + d[:, 9])
+    month = np.where(iso, d[:, 5] * 10 + d[:, 6], d[:, 0] * 10 + d[:, 1])
+    day = np.where(iso, d[:, 8] * 10 + d[:, 9], d[:, 3] * 10 + d[:, 4])
+    fast = (iso | us) & (month >= 1) & (month <= 12) & (day >= 1) & (day <= 31) & (year >= 1)
+
+    if fast.any():
+        months = (year[fast] - 1970) * 12 + (month[fast] - 1)
+        first_of_month = months.astype("datetime64[M]").astype("datetime64[D]").astype(np.int64)
+        result[fast] = first_of_month + day[fast] - 1
+
+    for i in np.flatnonzero(~fast):
+        parsed = parse_day(values[i])
+        if parsed is not None:
+            result[i] = parsed
+    return result
@@ -0,0 +1,126 @@
+"""
+Write-behind ingestion of app analytics events.
+
+A request only validates its batch and appends the events to a bounded
+in-memory queue, so ingest never waits on SQLite. EventIngestor drains the
+queue in the background and writes large batches in one transaction each,
+folding them into per-day, per-partner rollups as it goes. When the queue is
+full the whole batch is refused (EventQueueFull) so clients back off and
+retry instead of the server buffering without limit. Events still queued
+at shutdown are flushed before the store closes.
+"""
+
+import asyncio
+import json
+import logging
+from datetime import timezone
+
+from fastapi.concurrency import run_in_threadpool
+
+from dates import EPOCH_ORDINAL
+
+EVENT_TYPES = ("app_open", "ad_click", "affiliate_click")
+# Metadata keys naming the partner an event is attributed to, first match wins
+PARTNER_KEYS = ("partner_id", "ad_id")
+
+logger = logging.getLogger(__name__)
+
+
+class EventQueueFull(Exception):
+    """The ingest queue has no room for the batch."""
+
+
+def event_row(device_id, event_type, metadata, occurred_at, received_at):
+    """The events-table tuple for one event.
+
+    Client clocks are trusted for the day an event is counted on (events can
+    be sent late from offline devices) but never ahead of the server.
+    """
+    if occurred_at is not None and occurred_at.tzinfo is None:
+        occurred_at = occurred_at.replace(tzinfo=timezone.utc)
+    if occurred_at is None or occurred_at > received_at:
+        occurred_at = received_at
+    partner = next((str(metadata[key]) for key in PARTNER_KEYS if metadata.get(key)), "")
+    return (
+        device_id,
+        event_type,
+        partner,
+        occurred_at.astimezone(timezone.utc).date().toordinal() - EPOCH_ORDINAL,
+        occurred_at.isoformat(),
+        json.dumps(metadata, separators=(",", ":")) if metadata else None,
+    )
+
+
+class EventIngestor:
+    """Queue events in memory and write them to the store in batches."""
+
+    def __init__(self, store, registry, max_queued=100_000, batch_size=5000, flush_interval=1.0):
+        self.store = store
+        self.max_queued = max_queued
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queued = registry.gauge("analytics_events_queued", "Events waiting to be written.").labels()
+        self.written = registry.counter("analytics_events_written_total", "Events written to storage.").labels()
+        self.rejected = registry.counter(
+            "analytics_events_rejected_total", "Events refused because the queue was full."
+        ).labels()
+        self.lost = registry.counter(
+            "analytics_events_lost_total", "Events dropped because a batch failed to write."
+        ).labels()
+        self._queue = None
+        self._task = None
+
+    def submit(self, rows):
+        """Queue event rows without blocking; raises EventQueueFull if they do not all fit."""
+        if self._queue is None or self._queue.qsize() + len(rows) > self.max_queued:
+            self.rejected.inc(len(rows))
+            raise EventQueueFull()
+        for row in rows:
+            self._queue.put_nowait(row)
+        self.queued.set(self._queue.qsize())
+
+    def start(self):
+        # Created here so the queue binds to the loop the ingestor runs on
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the writer, then flush whatever is still queued."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        while self._queue is not None and not self._queue.empty():
+            await self._flush(self._take(self.batch_size))
+        self._queue = None
+
+    async def _run(self):
+        while True:
+            first = await self._queue.get()
+            if self._queue.qsize() < self.batch_size - 1:
+                # Let a burst accumulate into one write instead of many small ones
+                try:
+                    await asyncio.sleep(self.flush_interval)
+                except asyncio.CancelledError:
+                    self._queue.put_nowait(first)  # left for stop() to flush
+                    raise
+            await self._flush([first] + self._take(self.batch_size - 1))
+
+    def _take(self, limit):
+        batch = []
+        while len(batch) < limit and not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        return batch
+
+    async def _flush(self, batch):
+        self.queued.set(self._queue.qsize())
+        try:
+            await run_in_threadpool(self.store.record_events, batch)
+        except Exception:
+            logger.exception("Failed to write %d analytics events", len(batch))
+            self.lost.inc(len(batch))
+        else:
+            self.written.inc(len(batch))
@@ -0,0 +1,76 @@
+"""
+Readiness checks for the /readyz probe.
+
+Checks run on a background timer and the probe only reads the cached
+result, so however often an orchestrator polls, it never adds queries or
+thread hops to the server.
+"""
+
+import asyncio
+import logging
+from datetime import datetime, timezone
+
+from fastapi.concurrency import run_in_threadpool
+
+logger = logging.getLogger(__name__)
+
+
+class ReadinessProbe:
+    """Periodically evaluate named checks and cache whether all passed.
+
+    Each check is a synchronous callable returning a bool; they run together
+    in one worker thread so a slow database cannot stall the event loop.
+    """
+
+    def __init__(self, checks, interval=5.0):
+        self.checks = checks
+        self.interval = interval
+        self.ready = False
+        self.results = {name: False for name in checks}
+        self.checked_at = None
+        self._task = None
+
+    @property
+    def status(self):
+        return {
+            "status": "ok" if self.ready else "unavailable",
+            "checks": self.results,
+            "checked_at": self.checked_at,
+        }
+
+    async def start(self):
+        """Run the checks once, then keep re-running them in the background."""
+        await self.check_now()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        # Stop reporting ready first so traffic drains during shutdown
+        self.ready = False
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def check_now(self):
+        self.results = await run_in_threadpool(self._evaluate)
+        self.ready = all(self.results.values())
+        self.checked_at = datetime.now(timezone.utc).isoformat()
+        return self.ready
+
+    def _evaluate(self):
+        results = {}
+        for name, check in self.checks.items():
+            try:
+                results[name] = bool(check())
+            except Exception:
+                logger.warning("Readiness check %s failed", name, exc_info=True)
+                results[name] = False
+        return results
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.check_now()
@@ -0,0 +1,342 @@
+"""
+Streaming ingest for prescription image uploads.
+
+Request bodies are parsed as they arrive: the image_base64 field of a JSON
+prescription is validated, base64-decoded and hashed chunk by chunk straight
+into a BlobWriter, so memory per upload stays constant instead of holding
+the body string, the decoded bytes and the write buffer at once.
+"""
+
+import binascii
+import json
+import re
+
+from blobs import DATA_URI_RE, DEFAULT_CONTENT_TYPE, IMAGE_CONTENT_TYPES
+
+IMAGE_FIELD = "image_base64"
+MAX_FIELD_BYTES = 64 * 1024
+MAX_PREFIX_BYTES = 256
+# stage_image_text encodes in-memory text for the decoder this many characters at a time
+TEXT_SLICE_CHARS = 64 * 1024
+
+WHITESPACE = frozenset(b" \t\r\n")
+QUOTE, BACKSLASH, COMMA = ord('"'), ord("\\"), ord(",")
+LBRACE, RBRACE = ord("{"), ord("}")
+STRING_SPECIAL_RE = re.compile(rb'["\\]')
+LITERAL_END_RE = re.compile(rb"[\s,}]")
+
+
+class ImageTooLarge(ValueError):
+    pass
+
+
+class Base64StreamDecoder:
+    """Validate and decode base64 text fed in arbitrary slices."""
+
+    def __init__(self, writer, max_bytes=None):
+        self.writer = writer
+        self.max_bytes = max_bytes
+        self._pending = b""
+        self._padded = False
+
+    def feed(self, data):
+        if not data:
+            return
+        if self._padded:
+            raise ValueError("Invalid base64 image data: Excess data after padding")
+        data = self._pending + data
+        usable = len(data) - len(data) % 4
+        self._pending = data[usable:]
+        if not usable:
+            return
+        try:
+            decoded = binascii.a2b_base64(data[:usable], strict_mode=True)
+        except binascii.Error as exc:
+            raise ValueError(f"Invalid base64 image data: {exc}") from None
+        self._padded = data[usable - 1] == ord("=")
+        if self.max_bytes is not None and self.writer.size + len(decoded) > self.max_bytes:
+            raise ImageTooLarge(f"Image exceeds {self.max_bytes} bytes")
+        self.writer.write(decoded)
+
+    def close(self):
+        if self._pending:
+            raise ValueError("Invalid base64 image data: Incorrect padding")
+        if not self.writer.size:
+            raise ValueError("Image data is empty")
+
+
+class ImageStreamDecoder:
+    """Decode a data URI or bare base64 image into a blob, chunk by chunk.
+
+    The data URI prefix is checked against the same rules the blob store uses
+    and supplies the content type, which must be one of IMAGE_CONTENT_TYPES;
+    everything after the comma is validated in full, not just its first
+    characters.
+    """
+
+    def __init__(self, blob_store, max_bytes=None):
+        self.blob_store = blob_store
+        self.max_bytes = max_bytes
+        self.writer = None
+        self._head = b""
+        self._base64 = None
+
+    def feed(self, data):
+        if self._base64 is None:
+            self._head += data
+            data = self._read_prefix(final=False)
+            if data is None:
+                return
+        self._base64.feed(data)
+
+    def finish(self):
+        """Return the decoded image as a StagedBlob, or None if nothing was sent."""
+        if self._base64 is None:
+            if not self._head:
+                return None
+            data = self._read_prefix(final=True)
+            self._base64.feed(data)
+        self._base64.close()
+        return self.writer.finish()
+
+    def abort(self):
+        if self.writer is not None:
+            self.writer.abort()
+
+    def _read_prefix(self, final):
+        head = self._head
+        if len(head) < 5 and not final:
+            return None
+        content_type = DEFAULT_CONTENT_TYPE
+        if head.startswith(b"data:"):
+            comma = head.find(b",", 0, MAX_PREFIX_BYTES)
+            if comma == -1:
+                if len(head) < MAX_PREFIX_BYTES and not final:
+                    return None
+                raise ValueError("Unsupported data URI; expected base64 encoding")
+            match = DATA_URI_RE.match(head[:comma + 1].decode("latin-1"))
+            if not match:
+                raise ValueError("Unsupported data URI; expected base64 encoding")
+            content_type = (match.group(1) or DEFAULT_CONTENT_TYPE).lower()
+            if content_type not in IMAGE_CONTENT_TYPES:
+                raise ValueError(f"Unsupported image type {content_type}")
+            head = head[comma + 1:]
+        self.writer = self.blob_store.writer(content_type)
+        self._base64 = Base64StreamDecoder(self.writer, self.max_bytes)
+        self._head = b""
+        return head
+
+
+def stage_image_text(blob_store, value, max_bytes=None):
+    """Decode an in-memory data URI or base64 string into a StagedBlob.
+
+    The text is encoded a slice at a time, so no second full-size copy of it
+    is made.
+    """
+    decoder = ImageStreamDecoder(blob_store, max_bytes)
+    try:
+        for start in range(0, len(value), TEXT_SLICE_CHARS):
+            decoder.feed(value[start:start + TEXT_SLICE_CHARS].encode("latin-1", "replace"))
+        return decoder.finish()
+    except BaseException:
+        decoder.abort()
+        raise
+
+
+class PrescriptionStreamParser:
+    """Incremental parser for a flat JSON prescription object.
+
+    Scalar fields are collected into `fields` (each capped at MAX_FIELD_BYTES);
+    the image field is routed through an ImageStreamDecoder without ever being
+    held in memory. Raises ValueError on malformed input.
+    """
+
+    def __init__(self, blob_store, max_image_bytes=None):
+        self.blob_store = blob_store
+        self.max_image_bytes = max_image_bytes
+        self.fields = {}
+        self.image = None
+        self._decoder = None
+        self._state = self._start
+        self._buffer = bytearray()
+        self._key = None
+        self._escape = False
+
+    def feed(self, chunk):
+        pos, end = 0, len(chunk)
+        while pos < end:
+            pos = self._state(chunk, pos)
+
+    def close(self):
+        """Finish parsing and return (fields, staged image or None)."""
+        if self._state == self._literal:
+            self._end_literal()
+        if self._state != self._done:
+            raise ValueError("Unexpected end of JSON body")
+        return self.fields, self.image
+
+    def abort(self):
+        if self._decoder is not None:
+            self._decoder.abort()
+        if self.image is not None:
+            self.image.discard()
+
+    # ----- states: each consumes from chunk[pos:] and returns the new position
+
+    @staticmethod
+    def _skip_whitespace(chunk, pos):
+        end = len(chunk)
+        while pos < end and chunk[pos] in WHITESPACE:
+            pos += 1
+        return pos
+
+    def _start(self, chunk, pos):
+        pos = self._skip_whitespace(chunk, pos)
+        if pos < len(chunk):
+            if chunk[pos] != LBRACE:
+                raise ValueError("Expected a JSON object")
+            self._state = self._first_key
+            pos += 1
+        return pos
+
+    def _first_key(self, chunk, pos):
+        pos = self._skip_whitespace(chunk, pos)
+        if pos < len(chunk) and chunk[pos] == RBRACE:
+            self._state = self._done
+            return pos + 1
+        return self._next_key(chunk, pos)
+
+    def _next_key(self, chunk, pos):
+        pos = self._skip_whitespace(chunk, pos)
+        if pos < len(chunk):
+            if chunk[pos] != QUOTE:
+                raise ValueError("Expected a JSON object key")
+            self._key = None
+            self._state = self._string
+            pos += 1
+        return pos
+
+    def _colon(self, chunk, pos):
+        pos = self._skip_whitespace(chunk, pos)
+        if pos < len(chunk):
+            if chunk[pos] != ord(":"):
+                raise ValueError("Expected ':' after object key")
+            self._state = self._value
+            pos += 1
+        return pos
+
+    def _value(self, chunk, pos):
+        pos = self._skip_whitespace(chunk, pos)
+        if pos == len(chunk):
+            return pos
+        byte = chunk[pos]
+        if byte == QUOTE:
+            if self._key == IMAGE_FIELD:
+                if self._decoder is not None:
+                    raise ValueError(f"Duplicate {IMAGE_FIELD} field")
+                self._decoder = ImageStreamDecoder(self.blob_store, self.max_image_bytes)
+                self._state = self._image_string
+            else:
+                self._state = self._string
+            return pos + 1
+        if byte in b"{[":
+            raise ValueError(f"Field {self._key!r} must be a scalar value")
+        self._state = self._literal
+        return pos
+
+    def _string(self, chunk, pos):
+        end = len(chunk)
+        while pos < end:
+            if self._escape:
+                self._buffer.append(chunk[pos])
+                self._escape = False
+                pos += 1
+                continue
+            match = STRING_SPECIAL_RE.search(chunk, pos)
+            stop = match.start() if match else end
+            self._buffer += chunk[pos:stop]
+            if len(self._buffer) > MAX_FIELD_BYTES:
+                raise ValueError("JSON field too large")
+            if match is None:
+                return end
+            if chunk[stop] == BACKSLASH:
+                self._buffer.append(BACKSLASH)
+                self._escape = True
+                pos = stop + 1
+                continue
+            self._end_string(json.loads(b'"' + bytes(self._buffer) + b'"'))
+            return stop + 1
+        return pos
+
+    def _end_string(self, text):
+        self._buffer.clear()
+        if self._key is None:
+            self._key = text
+            self._state = self._colon
+        else:
+            self.fields[self._key] = text
+            self._state = self._after_value
+
+    def _image_string(self, chunk, pos):
+        end = len(chunk)
+        while pos < end:
+            if self._escape:
+                # Base64 only ever needs the JSON-escaped solidus
+                if chunk[pos] != ord("/"):
+                    raise ValueError("Invalid base64 image data: unexpected escape")
+                self._decoder.feed(b"/")
+                self._escape = False
+                pos += 1
+                continue
+            match = STRING_SPECIAL_RE.search(chunk, pos)
+            stop = match.start() if match else end
+            if stop > pos:
+                self._decoder.feed(chunk[pos:stop])
+            if match is None:
+                return end
+            if chunk[stop] == BACKSLASH:
+                self._escape = True
+                pos = stop + 1
+                continue
+            self.image = self._decoder.finish()
+            self._state = self._after_value
+            return stop + 1
+        return pos
+
+    def _literal(self, chunk, pos):
+        match = LITERAL_END_RE.search(chunk, pos)
+        stop = match.start() if match else len(chunk)
+        self._buffer += chunk[pos:stop]
+        if len(self._buffer) > MAX_FIELD_BYTES:
+            raise ValueError("JSON field too large")
+        if match is not None:
+            self._end_literal()
+        return stop
+
+    def _end_literal(self):
+        value = json.loads(bytes(self._buffer))
+        self._buffer.clear()
+        if self._key == IMAGE_FIELD:
+            if value is not None:
+                raise ValueError(f"{IMAGE_FIELD} must be a string")
+        else:
+            self.fields[self._key] = value
+        self._state = self._after_value
+
+    def _after_value(self, chunk, pos):
+        pos = self._skip_whitespace(chunk, pos)
+        if pos < len(chunk):
+            if chunk[pos] == COMMA:
+                self._state = self._next_key
+            elif chunk[pos] == RBRACE:
+                self._state = self._done
+            else:
+                raise ValueError("Expected ',' or '}' after value")
+            pos += 1
+        return pos
+
+    def _done(self, chunk, pos):
+        pos = self._skip_whitespace(chunk, pos)
+        if pos < len(chunk):
+            raise ValueError("Unexpected data after JSON object")
+        return pos
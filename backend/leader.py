@@ -0,0 +1,71 @@
+"""
+Leader election among worker processes sharing a data directory.
+
+Storage maintenance and reminder delivery must run in exactly one worker.
+Every worker tries to take an exclusive flock on the same lock file; the
+one that holds it is the leader until its process exits, at which point
+the kernel releases the lock and the next retry of another worker wins.
+Nothing has to be cleaned up after a crash.
+"""
+
+import asyncio
+import fcntl
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+class LeaderElection:
+    """Hold the lock file at `path` and run `on_elected` once it is ours."""
+
+    def __init__(self, path, on_elected, registry, retry_interval=1.0):
+        self.path = path
+        self.on_elected = on_elected
+        self.retry_interval = retry_interval
+        self.is_leader = False
+        self.leader = registry.gauge(
+            "worker_is_leader", "1 in the worker running background jobs, else 0."
+        ).labels()
+        self._fd = None
+        self._task = None
+
+    async def start(self):
+        """Try once now, so a lone worker starts its jobs before serving, then keep retrying."""
+        # Opened here, after any fork, so each worker has its own lock
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        if not await self._try_acquire():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop retrying and release the lock; call after the leader's jobs have stopped."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        self.is_leader = False
+        self.leader.set(0)
+
+    async def _run(self):
+        while not await self._try_acquire():
+            await asyncio.sleep(self.retry_interval)
+
+    async def _try_acquire(self):
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        # Record the holder for anyone inspecting the lock file
+        os.ftruncate(self._fd, 0)
+        os.pwrite(self._fd, f"{os.getpid()}\n".encode("ascii"), 0)
+        self.is_leader = True
+        self.leader.set(1)
+        logger.info("Worker %d elected to run background jobs", os.getpid())
+        await self.on_elected()
+        return True
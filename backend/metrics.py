@@ -0,0 +1,222 @@
+"""
+In-process metrics exposed in the Prometheus text format.
+
+MetricsMiddleware is plain ASGI rather than BaseHTTPMiddleware, so it adds
+only a couple of closures and dictionary lookups per request and never
+buffers bodies. Requests are labelled by route template, not raw path, to
+keep the number of series bounded.
+"""
+
+import asyncio
+import time
+from bisect import bisect_left
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = tuple(256 * 4 ** i for i in range(10))  # 256 B .. 64 MB
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+UNMATCHED_ROUTE = "unmatched"
+
+
+class Counter:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self, name, labels):
+        yield name, labels, self.value
+
+
+class Gauge(Counter):
+    __slots__ = ()
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield f"{name}_bucket", labels + (("le", format_value(bound)),), cumulative
+        cumulative += self.counts[-1]
+        yield f"{name}_bucket", labels + (("le", "+Inf"),), cumulative
+        yield f"{name}_sum", labels, self.sum
+        yield f"{name}_count", labels, cumulative
+
+
+class Family:
+    """A named metric with one child per combination of label values."""
+
+    def __init__(self, name, help_text, kind, label_names, factory):
+        self.name = name
+        self.help = help_text
+        self.kind = kind
+        self.label_names = label_names
+        self.factory = factory
+        self.children = {}
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = self.factory()
+        return child
+
+    def render(self, lines):
+        lines.append(f"# HELP {self.name} {self.help}")
+        lines.append(f"# TYPE {self.name} {self.kind}")
+        for values, child in list(self.children.items()):
+            labels = tuple(zip(self.label_names, values))
+            for name, sample_labels, value in child.samples(self.name, labels):
+                if sample_labels:
+                    label_text = ",".join(f'{key}="{escape(str(v))}"' for key, v in sample_labels)
+                    lines.append(f"{name}{{{label_text}}} {format_value(value)}")
+                else:
+                    lines.append(f"{name} {format_value(value)}")
+
+
+def escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_value(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value)) if abs(value) < 1e15 else repr(value)
+    return str(value)
+
+
+class Registry:
+    """Metric families in registration order; registering a name twice returns the existing family."""
+
+    def __init__(self):
+        self.families = {}
+
+    def counter(self, name, help_text, label_names=()):
+        return self._add(Family(name, help_text, "counter", label_names, Counter))
+
+    def gauge(self, name, help_text, label_names=()):
+        return self._add(Family(name, help_text, "gauge", label_names, Gauge))
+
+    def histogram(self, name, help_text, buckets, label_names=()):
+        return self._add(Family(name, help_text, "histogram", label_names, lambda: Histogram(buckets)))
+
+    def render(self):
+        lines = []
+        for family in self.families.values():
+            family.render(lines)
+        return "\n".join(lines) + "\n"
+
+    def _add(self, family):
+        return self.families.setdefault(family.name, family)
+
+
+class MetricsMiddleware:
+    """Record request counts, latency, payload sizes and in-flight requests."""
+
+    def __init__(self, app, registry):
+        self.app = app
+        self.requests = registry.counter(
+            "http_requests_total", "HTTP requests by route and status.", ("method", "route", "status")
+        )
+        self.duration = registry.histogram(
+            "http_request_duration_seconds", "Time from request start to the last response byte.",
+            LATENCY_BUCKETS, ("method", "route"),
+        )
+        self.request_size = registry.histogram(
+            "http_request_size_bytes", "Request body size.", SIZE_BUCKETS, ("route",)
+        )
+        self.response_size = registry.histogram(
+            "http_response_size_bytes", "Response body size.", SIZE_BUCKETS, ("route",)
+        )
+        self.in_flight = registry.gauge("http_requests_in_flight", "Requests currently being served.").labels()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = 500
+        request_bytes = response_bytes = 0
+
+        async def receive_counting():
+            nonlocal request_bytes
+            message = await receive()
+            request_bytes += len(message.get("body", b""))
+            return message
+
+        async def send_counting(message):
+            nonlocal status, response_bytes
+            kind = message["type"]
+            if kind == "http.response.start":
+                status = message["status"]
+            elif kind == "http.response.body":
+                response_bytes += len(message.get("body", b""))
+            elif kind == "http.response.zerocopysend":
+                response_bytes += message.get("count") or 0
+            await send(message)
+
+        self.in_flight.value += 1
+        try:
+            await self.app(scope, receive_counting, send_counting)
+        finally:
+            self.in_flight.value -= 1
+            route = scope.get("route")
+            path = route.path if route is not None else UNMATCHED_ROUTE
+            method = scope["method"]
+            self.duration.labels(method, path).observe(time.perf_counter() - start)
+            self.requests.labels(method, path, status).value += 1
+            self.request_size.labels(path).observe(request_bytes)
+            self.response_size.labels(path).observe(response_bytes)
+
+
+class LoopLagMonitor:
+    """Measure how late the event loop wakes a sleeping task."""
+
+    def __init__(self, registry, interval=0.5):
+        self.interval = interval
+        self.lag = registry.gauge(
+            "event_loop_lag_latest_seconds", "Most recent event loop wake-up delay."
+        ).labels()
+        self.lag_histogram = registry.histogram(
+            "event_loop_lag_seconds", "Event loop wake-up delay.", LAG_BUCKETS
+        ).labels()
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(loop.time() - started - self.interval, 0.0)
+            self.lag.set(lag)
+            self.lag_histogram.observe(lag)
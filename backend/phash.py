@@ -0,0 +1,185 @@
+"""
+Perceptual hashes of prescription photos, for spotting near-duplicates.
+
+Each image gets a 64-bit difference hash (dHash): the picture is reduced to
+a 9x8 grayscale thumbnail and each bit records whether a pixel is brighter
+than its right-hand neighbour. Re-encoding, resizing or small exposure
+changes flip only a few bits, so two photos of the same prescription are a
+small Hamming distance apart.
+
+Hashes are kept as signed 64-bit integers, the way SQLite stores them. The
+in-memory index holds them in one contiguous uint64 array, so a lookup is a
+single vectorized XOR and popcount over every hash. NumPy and Pillow are
+imported on first use, keeping them out of server start-up.
+"""
+
+import threading
+
+HASH_WIDTH = 9
+HASH_HEIGHT = 8
+# Intermediate size the decoder is asked for before the final reduction
+DRAFT_SIZE = 64
+ORIENTATION_TAG = 0x0112
+
+# Hamming distances up to this are treated as the same photo
+DEFAULT_MAX_DISTANCE = 6
+
+
+def popcount(values):
+    """Number of set bits in each element of a uint64 array."""
+    import numpy as np
+
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(values)
+    # SWAR fallback for NumPy < 2.0
+    m1, m2, m4, h01 = (np.uint64(mask) for mask in (
+        0x5555555555555555, 0x3333333333333333, 0x0F0F0F0F0F0F0F0F, 0x0101010101010101,
+    ))
+    values = values - ((values >> np.uint64(1)) & m1)
+    values = (values & m2) + ((values >> np.uint64(2)) & m2)
+    values = (values + (values >> np.uint64(4))) & m4
+    return (values * h01) >> np.uint64(56)
+
+
+def image_phash(path):
+    """The dHash of the image at `path`, or None if it cannot be decoded."""
+    import numpy as np
+    from PIL import Image
+
+    transposes = {
+        2: Image.Transpose.FLIP_LEFT_RIGHT,
+        3: Image.Transpose.ROTATE_180,
+        4: Image.Transpose.FLIP_TOP_BOTTOM,
+        5: Image.Transpose.TRANSPOSE,
+        6: Image.Transpose.ROTATE_270,
+        7: Image.Transpose.TRANSVERSE,
+        8: Image.Transpose.ROTATE_90,
+    }
+    try:
+        with Image.open(path) as image:
+            orientation = image.getexif().get(ORIENTATION_TAG)
+            # Let the JPEG decoder downscale by up to 1/8 while decoding
+            image.draft("L", (DRAFT_SIZE, DRAFT_SIZE))
+            small = image.convert("L").resize((DRAFT_SIZE, DRAFT_SIZE), Image.Resampling.BOX)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+    if orientation in transposes:
+        # A photo and a copy with the rotation baked in should hash alike
+        small = small.transpose(transposes[orientation])
+    pixels = np.asarray(small.resize((HASH_WIDTH, HASH_HEIGHT), Image.Resampling.LANCZOS), dtype=np.int16)
+    bits = np.packbits(pixels[:, 1:] > pixels[:, :-1])
+    return int(bits.view(">i8")[0])
+
+
+def _as_unsigned(phashes):
+    import numpy as np
+
+    return np.asarray(phashes, dtype=np.int64).view(np.uint64)
+
+
+class PhashIndex:
+    """Perceptual hashes of image blobs, searchable by Hamming distance.
+
+    Keys are blob hashes. Values live in a uint64 array that doubles when
+    full; removal moves the last entry into the freed slot.
+    """
+
+    def __init__(self, capacity=1024):
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._values = None
+        self._keys = []
+        self._positions = {}
+        self._synced = 0
+
+    def __len__(self):
+        return len(self._keys)
+
+    def add(self, key, phash):
+        self.extend([(key, phash)])
+
+    def extend(self, items):
+        """Add or update (blob hash, phash) pairs."""
+        import numpy as np
+
+        items = dict(items)
+        values = _as_unsigned(list(items.values()))
+        with self._lock:
+            positions = [self._positions.get(key, -1) for key in items]
+            new = [i for i, position in enumerate(positions) if position < 0]
+            needed = len(self._keys) + len(new)
+            if self._values is None or needed > len(self._values):
+                grown = np.zeros(max(needed * 2, self.capacity), dtype=np.uint64)
+                if self._values is not None:
+                    grown[:len(self._keys)] = self._values[:len(self._keys)]
+                self._values = grown
+            keys = list(items)
+            for i in new:
+                positions[i] = len(self._keys)
+                self._positions[keys[i]] = positions[i]
+                self._keys.append(keys[i])
+            self._values[positions] = values
+
+    def sync(self, fetch):
+        """Add entries stored since the last sync.
+
+        `fetch(seq)` returns (seq, blob hash, phash) rows stored after `seq`,
+        in order, e.g. Store.phashes_since. Other worker processes write to
+        the same store, so this is how their uploads become searchable here.
+        """
+        with self._sync_lock:
+            rows = fetch(self._synced)
+            if rows:
+                self.extend([(key, phash) for _, key, phash in rows])
+                self._synced = rows[-1][0]
+
+    def remove(self, key):
+        with self._lock:
+            position = self._positions.pop(key, None)
+            if position is None:
+                return
+            last_key = self._keys.pop()
+            if last_key != key:
+                self._keys[position] = last_key
+                self._positions[last_key] = position
+                self._values[position] = self._values[len(self._keys)]
+
+    def search(self, phash, max_distance=DEFAULT_MAX_DISTANCE):
+        """(blob hash, distance) of every entry within `max_distance` bits, nearest first."""
+        import numpy as np
+
+        target = _as_unsigned([phash])[0]
+        with self._lock:
+            if self._values is None:
+                return []
+            distances = popcount(self._values[:len(self._keys)] ^ target)
+            matches = np.flatnonzero(distances <= max_distance)
+            matches = matches[np.argsort(distances[matches], kind="stable")]
+            return [(self._keys[i], int(distances[i])) for i in matches.tolist()]
+
+
+def cluster(phashes, max_distance=DEFAULT_MAX_DISTANCE):
+    """Group positions of `phashes` linked by chains of near matches.
+
+    Returns every group, singletons included, as sorted lists of positions.
+    Each hash is compared against all later ones in one vectorized pass.
+    """
+    import numpy as np
+
+    values = _as_unsigned(phashes)
+    parents = list(range(len(values)))
+
+    def root(i):
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    for i in range(len(values) - 1):
+        for j in (np.flatnonzero(popcount(values[i + 1:] ^ values[i]) <= max_distance) + i + 1).tolist():
+            parents[root(j)] = root(i)
+    groups = {}
+    for i in range(len(values)):
+        groups.setdefault(root(i), []).append(i)
+    return list(groups.values())
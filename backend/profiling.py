@@ -0,0 +1,333 @@
+"""
+Opt-in sampling profiler for individual requests.
+
+A request is profiled when it carries a valid signed X-Profile header, when
+it falls in a configured random fraction of traffic, or, with a latency
+threshold set, always, keeping the profile only if the request turns out
+slow. While at least one profiled request is in flight a background thread
+snapshots every thread's stack at a fixed interval:
+
+- event loop samples belong to a request when its middleware frame is on
+  the loop's stack, and are trimmed to the frames below it
+- while the request is suspended, busy worker threads are sampled under
+  "[threadpool]", or "[awaiting]" is counted if none are busy
+
+so time the request spends suspended shows up as well. Finished profiles
+are kept on disk, shared by all worker processes, with the oldest removed
+beyond a fixed count. They are served as collapsed stacks
+("frame;frame;frame count") that flamegraph.pl and speedscope read directly.
+
+ProfilingMiddleware is only installed when profiling is configured, so a
+server without it pays nothing per request.
+"""
+
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import os
+import queue
+import random
+import selectors
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import thread as futures_thread
+from datetime import datetime, timezone
+from pathlib import Path
+
+HEADER = b"x-profile"
+# Where the server serves profiles; fetching them is never itself profiled
+PROFILES_PATH = "/debug/profiles"
+CONTENT_TYPE = "text/plain; charset=utf-8"
+THREADPOOL_FRAME = "[threadpool]"
+AWAITING_FRAME = "[awaiting]"
+
+# A thread whose innermost frame is in one of these is blocked, not working
+_IDLE_FILES = frozenset({
+    threading.__file__, queue.__file__, selectors.__file__, futures_thread.__file__,
+    # multiprocessing.connection, without importing it
+    os.path.join(os.path.dirname(threading.__file__), "multiprocessing", "connection.py"),
+})
+
+_frame_names = {}
+
+logger = logging.getLogger(__name__)
+
+
+def sign_token(secret, expires):
+    """An X-Profile header value valid until the unix time `expires`."""
+    digest = hmac.new(secret.encode("utf-8"), str(int(expires)).encode("ascii"), hashlib.sha256)
+    return f"{int(expires)}.{digest.hexdigest()}"
+
+
+def verify_token(secret, token, now=None):
+    expires, _, _ = token.partition(".")
+    if not expires.isdigit() or int(expires) < (time.time() if now is None else now):
+        return False
+    return hmac.compare_digest(sign_token(secret, int(expires)), token)
+
+
+def _frame_name(code):
+    name = _frame_names.get(code)
+    if name is None:
+        name = _frame_names[code] = f"{code.co_qualname} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+    return name
+
+
+class Capture:
+    """Stack samples collected for one request."""
+
+    __slots__ = ("frame", "thread_id", "started", "started_at", "stacks")
+
+    def __init__(self, frame, thread_id):
+        self.frame = frame
+        self.thread_id = thread_id
+        self.started = time.perf_counter()
+        self.started_at = datetime.now(timezone.utc)
+        self.stacks = Counter()
+
+    def collapsed(self, root):
+        """The samples as collapsed stack lines, heaviest first, under a `root` frame."""
+        root = root.replace(";", ":")
+        return [
+            ";".join([root, *(key if isinstance(key, str) else _frame_name(key) for key in stack)]) + f" {count}"
+            for stack, count in self.stacks.most_common()
+        ]
+
+
+class Sampler:
+    """Snapshot thread stacks every `interval` seconds while captures are active."""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self._captures = set()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+    def start(self):
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="request-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def begin(self, frame):
+        """Start sampling the request running in `frame` on the current thread."""
+        capture = Capture(frame, threading.get_ident())
+        with self._condition:
+            self._captures.add(capture)
+            self._condition.notify()
+        return capture
+
+    def end(self, capture):
+        with self._condition:
+            self._captures.discard(capture)
+        capture.frame = None
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._captures and not self._stopped:
+                    self._condition.wait()
+                if self._stopped:
+                    return
+            time.sleep(self.interval)
+            with self._condition:
+                captures = list(self._captures)
+            if captures:
+                self._sample(captures)
+
+    def _sample(self, captures):
+        own_id = threading.get_ident()
+        chains = {}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_id:
+                continue
+            chain = []
+            while frame is not None:
+                chain.append(frame)
+                frame = frame.f_back
+            chains[thread_id] = chain
+        for capture in captures:
+            chain = chains.get(capture.thread_id, ())
+            position = next((i for i, frame in enumerate(chain) if frame is capture.frame), None)
+            if position is not None:
+                capture.stacks[tuple(frame.f_code for frame in reversed(chain[:position]))] += 1
+                continue
+            busy = [
+                other for thread_id, other in chains.items()
+                if thread_id != capture.thread_id and other and other[0].f_code.co_filename not in _IDLE_FILES
+            ]
+            for other in busy:
+                capture.stacks[(THREADPOOL_FRAME, *(
+                    frame.f_code for frame in reversed(other)
+                    if frame.f_code.co_filename != threading.__file__
+                ))] += 1
+            if not busy:
+                capture.stacks[(AWAITING_FRAME,)] += 1
+
+
+class ProfileStore:
+    """The newest `slots` finished profiles, one JSON file each under `root`.
+
+    Ids are microsecond timestamps, so worker processes sharing the
+    directory never hand out the same one and file names sort by age.
+    """
+
+    def __init__(self, root, slots):
+        self.root = Path(root)
+        self.slots = slots
+
+    def open(self):
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def list(self):
+        """Metadata of the kept profiles, newest first."""
+        profiles = []
+        for path in sorted(self.root.glob("*.json"), reverse=True):
+            profile = self._read(path)
+            if profile is not None:
+                profile.pop("stacks")
+                profiles.append(profile)
+        return profiles
+
+    def get(self, profile_id):
+        """A profile with its collapsed stack lines, or None once it was pruned."""
+        return self._read(self._path(profile_id))
+
+    def save(self, profile, stacks):
+        temp_path = self.root / f"{os.getpid()}-{threading.get_ident()}.tmp"
+        profile_id = time.time_ns() // 1000
+        try:
+            while True:
+                profile_data = {"id": profile_id, **profile, "stacks": stacks}
+                temp_path.write_text(json.dumps(profile_data))
+                try:
+                    # Fails instead of replacing when another worker took the id
+                    os.link(temp_path, self._path(profile_id))
+                    break
+                except FileExistsError:
+                    profile_id += 1
+        finally:
+            temp_path.unlink(missing_ok=True)
+        for path in sorted(self.root.glob("*.json"))[:-self.slots]:
+            path.unlink(missing_ok=True)
+        return profile_id
+
+    @staticmethod
+    def _read(path):
+        try:
+            return json.loads(path.read_text())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _path(self, profile_id):
+        return self.root / f"{profile_id:020d}.json"
+
+
+class ProfilingMiddleware:
+    """Decide which requests to profile and store the profiles worth keeping.
+
+    `secret` enables the X-Profile header, `sample_rate` profiles that
+    fraction of all requests, and `slow_seconds` keeps a profile of any
+    request that takes at least that long (which means sampling every
+    request while it runs).
+    """
+
+    def __init__(self, app, sampler, store, registry, secret="", sample_rate=0.0, slow_seconds=0.0):
+        self.app = app
+        self.sampler = sampler
+        self.store = store
+        self.secret = secret
+        self.sample_rate = sample_rate
+        self.slow_seconds = slow_seconds
+        self.captured = registry.counter(
+            "request_profiles_captured_total", "Request profiles written, by trigger.", ("reason",)
+        )
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"].startswith(PROFILES_PATH):
+            await self.app(scope, receive, send)
+            return
+        reason = self._reason(scope)
+        if reason is None:
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+
+        async def send_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        capture = self.sampler.begin(sys._getframe())
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            self.sampler.end(capture)
+            duration = time.perf_counter() - capture.started
+            if reason != "slow" or duration >= self.slow_seconds:
+                self._keep(scope, reason, status, duration, capture)
+
+    def _reason(self, scope):
+        if self.secret:
+            for name, value in scope["headers"]:
+                if name == HEADER:
+                    if verify_token(self.secret, value.decode("latin-1")):
+                        return "requested"
+                    break
+        if self.sample_rate and random.random() < self.sample_rate:
+            return "sampled"
+        if self.slow_seconds:
+            return "slow"
+        return None
+
+    def _keep(self, scope, reason, status, duration, capture):
+        route = scope.get("route")
+        path = route.path if route is not None else scope["path"]
+        profile = {
+            "method": scope["method"],
+            "path": path,
+            "status": status,
+            "reason": reason,
+            "duration_ms": round(duration * 1000, 3),
+            "samples": sum(capture.stacks.values()),
+            "started_at": capture.started_at.isoformat(),
+        }
+        stacks = capture.collapsed(f"{scope['method']} {path}")
+        self.captured.labels(reason).inc()
+        # Written off the event loop; the response has already been sent
+        asyncio.get_running_loop().run_in_executor(None, self._save, profile, stacks)
+
+    def _save(self, profile, stacks):
+        try:
+            self.store.save(profile, stacks)
+        except OSError:
+            logger.exception("Failed to write request profile")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mint an X-Profile header value from PROFILE_SECRET.")
+    parser.add_argument("--ttl", type=int, default=600, help="seconds the token stays valid")
+    args = parser.parse_args()
+    secret = os.environ.get("PROFILE_SECRET")
+    if not secret:
+        sys.exit("PROFILE_SECRET is not set")
+    print(sign_token(secret, time.time() + args.ttl))
+
+
+if __name__ == "__main__":
+    main()
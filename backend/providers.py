@@ -0,0 +1,167 @@
+"""
+Nearest-provider search over a locally loaded optometrist directory.
+
+The directory (CSV, JSON array or NDJSON) is loaded once into NumPy arrays
+sorted by a fixed-size latitude/longitude grid cell, so the points of one
+grid row inside a longitude range are a contiguous slice. A query gathers
+those slices for its bounding box, which is a handful of binary searches,
+then computes haversine distances for just those candidates in one
+vectorized pass. Query points are snapped to a ~100 m cell and results are
+memoized per (cell, radius, limit), so repeat lookups from one
+neighbourhood are dictionary hits.
+"""
+
+import csv
+import json
+import logging
+import math
+from functools import lru_cache
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+EARTH_RADIUS_KM = 6371.0088
+CELL_DEGREES = 0.5
+# Query coordinates are rounded to this many decimals (~110 m of latitude)
+QUERY_PRECISION = 3
+QUERY_CACHE_SIZE = 16384
+
+PROVIDER_FIELDS = ("id", "name", "address", "city", "state", "postal_code", "phone", "website")
+# Column names accepted for each field, first match wins
+FIELD_ALIASES = {
+    "latitude": ("latitude", "lat"),
+    "longitude": ("longitude", "lon", "lng", "long"),
+    "postal_code": ("postal_code", "zip", "zip_code", "postcode"),
+    "phone": ("phone", "telephone"),
+    "website": ("website", "url"),
+}
+
+_COLUMNS = int(360 / CELL_DEGREES)
+
+
+def _cell_keys(lat, lon):
+    rows = np.floor((lat + 90.0) / CELL_DEGREES).astype(np.int64)
+    columns = np.floor((lon + 180.0) / CELL_DEGREES).astype(np.int64) % _COLUMNS
+    return rows * _COLUMNS + columns
+
+
+def _read_records(path):
+    suffix = path.suffix.lower()
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        if suffix == ".csv":
+            yield from csv.DictReader(f)
+        elif suffix in (".ndjson", ".jsonl"):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            data = json.load(f)
+            yield from data.get("providers", []) if isinstance(data, dict) else data
+
+
+def _field(record, name):
+    for alias in FIELD_ALIASES.get(name, (name,)):
+        value = record.get(alias)
+        if value not in (None, ""):
+            return value
+    return None
+
+
+def _text(value):
+    return None if value is None else str(value).strip()
+
+
+class ProviderIndex:
+    """An immutable grid index of provider locations."""
+
+    def __init__(self, providers, lat, lon):
+        keys = _cell_keys(lat, lon)
+        order = np.argsort(keys, kind="stable")
+        self.keys = keys[order]
+        self.lat = lat[order]
+        self.lon = lon[order]
+        self._lat_rad = np.radians(self.lat)
+        self._lon_rad = np.radians(self.lon)
+        self._cos_lat = np.cos(self._lat_rad)
+        self.providers = [providers[i] for i in order]
+        self.nearest = lru_cache(maxsize=QUERY_CACHE_SIZE)(self._nearest)
+
+    def __len__(self):
+        return len(self.providers)
+
+    @classmethod
+    def load(cls, path):
+        """Build an index from a directory file; rows without valid coordinates are skipped."""
+        providers, lats, lons, skipped = [], [], [], 0
+        for record in _read_records(path):
+            try:
+                lat = float(_field(record, "latitude"))
+                lon = float(_field(record, "longitude"))
+            except (TypeError, ValueError):
+                skipped += 1
+                continue
+            if not (-90.0 <= lat <= 90.0 and -180.0 <= lon <= 180.0):
+                skipped += 1
+                continue
+            providers.append(tuple(_text(_field(record, name)) for name in PROVIDER_FIELDS))
+            lats.append(lat)
+            lons.append(lon)
+        if skipped:
+            logger.warning("Skipped %d providers without valid coordinates in %s", skipped, path)
+        return cls(providers, np.array(lats, dtype=np.float64), np.array(lons, dtype=np.float64))
+
+    def search(self, lat, lon, radius_km, limit):
+        """Up to `limit` providers within `radius_km` of the point, nearest first."""
+        return self.nearest(round(lat, QUERY_PRECISION), round(lon, QUERY_PRECISION), radius_km, limit)
+
+    def _nearest(self, lat, lon, radius_km, limit):
+        candidates = self._candidates(lat, lon, radius_km)
+        if candidates.size == 0:
+            return ()
+        lat_rad, lon_rad = math.radians(lat), math.radians(lon)
+        a = (
+            np.sin((self._lat_rad[candidates] - lat_rad) / 2) ** 2
+            + math.cos(lat_rad) * self._cos_lat[candidates]
+            * np.sin((self._lon_rad[candidates] - lon_rad) / 2) ** 2
+        )
+        distances = 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+        inside = np.flatnonzero(distances <= radius_km)
+        if inside.size > limit:
+            inside = inside[np.argpartition(distances[inside], limit - 1)[:limit]]
+        inside = inside[np.argsort(distances[inside], kind="stable")]
+        return tuple(
+            {
+                **dict(zip(PROVIDER_FIELDS, self.providers[index])),
+                "latitude": float(self.lat[index]),
+                "longitude": float(self.lon[index]),
+                "distance_km": round(float(distance), 3),
+            }
+            for index, distance in zip(candidates[inside].tolist(), distances[inside].tolist())
+        )
+
+    def _candidates(self, lat, lon, radius_km):
+        """Indices of points in the grid cells covering the query's bounding box."""
+        lat_delta = math.degrees(radius_km / EARTH_RADIUS_KM)
+        south, north = max(lat - lat_delta, -90.0), min(lat + lat_delta, 90.0)
+        # Widest longitude span is at the box edge nearest a pole
+        cos_edge = math.cos(math.radians(max(abs(south), abs(north))))
+        lon_delta = 180.0 if cos_edge < 1e-9 else math.degrees(radius_km / (EARTH_RADIUS_KM * cos_edge))
+        if lon_delta >= 180.0 - CELL_DEGREES:
+            column_ranges = [(0, _COLUMNS - 1)]
+        else:
+            west = int(math.floor((lon - lon_delta + 180.0) / CELL_DEGREES)) % _COLUMNS
+            east = int(math.floor((lon + lon_delta + 180.0) / CELL_DEGREES)) % _COLUMNS
+            # A box crossing the antimeridian wraps around to column 0
+            column_ranges = [(west, east)] if west <= east else [(west, _COLUMNS - 1), (0, east)]
+        first_row = int(math.floor((south + 90.0) / CELL_DEGREES))
+        last_row = int(math.floor((north + 90.0) / CELL_DEGREES))
+        starts, ends = [], []
+        for row in range(first_row, last_row + 1):
+            for west, east in column_ranges:
+                starts.append(row * _COLUMNS + west)
+                ends.append(row * _COLUMNS + east + 1)
+        starts = np.searchsorted(self.keys, starts)
+        ends = np.searchsorted(self.keys, ends)
+        slices = [np.arange(start, end) for start, end in zip(starts.tolist(), ends.tolist()) if end > start]
+        return np.concatenate(slices) if slices else np.empty(0, dtype=np.int64)
@@ -0,0 +1,57 @@
+"""
+Compact record types for rows read out of the store.
+
+List and sync reads build these straight from SQLite tuples instead of
+sqlite3.Row -> dict -> pydantic model, and orjson serializes slotted
+dataclasses natively, so a list response is encoded to bytes in one C call
+with no per-item validation. Records still support `record["field"]` for
+code written against the old dict rows.
+"""
+
+from dataclasses import dataclass, fields
+from typing import Optional
+
+
+class Record:
+    __slots__ = ()
+
+    def __getitem__(self, name):
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name) from None
+
+    @classmethod
+    def columns(cls):
+        return ", ".join(field.name for field in fields(cls))
+
+    @classmethod
+    def row_factory(cls, cursor, row):
+        return cls(*row)
+
+
+@dataclass(slots=True)
+class FamilyMemberRecord(Record):
+    id: str
+    name: str
+    relationship: str
+    created_at: str
+
+
+@dataclass(slots=True)
+class PrescriptionRecord(Record):
+    id: str
+    family_member_id: str
+    rx_type: str
+    image_hash: Optional[str]
+    notes: str
+    date_taken: str
+    expiry_date: Optional[str]
+    created_at: str
+
+
+def fetch_records(conn, record_type, query, params=()):
+    """Run `query`, which must select `record_type.columns()`, into records."""
+    cursor = conn.cursor()
+    cursor.row_factory = record_type.row_factory
+    return cursor.execute(query, params).fetchall()
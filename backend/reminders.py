@@ -0,0 +1,177 @@
+"""
+Server-side prescription expiry reminders.
+
+Pending reminders live in the reminders table, whose index on due_at acts as
+a persistent priority queue: inserting or cancelling one is an O(log n)
+B-tree operation and survives restarts. ReminderScheduler sleeps until the
+earliest due time, then hands everything due to a sink in batches, so it
+wakes once per batch rather than once per reminder. The store reports each
+commit that schedules reminders, and the scheduler wakes early when one is
+due before its next check, so a reminder that is already due goes out at
+once instead of after the next poll.
+"""
+
+import asyncio
+import json
+import logging
+import time
+
+from fastapi.concurrency import run_in_threadpool
+
+# Same schedule the app uses for local notifications
+ALERT_DAYS = (30, 14, 7, 2, 0)
+REMINDER_HOUR_UTC = 8
+SECONDS_PER_DAY = 86400
+
+logger = logging.getLogger(__name__)
+
+
+def reminder_times(expiry_day, now):
+    """(days_before, due_at) pairs still in the future for an expiry day number."""
+    times = []
+    for days_before in ALERT_DAYS:
+        due_at = (expiry_day - days_before) * SECONDS_PER_DAY + REMINDER_HOUR_UTC * 3600
+        if due_at > now:
+            times.append((days_before, due_at))
+    return times
+
+
+def reminder_message(days_before, member_name, rx_type, expiry_date):
+    """Title and body matching the app's local notification copy."""
+    kind = "eyeglass" if rx_type == "eyeglass" else "contact lens"
+    name = member_name or "Family member"
+    if days_before == 0:
+        return ("⚠️ Prescription Expires TODAY!",
+                f"{name}'s {kind} prescription expires TODAY! Schedule an eye exam immediately to renew your prescription.")
+    if days_before == 2:
+        return ("⏰ Prescription Expires in 2 Days!",
+                f"{name}'s {kind} prescription expires in 2 days on {expiry_date}. Don't forget to schedule your eye exam!")
+    if days_before == 7:
+        return ("📅 Prescription Expires in 1 Week",
+                f"{name}'s {kind} prescription expires in 7 days on {expiry_date}. Time to book your eye appointment!")
+    if days_before == 14:
+        return ("📋 Prescription Expires in 2 Weeks",
+                f"{name}'s {kind} prescription expires in 14 days on {expiry_date}. Consider scheduling an eye exam soon.")
+    return ("🔔 Prescription Expires in 30 Days",
+            f"{name}'s {kind} prescription will expire on {expiry_date}. Start planning your next eye exam!")
+
+
+class FileSink:
+    """Append delivered reminders to a JSON Lines file."""
+
+    def __init__(self, path):
+        self.path = path
+
+    async def deliver(self, reminders):
+        await run_in_threadpool(self._append, reminders)
+
+    def _append(self, reminders):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as f:
+            for reminder in reminders:
+                f.write(json.dumps(reminder, ensure_ascii=False) + "\n")
+
+
+class QueueSink:
+    """Put each delivered batch on an asyncio queue (for tests and in-process consumers)."""
+
+    def __init__(self, queue=None):
+        self.queue = queue or asyncio.Queue()
+
+    async def deliver(self, reminders):
+        await self.queue.put(reminders)
+
+
+class ReminderScheduler:
+    """Dispatch due reminders from the store to a sink.
+
+    Delivery is at-least-once: a batch is removed from the store only after
+    the sink accepts it. `poll_interval` bounds how long a newly scheduled
+    reminder that is earlier than the current wake-up time can wait.
+    """
+
+    def __init__(self, store, sink, batch_size=500, poll_interval=60.0):
+        self.store = store
+        self.sink = sink
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self._task = None
+        self._loop = None
+        self._wakeup = None
+        # When the run loop next looks at the queue by itself
+        self._next_check = float("inf")
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        # Created here so the event binds to the loop the scheduler runs on
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def wake(self):
+        """Re-check for due reminders now instead of waiting for the timer.
+
+        Safe to call from any thread.
+        """
+        if self._wakeup is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def reminder_scheduled(self, due_at):
+        """Store hook: wake up if a new reminder is due before the next check."""
+        if due_at < self._next_check:
+            self.wake()
+
+    async def dispatch_due(self, now=None):
+        """Deliver every reminder due by `now`; returns how many were sent."""
+        now = time.time() if now is None else now
+        sent = 0
+        while True:
+            batch = await run_in_threadpool(self.store.due_reminders, now, self.batch_size)
+            if not batch:
+                return sent
+            await self.sink.deliver([self._payload(reminder) for reminder in batch])
+            await run_in_threadpool(self.store.complete_reminders, [r["id"] for r in batch])
+            sent += len(batch)
+            if len(batch) < self.batch_size:
+                return sent
+
+    async def _run(self):
+        while True:
+            # Cleared before looking, so a wake-up during dispatch is not lost
+            self._wakeup.clear()
+            self._next_check = float("inf")
+            try:
+                sent = await self.dispatch_due()
+                if sent:
+                    logger.info("Dispatched %d expiry reminders", sent)
+                next_due = await run_in_threadpool(self.store.next_reminder_due)
+            except Exception:
+                logger.exception("Reminder dispatch failed")
+                next_due = None
+            delay = self.poll_interval
+            if next_due is not None:
+                delay = min(max(next_due - time.time(), 0), self.poll_interval)
+            self._next_check = time.time() + delay
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    @staticmethod
+    def _payload(reminder):
+        title, body = reminder_message(
+            reminder["days_before"], reminder["member_name"], reminder["rx_type"], reminder["expiry_date"]
+        )
+        return {**reminder, "title": title, "body": body}
@@ -0,0 +1,143 @@
+"""
+Run the API in several worker processes sharing one listening socket.
+
+The app is imported once in this process, which also applies any schema
+migrations; each worker is then forked from it, so start-up cost is paid
+once and the imported code is shared copy-on-write. Every worker runs its
+own event loop on the shared socket and the kernel spreads connections
+between them. Workers share the database and data directory: cached
+responses are revalidated against versions stored in the database, and
+maintenance and reminder delivery run only in the worker that wins the
+leader lock (see leader.py). A worker that dies is replaced.
+
+    python serve.py --workers 4 --port 8001
+
+Behind a reverse proxy or ingress, pass its address in --forwarded-allow-ips
+(or FORWARDED_ALLOW_IPS) so each client is seen at its own address.
+"""
+
+import argparse
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+
+import uvicorn
+
+logger = logging.getLogger("serve")
+
+# A worker dying sooner than this after start is failing at start-up
+MIN_WORKER_LIFETIME = 1.0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default=os.environ.get("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", 8001)))
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("WEB_CONCURRENCY", 0)) or os.cpu_count(),
+                        help="worker processes (default WEB_CONCURRENCY, else one per CPU)")
+    parser.add_argument("--forwarded-allow-ips", default=os.environ.get("FORWARDED_ALLOW_IPS", "127.0.0.1"),
+                        help="proxy addresses whose X-Forwarded-For is trusted as the client address "
+                             "(default FORWARDED_ALLOW_IPS, else 127.0.0.1; '*' trusts every peer)")
+    parser.add_argument("--log-level", default="info")
+    return parser.parse_args()
+
+
+def bind(host, port):
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+def run_worker(config, sock):
+    uvicorn.Server(config).run(sockets=[sock])
+
+
+def spawn(config, sock):
+    pid = os.fork()
+    if pid:
+        return pid
+    # uvicorn installs its own handlers; drop the supervisor's
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    code = 0
+    try:
+        run_worker(config, sock)
+    except BaseException:
+        logger.exception("Worker %d failed", os.getpid())
+        code = 1
+    finally:
+        os._exit(code)
+
+
+def supervise(config, sock, workers):
+    started = {}
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(started):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for _ in range(workers):
+        started[spawn(config, sock)] = time.monotonic()
+    logger.info("Serving on %s with %d workers", sock.getsockname(), workers)
+    while started:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        lifetime = time.monotonic() - started.pop(pid, time.monotonic())
+        if stopping:
+            continue
+        logger.warning("Worker %d exited with status %d; replacing it", pid, os.waitstatus_to_exitcode(status))
+        if lifetime < MIN_WORKER_LIFETIME:
+            # Don't spin when every new worker fails straight away
+            time.sleep(MIN_WORKER_LIFETIME)
+        if not stopping:
+            started[spawn(config, sock)] = time.monotonic()
+
+
+def main():
+    args = parse_args()
+    workers = max(1, args.workers)
+    logging.basicConfig(level=args.log_level.upper(), format="%(asctime)s %(name)s %(levelname)s %(message)s")
+    # Each worker would otherwise size its thumbnail pool for the whole machine
+    os.environ.setdefault("THUMBNAIL_WORKERS", str(max(1, (os.cpu_count() or 1) // workers)))
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import server
+
+    # Migrate once here rather than racing in every worker
+    server.store.open()
+    server.store.close()
+    # Rate limits key requests without X-Device-Id on the client address, which
+    # behind a load balancer is only right once its forwarded header is trusted
+    config = uvicorn.Config(
+        server.app, log_level=args.log_level, access_log=False,
+        proxy_headers=True, forwarded_allow_ips=args.forwarded_allow_ips,
+    )
+    # Imports the protocol implementations before forking, so workers share them too
+    config.load()
+    sock = bind(args.host, args.port)
+    if workers == 1:
+        run_worker(config, sock)
+    else:
+        supervise(config, sock, workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,29 +1,1083 @@
-from fastapi import FastAPI
+import asyncio
+import base64
+import json
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Any, Dict, List, Literal, Optional
+
+import anyio
+import orjson
+from dotenv import load_dotenv
+from fastapi import APIRouter, FastAPI, HTTPException, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, Field, ValidationError, field_validator
 from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, Response, StreamingResponse
 
-app = FastAPI(title="Optical Rx Now API - Minimal")
+from admission import AdmissionMiddleware
+from backup import MEDIA_TYPE as BACKUP_MEDIA_TYPE
+from backup import BackupError, ChunkedUploads, backup_chunks, restore_archive
+from blobs import DEFAULT_CONTENT_TYPE, HASH_RE, IMAGE_CONTENT_TYPES, BlobResponse, BlobStore
+from cache import ResponseCache, etag_matches
+from dates import EXPIRING_SOON_DAYS, parse_day, today_day
+from events import EVENT_TYPES, EventIngestor, EventQueueFull, event_row
+from health import ReadinessProbe
+from ingest import ImageTooLarge, PrescriptionStreamParser
+from leader import LeaderElection
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE
+from metrics import LoopLagMonitor, MetricsMiddleware, Registry
+from phash import DEFAULT_MAX_DISTANCE, PhashIndex, cluster, image_phash
+from profiling import CONTENT_TYPE as PROFILE_CONTENT_TYPE
+from profiling import PROFILES_PATH, ProfileStore, ProfilingMiddleware, Sampler, verify_token
+from reminders import FileSink, ReminderScheduler
+from storage import (
+    LIST_COLUMNS, MEMBER, MEMBER_PRESCRIPTIONS, MEMBERS_VERSION, PRESCRIPTION, PRESCRIPTIONS_VERSION,
+    BatchFailed, Store,
+)
+from thumbnails import VARIANT_CONTENT_TYPE, VariantCache, VariantError, pick_width
+from transfer import MEDIA_TYPES, Importer, export_chunks, format_for
 
-# CORS middleware
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+ROOT_DIR = Path(__file__).parent
+load_dotenv(ROOT_DIR / '.env')
+
+DATA_DIR = Path(os.environ.get('DATA_DIR', ROOT_DIR / 'data'))
+
+# Unreferenced blobs are kept this long before their files are removed
+BLOB_GC_GRACE = timedelta(seconds=int(os.environ.get('BLOB_GC_GRACE_SECONDS', 3600)))
+BLOB_GC_INTERVAL = int(os.environ.get('BLOB_GC_INTERVAL_SECONDS', 600))
+# Clients whose sync cursor is older than this must resync from scratch
+SYNC_TOMBSTONE_RETENTION = timedelta(days=int(os.environ.get('SYNC_TOMBSTONE_DAYS', 90)))
+SYNC_BATCH_SIZE = 500
+SYNC_MAX_BATCH_SIZE = 2000
+MAX_IMAGE_BYTES = int(os.environ.get('MAX_IMAGE_BYTES', 25 * 1024 * 1024))
+VARIANT_CACHE_BYTES = int(os.environ.get('VARIANT_CACHE_BYTES', 64 * 1024 * 1024))
+THUMBNAIL_WORKERS = int(os.environ.get('THUMBNAIL_WORKERS', 0)) or None
+LIST_CACHE_BYTES = int(os.environ.get('LIST_CACHE_BYTES', 16 * 1024 * 1024))
+MAX_PAGE_SIZE = 1000
+# Photos whose perceptual hashes differ in at most this many bits are flagged as duplicates
+DUPLICATE_MAX_DISTANCE = int(os.environ.get('DUPLICATE_MAX_DISTANCE', DEFAULT_MAX_DISTANCE))
+# Distinct photos one duplicates listing may compare; clustering them is quadratic
+MAX_DUPLICATE_PHOTOS = int(os.environ.get('MAX_DUPLICATE_PHOTOS', 2000))
+PHASH_BACKFILL_BATCH = 256
+# Optometrist directory (CSV, JSON or NDJSON) behind /api/optometrists/near
+PROVIDERS_PATH = Path(os.environ.get('PROVIDERS_PATH', DATA_DIR / 'optometrists.csv'))
+MAX_PROVIDER_RADIUS_KM = 250
+MAX_PROVIDER_RESULTS = 100
+EVENT_QUEUE_SIZE = int(os.environ.get('EVENT_QUEUE_SIZE', 100_000))
+MAX_EVENTS_PER_REQUEST = 500
+# Raw analytics events are kept this long; daily rollups are kept forever
+EVENT_RETENTION_DAYS = int(os.environ.get('EVENT_RETENTION_DAYS', 90))
+MAX_BATCH_OPERATIONS = 1000
+READINESS_INTERVAL = float(os.environ.get('READINESS_INTERVAL_SECONDS', 5))
+# Per-client token buckets (by X-Device-Id, else address); 0 disables the rate limit.
+# Behind a proxy, trust its forwarded address with FORWARDED_ALLOW_IPS
+RATE_LIMIT_PER_SECOND = float(os.environ.get('RATE_LIMIT_PER_SECOND', 20))
+RATE_LIMIT_BURST = int(os.environ.get('RATE_LIMIT_BURST', 60))
+RATE_LIMIT_MAX_CLIENTS = int(os.environ.get('RATE_LIMIT_MAX_CLIENTS', 10_000))
+# Requests served at once, and how many may wait (and for how long) for a slot; 0 disables the cap
+MAX_CONCURRENT_REQUESTS = int(os.environ.get('MAX_CONCURRENT_REQUESTS', 64))
+ADMISSION_QUEUE_SIZE = int(os.environ.get('ADMISSION_QUEUE_SIZE', 128))
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get('ADMISSION_QUEUE_TIMEOUT_SECONDS', 2))
+# Request profiling is off unless one of these is set: a secret for signed
+# X-Profile headers, a fraction of requests to sample, or a latency above
+# which every request's profile is kept. Profiles are only served over HTTP
+# to holders of the secret; without one, read them from DATA_DIR/profiles
+PROFILE_SECRET = os.environ.get('PROFILE_SECRET', '')
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+PROFILE_SLOW_MS = float(os.environ.get('PROFILE_SLOW_MS', 0))
+PROFILING_ENABLED = bool(PROFILE_SECRET or PROFILE_SAMPLE_RATE or PROFILE_SLOW_MS)
+PROFILE_INTERVAL_MS = float(os.environ.get('PROFILE_INTERVAL_MS', 5))
+PROFILE_SLOTS = int(os.environ.get('PROFILE_SLOTS', 100))
+# Room for an inline base64 image plus the rest of its import record
+MAX_IMPORT_LINE_BYTES = MAX_IMAGE_BYTES * 4 // 3 + 64 * 1024
+BACKUP_CHUNK_BYTES = 4 * 1024 * 1024
+MAX_BACKUP_BYTES = int(os.environ.get('MAX_BACKUP_BYTES', 2 * 1024 * 1024 * 1024))
+# Restore uploads idle this long are discarded
+RESTORE_UPLOAD_EXPIRY = int(os.environ.get('RESTORE_UPLOAD_EXPIRY_SECONDS', 24 * 3600))
+
+store = Store(DATA_DIR / 'optical_rx.db')
+blob_store = BlobStore(DATA_DIR / 'blobs')
+list_cache = ResponseCache(LIST_CACHE_BYTES)
+phash_index = PhashIndex()
+restore_uploads = ChunkedUploads(
+    DATA_DIR / 'restore_uploads', BACKUP_CHUNK_BYTES, MAX_BACKUP_BYTES, RESTORE_UPLOAD_EXPIRY
 )
+profile_store = ProfileStore(DATA_DIR / 'profiles', PROFILE_SLOTS)
+profile_sampler = Sampler(PROFILE_INTERVAL_MS / 1000)
+variant_cache = VariantCache(DATA_DIR / 'variants', VARIANT_CACHE_BYTES, THUMBNAIL_WORKERS)
+reminder_scheduler = ReminderScheduler(
+    store, FileSink(Path(os.environ.get('REMINDER_SINK_PATH', DATA_DIR / 'reminders.jsonl')))
+)
+# Writes in this worker wake the scheduler (if it runs here) for reminders already due
+store.on_reminders_scheduled = reminder_scheduler.reminder_scheduled
+
+logger = logging.getLogger(__name__)
+
+app = FastAPI(title="Optical Rx Now API - Minimal")
+metrics_registry = Registry()
+loop_lag_monitor = LoopLagMonitor(metrics_registry)
+event_ingestor = EventIngestor(store, metrics_registry, EVENT_QUEUE_SIZE)
+
+
+def maintenance_running():
+    # Unset until startup, and None until the leader's jobs have been started
+    task = getattr(app.state, "maintenance", None)
+    return task is not None and not task.done()
+
+
+readiness_probe = ReadinessProbe({
+    "storage": store.ping,
+    "blob_store": lambda: blob_store.tmp_dir.is_dir(),
+    # Background jobs only run in the elected leader worker
+    "reminder_scheduler": lambda: not leader_election.is_leader or reminder_scheduler.running,
+    "maintenance": lambda: not leader_election.is_leader or maintenance_running(),
+}, READINESS_INTERVAL)
+api_router = APIRouter(prefix="/api")
+
+
+# Models
+def reject_null(value):
+    """Update fields backed by NOT NULL columns may be left out, but not set to null."""
+    if value is None:
+        raise ValueError("may be omitted but not null")
+    return value
+
+
+class FamilyMemberCreate(BaseModel):
+    name: str
+    relationship: str
+
+
+class FamilyMemberUpdate(BaseModel):
+    name: Optional[str] = None
+    relationship: Optional[str] = None
+
+    _not_null = field_validator("name", "relationship")(reject_null)
+
+
+class FamilyMember(FamilyMemberCreate):
+    id: str
+    created_at: str
+
+
+class PrescriptionCreate(BaseModel):
+    family_member_id: str
+    rx_type: Literal["eyeglass", "contact"]
+    image_base64: str = ""
+    notes: str = ""
+    date_taken: str = ""
+    expiry_date: Optional[str] = None
+
+
+class PrescriptionUpdate(BaseModel):
+    rx_type: Optional[Literal["eyeglass", "contact"]] = None
+    image_base64: Optional[str] = None
+    notes: Optional[str] = None
+    date_taken: Optional[str] = None
+    expiry_date: Optional[str] = None
+
+    _not_null = field_validator("rx_type", "notes", "date_taken")(reject_null)
+
+
+class Prescription(BaseModel):
+    id: str
+    family_member_id: str
+    rx_type: Literal["eyeglass", "contact"]
+    image_hash: Optional[str] = None
+    notes: str
+    date_taken: str
+    expiry_date: Optional[str] = None
+    created_at: str
+
+
+class PrescriptionUpload(Prescription):
+    # Other prescriptions whose photo looks like the one just uploaded
+    duplicates: List[str] = []
+
+
+class DuplicateCluster(BaseModel):
+    prescription_ids: List[str]
+    image_hashes: List[str]
+
+
+class SyncFamilyMember(FamilyMemberCreate):
+    id: str
+    created_at: Optional[str] = None
+
+
+class SyncPrescription(BaseModel):
+    id: str
+    family_member_id: str
+    rx_type: Literal["eyeglass", "contact"]
+    image_hash: Optional[str] = None
+    notes: str = ""
+    date_taken: str = ""
+    expiry_date: Optional[str] = None
+
+
+class SyncDeleted(BaseModel):
+    family_members: List[str] = Field(default_factory=list, max_length=SYNC_MAX_BATCH_SIZE)
+    prescriptions: List[str] = Field(default_factory=list, max_length=SYNC_MAX_BATCH_SIZE)
+
+
+class SyncPush(BaseModel):
+    cursor: int = Field(0, ge=0)
+    limit: int = Field(SYNC_BATCH_SIZE, gt=0, le=SYNC_MAX_BATCH_SIZE)
+    family_members: List[SyncFamilyMember] = Field(default_factory=list, max_length=SYNC_MAX_BATCH_SIZE)
+    prescriptions: List[SyncPrescription] = Field(default_factory=list, max_length=SYNC_MAX_BATCH_SIZE)
+    deleted: SyncDeleted = Field(default_factory=SyncDeleted)
+
+
+class SyncChanges(BaseModel):
+    family_members: List[FamilyMember]
+    prescriptions: List[Prescription]
+    deleted: SyncDeleted
+
+
+class SyncRejection(BaseModel):
+    entity: str
+    id: str
+    reason: str
+
+
+class SyncResponse(BaseModel):
+    changes: SyncChanges
+    cursor: int
+    has_more: bool
+    reset: bool
+    rejected: List[SyncRejection] = []
+
+
+class ImportFamilyMember(FamilyMemberCreate):
+    id: Optional[str] = None
+    created_at: Optional[str] = None
+
+
+class ImportPrescription(SyncPrescription):
+    id: Optional[str] = None
+    image_base64: str = ""
+    created_at: Optional[str] = None
+
+
+class ImportRowError(BaseModel):
+    line: Optional[int] = None
+    error: str
+
+
+class ImportCounts(BaseModel):
+    family_members: int
+    prescriptions: int
+
+
+class ImportResult(BaseModel):
+    imported: ImportCounts
+    completed: bool
+    error_count: int
+    errors: List[ImportRowError]
+
+
+class BatchPrescriptionCreate(BaseModel):
+    family_member_id: str
+    rx_type: Literal["eyeglass", "contact"]
+    image_hash: Optional[str] = None
+    notes: str = ""
+    date_taken: str = ""
+    expiry_date: Optional[str] = None
+
+
+class BatchPrescriptionUpdate(BaseModel):
+    family_member_id: Optional[str] = None
+    rx_type: Optional[Literal["eyeglass", "contact"]] = None
+    image_hash: Optional[str] = None
+    notes: Optional[str] = None
+    date_taken: Optional[str] = None
+    expiry_date: Optional[str] = None
+
+    _not_null = field_validator("family_member_id", "rx_type", "notes", "date_taken")(reject_null)
+
+
+class BatchOperation(BaseModel):
+    op: Literal["create", "update", "delete"]
+    entity: Literal["family_member", "prescription"]
+    # Target of update/delete: a real id, or "$<temp_id>" of an earlier create
+    id: Optional[str] = None
+    temp_id: Optional[str] = Field(None, min_length=1, max_length=64)
+    data: Dict[str, Any] = Field(default_factory=dict)
+
+
+class BatchRequest(BaseModel):
+    operations: List[BatchOperation] = Field(min_length=1, max_length=MAX_BATCH_OPERATIONS)
+
+
+class BatchOperationResult(BaseModel):
+    op: str
+    entity: str
+    id: str
+    record: Optional[Dict[str, Any]] = None
+    prescriptions_deleted: Optional[int] = None
+
+
+class BatchResult(BaseModel):
+    results: List[BatchOperationResult]
+    temp_ids: Dict[str, str]
+
+
+class RestoreUploadCreate(BaseModel):
+    size: int = Field(gt=0)
+    sha256: Optional[str] = Field(None, pattern=r"^[0-9a-f]{64}$")
+
+
+class RestoreUploadStatus(BaseModel):
+    upload_id: str
+    size: int
+    chunk_size: int
+    chunk_count: int
+    received: List[int]
+    missing: List[int]
+
+
+class RestoreResult(ImportResult):
+    images: int
+
+
+class NearbyProvider(BaseModel):
+    id: Optional[str] = None
+    name: Optional[str] = None
+    address: Optional[str] = None
+    city: Optional[str] = None
+    state: Optional[str] = None
+    postal_code: Optional[str] = None
+    phone: Optional[str] = None
+    website: Optional[str] = None
+    latitude: float
+    longitude: float
+    distance_km: float
+
+
+class AnalyticsEvent(BaseModel):
+    type: Literal[EVENT_TYPES]
+    occurred_at: Optional[datetime] = None
+    metadata: Dict[str, Any] = Field(default_factory=dict)
+
+
+class EventBatch(BaseModel):
+    device_id: str = Field(min_length=1, max_length=128)
+    events: List[AnalyticsEvent] = Field(min_length=1, max_length=MAX_EVENTS_PER_REQUEST)
+
+
+class EventRollup(BaseModel):
+    day: str
+    event_type: str
+    partner: str
+    count: int
+
+
+class Stats(BaseModel):
+    family_members: Optional[int] = None
+    total_prescriptions: int
+    eyeglass_prescriptions: int
+    contact_prescriptions: int
+    expiring_soon: int
+    expiring_within_days: int
+
+
+async def cached_list(request, scope, render, day=None):
+    """Serve a list response from the versioned cache.
+
+    `render` runs in the threadpool on a miss and returns the body and any
+    extra headers. The ETag is the collection's version (plus the day for
+    date-relative filters), so an unchanged poll is answered with 304 before
+    the cache is even consulted, and a cache hit skips the query and
+    serialization.
+    """
+    tag = f"{store.epoch}-{store.version(scope)}"
+    etag = f'"{tag}"' if day is None else f'"{tag}-{day}"'
+    headers = {"etag": etag, "cache-control": "no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    key = (request.url.path, request.url.query)
+    cached = list_cache.get(key, etag)
+    if cached is None:
+        cached = await run_in_threadpool(render)
+        list_cache.put(key, etag, *cached)
+    body, extra_headers = cached
+    return Response(body, media_type="application/json", headers={**headers, **extra_headers})
+
+
+def encode_cursor(row):
+    text = json.dumps([row["created_at"], row["id"]], separators=(",", ":"))
+    return base64.urlsafe_b64encode(text.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor):
+    """The (created_at, id) a page cursor points after."""
+    try:
+        after = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except ValueError:
+        after = None
+    if not (isinstance(after, list) and len(after) == 2 and all(isinstance(part, str) for part in after)):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return tuple(after)
+
+
+def parse_fields(fields):
+    names = list(dict.fromkeys(name.strip() for name in fields.split(",") if name.strip()))
+    unknown = [name for name in names if name not in LIST_COLUMNS]
+    if unknown or not names:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown fields: {', '.join(unknown)}" if unknown else "No fields requested",
+        )
+    return names
+
+
+def hash_image(image):
+    """Compute a staged image's perceptual hash so it is stored with the blob."""
+    image.phash = image_phash(image.temp_path)
+
+
+def find_duplicates(prescription, image):
+    """Return the other prescriptions whose image looks like a just-stored one."""
+    if image.phash is None:
+        matches = [image.hash]
+    else:
+        # Picks up this image and any stored by other workers
+        phash_index.sync(store.phashes_since)
+        matches = [blob_hash for blob_hash, _ in phash_index.search(image.phash, DUPLICATE_MAX_DISTANCE)]
+    return [
+        prescription_id for prescription_id in store.prescriptions_with_images(matches)
+        if prescription_id != prescription["id"]
+    ]
+
+
+def image_error(exc):
+    status_code = 413 if isinstance(exc, ImageTooLarge) else 400
+    return HTTPException(status_code=status_code, detail=str(exc))
+
+
+async def read_prescription_body(request):
+    """Parse a prescription JSON body into (fields, staged image or None).
+
+    The body is parsed incrementally so image_base64 is decoded straight to
+    disk instead of being held in memory as a string.
+    """
+    parser = PrescriptionStreamParser(blob_store, MAX_IMAGE_BYTES)
+    try:
+        async for chunk in request.stream():
+            await run_in_threadpool(parser.feed, chunk)
+        return parser.close()
+    except ValueError as exc:
+        parser.abort()
+        raise image_error(exc)
+    except BaseException:
+        parser.abort()
+        raise
+
 
 @app.get("/")
 async def health_check():
-    return {"status": "healthy", "service": "Optical Rx Now API", "mode": "frontend-only"}
+    return {"status": "healthy", "service": "Optical Rx Now API", "mode": "server-storage"}
 
-@app.get("/api/")
+@api_router.get("/")
 async def api_root():
-    return {"message": "Optical Rx Now API - Frontend Only Mode", "note": "All data is stored locally on device"}
+    return {
+        "message": "Optical Rx Now API",
+        "note": "Family members, prescriptions and their images are stored on the server and synced to devices",
+    }
 
-@app.get("/api/health")
+@api_router.get("/health")
 async def api_health():
     return {"status": "healthy", "service": "optical-rx-now", "version": "1.0.0"}
 
+
+# Family members
+@api_router.get("/family-members", response_model=List[FamilyMember])
+async def list_family_members(request: Request):
+    return await cached_list(
+        request, MEMBERS_VERSION, lambda: (orjson.dumps(store.list_family_members()), {})
+    )
+
+@api_router.post("/family-members", response_model=FamilyMember)
+def create_family_member(member: FamilyMemberCreate):
+    return store.create_family_member(member.name, member.relationship)
+
+@api_router.get("/family-members/{member_id}", response_model=FamilyMember)
+def get_family_member(member_id: str):
+    member = store.get_family_member(member_id)
+    if member is None:
+        raise HTTPException(status_code=404, detail="Family member not found")
+    return member
+
+@api_router.put("/family-members/{member_id}", response_model=FamilyMember)
+def update_family_member(member_id: str, update: FamilyMemberUpdate):
+    member = store.update_family_member(member_id, update.model_dump(exclude_unset=True))
+    if member is None:
+        raise HTTPException(status_code=404, detail="Family member not found")
+    return member
+
+@api_router.delete("/family-members/{member_id}")
+def delete_family_member(member_id: str):
+    deleted = store.delete_family_member(member_id)
+    if deleted is None:
+        raise HTTPException(status_code=404, detail="Family member not found")
+    return {"message": "Family member deleted", "prescriptions_deleted": deleted}
+
+
+# Prescriptions
+@api_router.get("/prescriptions", response_model=List[Prescription])
+async def list_prescriptions(
+    request: Request,
+    family_member_id: Optional[str] = None,
+    expired: Optional[bool] = None,
+    expiring_within_days: Optional[int] = Query(None, ge=0, le=3660),
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    fields: Optional[str] = Query(None, description="Comma-separated fields to return, e.g. id,rx_type,expiry_date"),
+):
+    """List prescriptions oldest first.
+
+    With `limit`, at most that many are returned and, if more follow, the
+    X-Next-Cursor header carries the `cursor` for the next page. Without it
+    the whole (filtered) collection is returned as before.
+    """
+    scope = PRESCRIPTIONS_VERSION if family_member_id is None else MEMBER_PRESCRIPTIONS + family_member_id
+    day = None if expired is None and expiring_within_days is None else today_day()
+    after = None if cursor is None else decode_cursor(cursor)
+    names = None if fields is None else parse_fields(fields)
+    # The cursor is built from the last row, so keep its keys in a projection
+    columns = None if names is None else list(dict.fromkeys([*names, "created_at", "id"]))
+
+    def render():
+        rows = store.list_prescriptions(
+            family_member_id, expired, expiring_within_days,
+            after=after, limit=None if limit is None else limit + 1, columns=columns,
+        )
+        extra_headers = {}
+        if limit is not None and len(rows) > limit:
+            del rows[limit:]
+            extra_headers["x-next-cursor"] = encode_cursor(rows[-1])
+        if names is not None:
+            rows = [{name: row[name] for name in names} for row in rows]
+        return orjson.dumps(rows), extra_headers
+
+    return await cached_list(request, scope, render, day=day)
+
+@api_router.get("/prescriptions/duplicates", response_model=List[DuplicateCluster])
+def list_duplicate_prescriptions(
+    family_member_id: Optional[str] = None,
+    max_distance: int = Query(DUPLICATE_MAX_DISTANCE, ge=0, le=32),
+):
+    """Groups of prescriptions whose photos are identical or look alike.
+
+    Photos are linked when their perceptual hashes differ in at most
+    `max_distance` bits; prescriptions are listed oldest first. Every photo
+    is compared with every other, so at most MAX_DUPLICATE_PHOTOS distinct
+    photos are accepted; filter by family member beyond that.
+    """
+    rows = store.prescription_phashes(family_member_id)
+    phashes = {}
+    for _, image_hash, phash in rows:
+        phashes.setdefault(image_hash, phash)
+    if len(phashes) > MAX_DUPLICATE_PHOTOS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Too many photos to compare ({len(phashes)}, at most {MAX_DUPLICATE_PHOTOS})"
+            + ("; filter by family_member_id" if family_member_id is None else ""),
+        )
+    image_hashes = list(phashes)
+    group_of = {}
+    for group, positions in enumerate(cluster(list(phashes.values()), max_distance)):
+        for position in positions:
+            group_of[image_hashes[position]] = group
+    clusters = {}
+    for prescription_id, image_hash, _ in rows:
+        found = clusters.setdefault(group_of[image_hash], {"prescription_ids": [], "image_hashes": []})
+        found["prescription_ids"].append(prescription_id)
+        if image_hash not in found["image_hashes"]:
+            found["image_hashes"].append(image_hash)
+    return [found for found in clusters.values() if len(found["prescription_ids"]) > 1]
+
+@api_router.post(
+    "/prescriptions",
+    response_model=PrescriptionUpload,
+    openapi_extra={"requestBody": {
+        "content": {"application/json": {"schema": PrescriptionCreate.model_json_schema()}},
+        "required": True,
+    }},
+)
+async def create_prescription(request: Request):
+    fields, image = await read_prescription_body(request)
+    try:
+        prescription = PrescriptionCreate.model_validate(fields)
+        if image is not None:
+            await run_in_threadpool(hash_image, image)
+        created = await run_in_threadpool(
+            store.create_prescription, prescription.model_dump(exclude={"image_base64"}), image
+        )
+    except ValidationError as exc:
+        raise RequestValidationError(exc.errors())
+    finally:
+        if image is not None:
+            image.discard()
+    if created is None:
+        raise HTTPException(status_code=404, detail="Family member not found")
+    if image is not None:
+        created["duplicates"] = await run_in_threadpool(find_duplicates, created, image)
+    return created
+
+@api_router.get("/prescriptions/{prescription_id}", response_model=Prescription)
+def get_prescription(prescription_id: str):
+    prescription = store.get_prescription(prescription_id)
+    if prescription is None:
+        raise HTTPException(status_code=404, detail="Prescription not found")
+    return prescription
+
+@api_router.put(
+    "/prescriptions/{prescription_id}",
+    response_model=PrescriptionUpload,
+    openapi_extra={"requestBody": {
+        "content": {"application/json": {"schema": PrescriptionUpdate.model_json_schema()}},
+        "required": True,
+    }},
+)
+async def update_prescription(prescription_id: str, request: Request):
+    fields, image = await read_prescription_body(request)
+    try:
+        update = PrescriptionUpdate.model_validate(fields)
+        changes = update.model_dump(exclude_unset=True, exclude={"image_base64"})
+        if image is not None:
+            await run_in_threadpool(hash_image, image)
+        prescription = await run_in_threadpool(store.update_prescription, prescription_id, changes, image)
+    except ValidationError as exc:
+        raise RequestValidationError(exc.errors())
+    finally:
+        if image is not None:
+            image.discard()
+    if prescription is None:
+        raise HTTPException(status_code=404, detail="Prescription not found")
+    if image is not None:
+        prescription["duplicates"] = await run_in_threadpool(find_duplicates, prescription, image)
+    return prescription
+
+@api_router.delete("/prescriptions/{prescription_id}")
+def delete_prescription(prescription_id: str):
+    if not store.delete_prescription(prescription_id):
+        raise HTTPException(status_code=404, detail="Prescription not found")
+    return {"message": "Prescription deleted"}
+
+
+async def receive_raw_image(request):
+    """Stream a raw image request body into a staged blob."""
+    content_type = request.headers.get("content-type", DEFAULT_CONTENT_TYPE).split(";")[0].strip().lower()
+    if content_type not in IMAGE_CONTENT_TYPES:
+        raise HTTPException(
+            status_code=415, detail=f"Expected one of {', '.join(sorted(IMAGE_CONTENT_TYPES))}"
+        )
+    writer = blob_store.writer(content_type)
+    try:
+        async for chunk in request.stream():
+            if writer.size + len(chunk) > MAX_IMAGE_BYTES:
+                raise ImageTooLarge(f"Image exceeds {MAX_IMAGE_BYTES} bytes")
+            await run_in_threadpool(writer.write, chunk)
+        if not writer.size:
+            raise ValueError("Image data is empty")
+    except ValueError as exc:
+        writer.abort()
+        raise image_error(exc)
+    except BaseException:
+        writer.abort()
+        raise
+    return writer.finish()
+
+
+@api_router.put("/prescriptions/{prescription_id}/image", response_model=PrescriptionUpload)
+async def upload_prescription_image(prescription_id: str, request: Request):
+    """Replace a prescription's image with the raw binary request body."""
+    with await receive_raw_image(request) as image:
+        await run_in_threadpool(hash_image, image)
+        prescription = await run_in_threadpool(store.update_prescription, prescription_id, {}, image)
+    if prescription is None:
+        raise HTTPException(status_code=404, detail="Prescription not found")
+    prescription["duplicates"] = await run_in_threadpool(find_duplicates, prescription, image)
+    return prescription
+
+
+# Image blobs
+@api_router.post("/blobs")
+async def upload_blob(request: Request):
+    """Upload a raw image ahead of referencing it from a synced prescription."""
+    with await receive_raw_image(request) as image:
+        await run_in_threadpool(hash_image, image)
+        await run_in_threadpool(store.add_blob, image)
+    return {"hash": image.hash, "size": image.size, "content_type": image.content_type}
+
+@api_router.get("/blobs/{blob_hash}")
+def get_blob(blob_hash: str, request: Request):
+    blob = store.get_blob(blob_hash) if HASH_RE.match(blob_hash) else None
+    if blob is None:
+        raise HTTPException(status_code=404, detail="Blob not found")
+    return BlobResponse(blob_store.path(blob_hash), blob_hash, blob["content_type"], request.headers)
+
+@api_router.get("/blobs/{blob_hash}/variant")
+async def get_blob_variant(blob_hash: str, request: Request, width: int = Query(..., gt=0)):
+    """Serve the smallest rendered variant at least `width` pixels wide."""
+    blob = await run_in_threadpool(store.get_blob, blob_hash) if HASH_RE.match(blob_hash) else None
+    if blob is None:
+        raise HTTPException(status_code=404, detail="Blob not found")
+    variant_width = pick_width(width)
+    if variant_width is None:
+        return BlobResponse(blob_store.path(blob_hash), blob_hash, blob["content_type"], request.headers)
+    headers = {
+        "etag": f'"{blob_hash}-w{variant_width}"',
+        "cache-control": "public, max-age=31536000, immutable",
+    }
+    if etag_matches(request.headers.get("if-none-match"), headers["etag"]):
+        return Response(status_code=304, headers=headers)
+    try:
+        data = await variant_cache.get(blob_hash, variant_width, blob_store.path(blob_hash))
+    except VariantError as exc:
+        logger.warning("Could not render variant of blob %s: %s", blob_hash, exc)
+        raise HTTPException(status_code=422, detail="Blob is not a decodable image")
+    return Response(content=data, media_type=VARIANT_CONTENT_TYPE, headers=headers)
+
+
+# Stats
+@api_router.get("/stats", response_model=Stats, response_model_exclude_none=True)
+def get_stats(
+    family_member_id: Optional[str] = None,
+    expiring_within_days: int = Query(EXPIRING_SOON_DAYS, ge=0, le=3660),
+):
+    """Counts for all data, or one family member's breakdown."""
+    if family_member_id is not None and store.get_family_member(family_member_id) is None:
+        raise HTTPException(status_code=404, detail="Family member not found")
+    stats = store.get_stats(expiring_within_days, family_member_id)
+    return {**stats, "expiring_within_days": expiring_within_days}
+
+
+# Optometrist search
+@api_router.get("/optometrists/near", response_model=List[NearbyProvider])
+async def nearby_optometrists(
+    lat: float = Query(..., ge=-90, le=90),
+    lon: float = Query(..., ge=-180, le=180),
+    radius_km: float = Query(25, gt=0, le=MAX_PROVIDER_RADIUS_KM),
+    limit: int = Query(20, ge=1, le=MAX_PROVIDER_RESULTS),
+):
+    """Providers within `radius_km` of the point, nearest first.
+
+    Answered on the event loop: a search is a few index lookups and one
+    vectorized distance pass, cheaper than a hop to the threadpool.
+    """
+    providers = app.state.providers
+    if providers is None:
+        raise HTTPException(status_code=503, detail="Optometrist directory is not loaded")
+    return ORJSONResponse(providers.search(lat, lon, radius_km, limit))
+
+
+def load_providers():
+    if not PROVIDERS_PATH.exists():
+        logger.info("No optometrist directory at %s; nearby search is disabled", PROVIDERS_PATH)
+        return None
+    # Imported here so NumPy stays out of start-up when there is no directory
+    from providers import ProviderIndex
+
+    providers = ProviderIndex.load(PROVIDERS_PATH)
+    logger.info("Loaded %d optometrists from %s", len(providers), PROVIDERS_PATH)
+    return providers
+
+
+# Analytics events
+@api_router.post("/events", status_code=202)
+async def ingest_events(batch: EventBatch):
+    """Queue a device's events for the background writer.
+
+    Returns as soon as the events are queued; they reach the rollups within
+    about a second. A full queue answers 503 so the client retries later.
+    """
+    received_at = datetime.now(timezone.utc)
+    rows = [
+        event_row(batch.device_id, event.type, event.metadata, event.occurred_at, received_at)
+        for event in batch.events
+    ]
+    try:
+        event_ingestor.submit(rows)
+    except EventQueueFull:
+        raise HTTPException(
+            status_code=503, detail="Event queue is full", headers={"Retry-After": "5"}
+        )
+    return {"accepted": len(rows)}
+
+@api_router.get("/events/rollups", response_model=List[EventRollup])
+def get_event_rollups(
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    event_type: Optional[Literal[EVENT_TYPES]] = None,
+):
+    """Daily event counts per partner between two dates (inclusive)."""
+    first_day, last_day = (None if value is None else parse_day(value) for value in (since, until))
+    if (since is not None and first_day is None) or (until is not None and last_day is None):
+        raise HTTPException(status_code=400, detail="Dates must be YYYY-MM-DD or MM/DD/YYYY")
+    return store.event_rollups(first_day, last_day, event_type)
+
+
+# Delta sync
+# Change batches are encoded straight from store records by orjson; the
+# response_model documents the shape without validating every item again.
+@api_router.get("/sync", response_model=SyncResponse)
+def pull_changes(
+    cursor: int = Query(0, ge=0),
+    limit: int = Query(SYNC_BATCH_SIZE, gt=0, le=SYNC_MAX_BATCH_SIZE),
+):
+    """Return changes since `cursor`; repeat with the returned cursor while has_more.
+
+    Cursors are opaque: only 0 or a value returned by this API is meaningful.
+    """
+    return ORJSONResponse({**store.pull_changes(cursor, limit), "rejected": []})
+
+@api_router.post("/sync", response_model=SyncResponse)
+def push_and_pull_changes(push: SyncPush):
+    """Apply a client's batched changes, then return changes since its cursor."""
+    rejected = store.apply_changes(
+        [member.model_dump(exclude_none=True) for member in push.family_members],
+        [prescription.model_dump() for prescription in push.prescriptions],
+        push.deleted.family_members,
+        push.deleted.prescriptions,
+    )
+    return ORJSONResponse({**store.pull_changes(push.cursor, push.limit), "rejected": rejected})
+
+
+# Bulk import / export
+def validate_import_record(entity, record):
+    model = ImportFamilyMember if entity == MEMBER else ImportPrescription
+    return model.model_validate(record).model_dump(exclude_none=True)
+
+
+def iterate_from_thread(stream):
+    """Pull items from an async iterator inside a worker thread."""
+    async def next_item():
+        try:
+            return await stream.__anext__()
+        except StopAsyncIteration:
+            return None
+
+    while True:
+        item = anyio.from_thread.run(next_item)
+        if item is None:
+            return
+        yield item
+
+
+@api_router.get("/export")
+def export_data(
+    format: Literal["ndjson", "csv"] = "ndjson",
+    family_member_id: Optional[str] = None,
+    include_images: bool = False,
+):
+    """Stream all records (or one member's) as NDJSON or CSV."""
+    if family_member_id is not None and store.get_family_member(family_member_id) is None:
+        raise HTTPException(status_code=404, detail="Family member not found")
+    return StreamingResponse(
+        export_chunks(store, blob_store, format, family_member_id, include_images),
+        media_type=MEDIA_TYPES[format],
+        headers={"content-disposition": f'attachment; filename="optical-rx-export.{format}"'},
+    )
+
+@api_router.post(
+    "/import",
+    response_model=ImportResult,
+    openapi_extra={"requestBody": {
+        "content": {media_type: {"schema": {"type": "string"}} for media_type in MEDIA_TYPES.values()},
+        "required": True,
+    }},
+)
+async def import_data(request: Request, format: Optional[Literal["ndjson", "csv"]] = None):
+    """Upsert records from an NDJSON or CSV body in batched transactions.
+
+    The format defaults from the Content-Type. Rows that fail validation are
+    reported by line number and skipped.
+    """
+    fmt = format or format_for(request.headers.get("content-type", ""))
+    importer = Importer(store, blob_store, validate_import_record, MAX_IMAGE_BYTES, MAX_IMPORT_LINE_BYTES)
+    return await run_in_threadpool(importer.run, iterate_from_thread(request.stream().__aiter__()), fmt)
+
+
+# Batch mutations
+BATCH_DATA_MODELS = {
+    ("create", MEMBER): FamilyMemberCreate,
+    ("update", MEMBER): FamilyMemberUpdate,
+    ("create", PRESCRIPTION): BatchPrescriptionCreate,
+    ("update", PRESCRIPTION): BatchPrescriptionUpdate,
+}
+
+def validate_batch_operation(index, operation, temp_ids):
+    """The operation as a plain dict with its data validated for its op and entity."""
+    def fail(reason):
+        raise HTTPException(status_code=422, detail={"index": index, "error": reason})
+
+    if operation.op == "create":
+        if operation.id is not None:
+            fail("create takes a temp_id, not an id")
+        if operation.temp_id is not None:
+            if operation.temp_id in temp_ids:
+                fail(f"Duplicate temp_id {operation.temp_id}")
+            temp_ids.add(operation.temp_id)
+    elif operation.id is None:
+        fail(f"{operation.op} requires an id")
+    data = {}
+    model = BATCH_DATA_MODELS.get((operation.op, operation.entity))
+    if model is not None:
+        try:
+            data = model.model_validate(operation.data).model_dump(exclude_unset=operation.op == "update")
+        except ValidationError as exc:
+            fail("; ".join(
+                f"{'.'.join(str(part) for part in error['loc'])}: {error['msg']}" for error in exc.errors()
+            ))
+    return {"op": operation.op, "entity": operation.entity, "id": operation.id,
+            "temp_id": operation.temp_id, "data": data}
+
+@api_router.post("/batch", response_model=BatchResult)
+def apply_batch(batch: BatchRequest):
+    """Apply create, update and delete operations in one transaction.
+
+    A create may name a `temp_id`; later operations refer to that record as
+    "$<temp_id>" in `id` or `data.family_member_id`. Either every operation
+    is applied and one result per operation is returned, or none is and the
+    error names the failing operation's index.
+    """
+    temp_ids = set()
+    operations = [
+        validate_batch_operation(index, operation, temp_ids) for index, operation in enumerate(batch.operations)
+    ]
+    try:
+        results, created = store.apply_batch(operations)
+    except BatchFailed as exc:
+        raise HTTPException(status_code=409, detail={"index": exc.index, "error": exc.reason})
+    return {"results": results, "temp_ids": created}
+
+
+# Backup / restore
+@api_router.get("/backup")
+def download_backup():
+    """Stream a tar archive of all records and their images, each image once."""
+    filename = f"optical-rx-backup-{datetime.now(timezone.utc):%Y%m%d-%H%M%S}.tar"
+    return StreamingResponse(
+        backup_chunks(store, blob_store, restore_uploads.root),
+        media_type=BACKUP_MEDIA_TYPE,
+        headers={"content-disposition": f'attachment; filename="{filename}"'},
+    )
+
+def get_restore_upload(upload_id):
+    state = restore_uploads.get(upload_id)
+    if state is None:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    return state
+
+@api_router.post("/restore/uploads", response_model=RestoreUploadStatus, status_code=201)
+def create_restore_upload(upload: RestoreUploadCreate):
+    """Start a resumable upload of a backup archive.
+
+    Send the archive as PUT .../chunks/{index} requests of `chunk_size`
+    bytes (the last may be shorter), each with its hex SHA-256 in
+    X-Chunk-SHA256, in any order. After an interruption, GET the upload to
+    see which chunks are missing, then POST .../complete to restore.
+    """
+    try:
+        return restore_uploads.create(upload.size, upload.sha256)
+    except BackupError as exc:
+        raise HTTPException(status_code=413, detail=str(exc))
+
+@api_router.get("/restore/uploads/{upload_id}", response_model=RestoreUploadStatus)
+def get_restore_upload_status(upload_id: str):
+    return restore_uploads.status(get_restore_upload(upload_id))
+
+@api_router.put("/restore/uploads/{upload_id}/chunks/{index}", response_model=RestoreUploadStatus)
+async def upload_restore_chunk(upload_id: str, index: int, request: Request):
+    """Write one chunk of the archive; it only counts once its checksum matches."""
+    sha256 = request.headers.get("x-chunk-sha256", "").strip().lower()
+    if not HASH_RE.match(sha256):
+        raise HTTPException(status_code=400, detail="X-Chunk-SHA256 header must be a hex SHA-256")
+    state = await run_in_threadpool(get_restore_upload, upload_id)
+    if restore_uploads.has_chunk(state, index, sha256):
+        return restore_uploads.status(state)
+    try:
+        writer = await run_in_threadpool(restore_uploads.chunk_writer, state, index, sha256)
+    except BackupError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    try:
+        async for data in request.stream():
+            await run_in_threadpool(writer.write, data)
+        return await run_in_threadpool(writer.finish)
+    except BackupError as exc:
+        writer.abort()
+        raise HTTPException(status_code=400, detail=str(exc))
+    except BaseException:
+        writer.abort()
+        raise
+
+@api_router.post("/restore/uploads/{upload_id}/complete", response_model=RestoreResult)
+def complete_restore_upload(upload_id: str):
+    """Restore a fully uploaded archive, merging its records into existing data by id."""
+    try:
+        path = restore_uploads.complete(upload_id)
+    except BackupError as exc:
+        raise HTTPException(status_code=409, detail=str(exc))
+    if path is None:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    importer = Importer(store, blob_store, validate_import_record, MAX_IMAGE_BYTES, MAX_IMPORT_LINE_BYTES)
+    try:
+        return restore_archive(path, store, blob_store, importer, MAX_IMAGE_BYTES)
+    except BackupError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    finally:
+        restore_uploads.delete(upload_id)
+
+@api_router.delete("/restore/uploads/{upload_id}")
+def cancel_restore_upload(upload_id: str):
+    if not restore_uploads.delete(upload_id):
+        raise HTTPException(status_code=404, detail="Upload not found")
+    return {"message": "Upload cancelled"}
+
+
+app.include_router(api_router)
+
+# Admission control runs inside CORS so refusals still carry CORS headers
+app.add_middleware(
+    AdmissionMiddleware,
+    registry=metrics_registry,
+    rate=RATE_LIMIT_PER_SECOND,
+    burst=RATE_LIMIT_BURST,
+    max_keys=RATE_LIMIT_MAX_CLIENTS,
+    max_concurrent=MAX_CONCURRENT_REQUESTS,
+    max_queued=ADMISSION_QUEUE_SIZE,
+    queue_timeout=ADMISSION_QUEUE_TIMEOUT,
+    # Probes and scrapes must keep answering while the API sheds load
+    exempt_paths=("/healthz", "/readyz", "/metrics"),
+)
+
+# CORS middleware
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+    expose_headers=["ETag", "X-Next-Cursor", "Retry-After"],
+)
+app.add_middleware(MetricsMiddleware, registry=metrics_registry)
+if PROFILING_ENABLED:
+    app.add_middleware(
+        ProfilingMiddleware,
+        sampler=profile_sampler,
+        store=profile_store,
+        registry=metrics_registry,
+        secret=PROFILE_SECRET,
+        sample_rate=PROFILE_SAMPLE_RATE,
+        slow_seconds=PROFILE_SLOW_MS / 1000,
+    )
+
 # Kubernetes standard health endpoints
 @app.get("/healthz")
 async def healthz():
@@ -32,6 +1086,121 @@ async def healthz():
 
 @app.get("/readyz")
 async def readyz():
-    """Kubernetes readiness probe endpoint"""
-    return {"status": "ok"}
+    """Kubernetes readiness probe endpoint, served from the last background check"""
+    return JSONResponse(readiness_probe.status, status_code=200 if readiness_probe.ready else 503)
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus scrape endpoint"""
+    return Response(metrics_registry.render(), media_type=METRICS_CONTENT_TYPE)
+
+def check_profile_access(request):
+    if not PROFILING_ENABLED:
+        raise HTTPException(status_code=404, detail="Profiling is not enabled")
+    if not PROFILE_SECRET:
+        raise HTTPException(status_code=404, detail="Profiles are not served without PROFILE_SECRET")
+    if not verify_token(PROFILE_SECRET, request.headers.get("x-profile", "")):
+        raise HTTPException(status_code=403, detail="A valid X-Profile header is required")
+
+@app.get(PROFILES_PATH)
+def list_profiles(request: Request):
+    """Captured request profiles, newest first"""
+    check_profile_access(request)
+    return profile_store.list()
+
+@app.get(PROFILES_PATH + "/{profile_id}")
+def get_profile(profile_id: int, request: Request):
+    """One request profile as collapsed stacks, ready for flamegraph.pl or speedscope"""
+    check_profile_access(request)
+    profile = profile_store.get(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return Response("\n".join(profile["stacks"]) + "\n", media_type=PROFILE_CONTENT_TYPE)
+
+def delete_blob_files(blob_hash):
+    blob_store.delete(blob_hash)
+    variant_cache.delete_files(blob_hash)
+    phash_index.remove(blob_hash)
+
+def backfill_phashes():
+    """Hash blobs stored without a perceptual hash: imports, restores and older data."""
+    checked = 0
+    while True:
+        blob_hashes = store.blobs_without_phash(PHASH_BACKFILL_BATCH)
+        if not blob_hashes:
+            return checked
+        store.set_phashes([(blob_hash, image_phash(blob_store.path(blob_hash))) for blob_hash in blob_hashes])
+        checked += len(blob_hashes)
+
+async def run_maintenance_periodically():
+    while True:
+        now = datetime.now(timezone.utc)
+        try:
+            removed = await run_in_threadpool(
+                store.collect_blobs, (now - BLOB_GC_GRACE).isoformat(), delete_blob_files
+            )
+            if removed:
+                logger.info("Removed %d unreferenced image blobs", removed)
+            pruned = await run_in_threadpool(
+                store.prune_tombstones, (now - SYNC_TOMBSTONE_RETENTION).isoformat()
+            )
+            if pruned:
+                logger.info("Pruned %d sync tombstones", pruned)
+            expired = await run_in_threadpool(restore_uploads.prune)
+            if expired:
+                logger.info("Removed %d abandoned restore uploads", expired)
+            pruned = await run_in_threadpool(store.prune_events, today_day() - EVENT_RETENTION_DAYS)
+            if pruned:
+                logger.info("Pruned %d analytics events", pruned)
+            hashed = await run_in_threadpool(backfill_phashes)
+            if hashed:
+                logger.info("Computed perceptual hashes of %d image blobs", hashed)
+        except Exception:
+            logger.exception("Storage maintenance failed")
+        await asyncio.sleep(BLOB_GC_INTERVAL)
+
+async def load_indexes():
+    """Build the in-memory search indexes without holding up readiness."""
+    try:
+        app.state.providers = await run_in_threadpool(load_providers)
+        await run_in_threadpool(phash_index.sync, store.phashes_since)
+    except Exception:
+        logger.exception("Loading search indexes failed")
+
+async def start_leader_jobs():
+    """Start the background jobs that must run in exactly one worker."""
+    app.state.maintenance = asyncio.create_task(run_maintenance_periodically())
+    reminder_scheduler.start()
+
+leader_election = LeaderElection(DATA_DIR / 'leader.lock', start_leader_jobs, metrics_registry)
+
+@app.on_event("startup")
+async def open_storage():
+    store.open()
+    blob_store.open()
+    restore_uploads.open()
+    if PROFILING_ENABLED:
+        profile_store.open()
+        profile_sampler.start()
+    app.state.maintenance = None
+    app.state.providers = None
+    app.state.index_loader = asyncio.create_task(load_indexes())
+    event_ingestor.start()
+    loop_lag_monitor.start()
+    await leader_election.start()
+    await readiness_probe.start()
 
+@app.on_event("shutdown")
+async def close_storage():
+    await readiness_probe.stop()
+    await loop_lag_monitor.stop()
+    await event_ingestor.stop()
+    profile_sampler.stop()
+    app.state.index_loader.cancel()
+    if app.state.maintenance is not None:
+        app.state.maintenance.cancel()
+    await reminder_scheduler.stop()
+    # Released only once its jobs have stopped, so the next leader never overlaps them
+    await leader_election.stop()
+    variant_cache.close()
+    store.close()
@@ -0,0 +1,1390 @@
+"""
+SQLite-backed storage for family members and prescriptions.
+
+The database runs in WAL mode so readers never block the single writer, and
+prescriptions are indexed on (created_at, id), overall and per member, so
+listing pages by keyset and cascade delete touch only the rows they need. Image blobs are
+reference counted here; the bytes themselves live in blobs.BlobStore. Every
+mutation is recorded in change_log, which drives cursor-based delta sync,
+and updates the counters behind get_stats so stats never scan the tables.
+Committed writes also bump collection versions, which let list responses be
+cached and revalidated. Versions are kept in the database so every worker
+process sees them; each connection remembers the ones it has looked up until
+PRAGMA data_version shows another connection has committed.
+Expiry reminders are rescheduled in the same transaction as the change.
+Dates are parsed once on write into day-number columns (see dates.py), so
+expiry filters are index range scans. Analytics events are appended in
+batches together with their daily rollups.
+"""
+
+import sqlite3
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+
+from dates import NO_DAY, day_to_iso, parse_day, parse_days, today_day
+from records import FamilyMemberRecord, PrescriptionRecord, fetch_records
+from reminders import reminder_times
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS blobs (
+    hash TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    content_type TEXT NOT NULL,
+    refcount INTEGER NOT NULL,
+    released_at TEXT
+);
+
+-- Perceptual hash of each image blob; NULL when it could not be decoded.
+-- seq only grows, so workers can pick up hashes stored since they last looked.
+CREATE TABLE IF NOT EXISTS blob_phashes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    hash TEXT NOT NULL UNIQUE REFERENCES blobs(hash) ON DELETE CASCADE,
+    phash INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS family_members (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    relationship TEXT NOT NULL,
+    created_at TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS prescriptions (
+    id TEXT PRIMARY KEY,
+    family_member_id TEXT NOT NULL REFERENCES family_members(id),
+    rx_type TEXT NOT NULL,
+    image_hash TEXT REFERENCES blobs(hash),
+    notes TEXT NOT NULL DEFAULT '',
+    date_taken TEXT NOT NULL DEFAULT '',
+    expiry_date TEXT,
+    created_at TEXT NOT NULL,
+    date_taken_day INTEGER,
+    expiry_day INTEGER
+);
+
+-- Listing pages by (created_at, id), overall and per member; the member
+-- index also serves cascade delete.
+CREATE INDEX IF NOT EXISTS idx_prescriptions_created
+    ON prescriptions(created_at, id);
+
+CREATE INDEX IF NOT EXISTS idx_prescriptions_member_created
+    ON prescriptions(family_member_id, created_at, id);
+
+-- Finding the prescriptions that show a near-duplicate image
+CREATE INDEX IF NOT EXISTS idx_prescriptions_image
+    ON prescriptions(image_hash) WHERE image_hash IS NOT NULL;
+
+CREATE INDEX IF NOT EXISTS idx_blobs_released
+    ON blobs(released_at) WHERE refcount <= 0;
+
+-- One row per entity holding its latest change; re-logging an entity moves
+-- it to a fresh seq, so the log never grows beyond the number of entities.
+CREATE TABLE IF NOT EXISTS change_log (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    entity TEXT NOT NULL,
+    entity_id TEXT NOT NULL,
+    deleted INTEGER NOT NULL,
+    changed_at TEXT NOT NULL
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_change_log_entity
+    ON change_log(entity, entity_id);
+
+CREATE INDEX IF NOT EXISTS idx_change_log_tombstones
+    ON change_log(changed_at) WHERE deleted = 1;
+
+CREATE TABLE IF NOT EXISTS sync_meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+
+-- Latest version of each cached collection scope, shared by all workers
+CREATE TABLE IF NOT EXISTS cache_versions (
+    scope TEXT PRIMARY KEY,
+    version INTEGER NOT NULL
+) WITHOUT ROWID;
+
+-- Counters maintained in the same transaction as each mutation. scope is ''
+-- for totals or a family member id for that member's breakdown.
+CREATE TABLE IF NOT EXISTS counters (
+    scope TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value INTEGER NOT NULL,
+    PRIMARY KEY (scope, key)
+) WITHOUT ROWID;
+
+-- Pending expiry reminders; idx_reminders_due is the scheduler's queue
+CREATE TABLE IF NOT EXISTS reminders (
+    id INTEGER PRIMARY KEY,
+    prescription_id TEXT NOT NULL,
+    days_before INTEGER NOT NULL,
+    due_at INTEGER NOT NULL,
+    UNIQUE (prescription_id, days_before)
+);
+
+CREATE INDEX IF NOT EXISTS idx_reminders_due ON reminders(due_at);
+
+CREATE TABLE IF NOT EXISTS expiry_counts (
+    scope TEXT NOT NULL,
+    day INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (scope, day)
+) WITHOUT ROWID;
+
+-- Analytics events appended in batches by events.EventIngestor. partner is
+-- the affiliate or ad the event is attributed to, '' when there is none.
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY,
+    device_id TEXT NOT NULL,
+    event_type TEXT NOT NULL,
+    partner TEXT NOT NULL,
+    day INTEGER NOT NULL,
+    occurred_at TEXT NOT NULL,
+    metadata TEXT
+);
+
+CREATE INDEX IF NOT EXISTS idx_events_day ON events(day);
+
+-- Event counts per day, type and partner, updated with each batch so
+-- reports never scan the events table.
+CREATE TABLE IF NOT EXISTS event_rollups (
+    day INTEGER NOT NULL,
+    event_type TEXT NOT NULL,
+    partner TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (day, event_type, partner)
+) WITHOUT ROWID;
+"""
+
+FAMILY_MEMBER_FIELDS = ("name", "relationship")
+PRESCRIPTION_FIELDS = (
+    "family_member_id",
+    "rx_type",
+    "image_hash",
+    "notes",
+    "date_taken",
+    "expiry_date",
+)
+# Prescription columns a listing may be projected onto
+LIST_COLUMNS = ("id", *PRESCRIPTION_FIELDS, "created_at")
+RECORD_TYPES = {"family_members": FamilyMemberRecord, "prescriptions": PrescriptionRecord}
+
+
+MEMBER = "family_member"
+PRESCRIPTION = "prescription"
+
+TOTALS = ""
+
+# Version scopes: the member list, all prescriptions, and each member's
+# prescriptions (MEMBER_PRESCRIPTIONS + member id)
+MEMBERS_VERSION = "family_members"
+PRESCRIPTIONS_VERSION = "prescriptions"
+MEMBER_PRESCRIPTIONS = "prescriptions:"
+
+# Sync cursors carry the tombstone prune generation above the change_log seq,
+# so a cursor handed out after a prune is never mistaken for a stale one
+CURSOR_SEQ_BITS = 36
+
+# Columns derived from the text dates, added to databases created before them
+DAY_COLUMNS = {"date_taken_day": "date_taken", "expiry_day": "expiry_date"}
+
+
+class PendingWrites:
+    """Counter and reminder writes collected to be applied in one go.
+
+    Counter and expiry deltas are summed per (scope, key) and (scope, day)
+    as they are collected.
+    """
+
+    def __init__(self):
+        self.counters = Counter()
+        self.expiry = Counter()
+        self.reminders = {}
+
+    def merge(self, other):
+        self.counters.update(other.counters)
+        self.expiry.update(other.expiry)
+        self.reminders.update(other.reminders)
+
+    def drop_scope(self, scope):
+        for deltas in (self.counters, self.expiry):
+            for key in [key for key in deltas if key[0] == scope]:
+                del deltas[key]
+
+    @staticmethod
+    def totals(deltas):
+        """(scope, key, delta) rows for the non-zero sums."""
+        return [(scope, key, delta) for (scope, key), delta in deltas.items() if delta]
+
+
+class SyncRejected(Exception):
+    """A pushed change that cannot be applied; the rest of the batch still is."""
+
+
+class BatchFailed(Exception):
+    """An operation in a batch could not be applied, so none of them were."""
+
+    def __init__(self, index, reason):
+        super().__init__(reason)
+        self.index = index
+        self.reason = reason
+
+
+def generate_id():
+    return str(uuid.uuid4())
+
+
+def utc_now():
+    return datetime.now(timezone.utc).isoformat()
+
+
+class Store:
+    """Thread-safe handle on the database; each thread gets its own connection."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        self.is_open = False
+        # Identifies this database in ETags, so a replaced database cannot
+        # match ETags handed out for the old one
+        self.epoch = None
+        # Called with the earliest due time (epoch seconds) after each commit
+        # that scheduled reminders, so a scheduler can wake up for it
+        self.on_reminders_scheduled = None
+
+    def open(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        conn = self.connection()
+        conn.executescript(SCHEMA)
+        self._migrate(conn)
+        if conn.execute("SELECT 1 FROM sync_meta WHERE key = 'counters_built'").fetchone() is None:
+            self.rebuild_counters()
+        if conn.execute("SELECT 1 FROM sync_meta WHERE key = 'reminders_built'").fetchone() is None:
+            self.rebuild_reminders()
+        conn.execute(
+            "INSERT OR IGNORE INTO sync_meta (key, value) VALUES ('cache_epoch', ?)",
+            (uuid.uuid4().int & 0xFFFFFFFF,),
+        )
+        epoch = conn.execute("SELECT value FROM sync_meta WHERE key = 'cache_epoch'").fetchone()[0]
+        self.epoch = f"{epoch:08x}"
+        self.is_open = True
+
+    def _migrate(self, conn):
+        columns = {row["name"] for row in conn.execute("PRAGMA table_info(prescriptions)")}
+        missing = [column for column in DAY_COLUMNS if column not in columns]
+        if missing:
+            with self.transaction() as conn:
+                for column in missing:
+                    conn.execute(f"ALTER TABLE prescriptions ADD COLUMN {column} INTEGER")
+                self._backfill_days(conn, missing)
+                # Counters and reminders were keyed on the old text parsing
+                conn.execute(
+                    "DELETE FROM sync_meta WHERE key IN ('counters_built', 'reminders_built')"
+                )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_prescriptions_expiry "
+            "ON prescriptions(expiry_day) WHERE expiry_day IS NOT NULL"
+        )
+        # Superseded by idx_prescriptions_member_created
+        conn.execute("DROP INDEX IF EXISTS idx_prescriptions_family_member")
+        if conn.execute("SELECT 1 FROM sync_meta WHERE key = 'orphan_reminders_purged'").fetchone() is None:
+            # Left behind by batches that created and then deleted a
+            # prescription, before those deletes cancelled queued reminders
+            with self.transaction() as conn:
+                conn.execute(
+                    "DELETE FROM reminders WHERE prescription_id NOT IN (SELECT id FROM prescriptions)"
+                )
+                conn.execute("INSERT INTO sync_meta (key, value) VALUES ('orphan_reminders_purged', 1)")
+        if "seq" not in {row["name"] for row in conn.execute("PRAGMA table_info(blob_phashes)")}:
+            # Rebuilt with a sequence column; maintenance recomputes the hashes
+            conn.execute("DROP TABLE blob_phashes")
+            conn.executescript(SCHEMA)
+
+    @staticmethod
+    def _backfill_days(conn, columns):
+        """Fill day columns from their text dates, parsing each column in one batch."""
+        rows = conn.execute(
+            f"SELECT id, {', '.join(DAY_COLUMNS[column] for column in columns)} FROM prescriptions"
+        ).fetchall()
+        if not rows:
+            return
+        ids = [row[0] for row in rows]
+        for index, column in enumerate(columns, start=1):
+            days = parse_days([row[index] for row in rows])
+            conn.executemany(
+                f"UPDATE prescriptions SET {column} = ? WHERE id = ?",
+                [(None if day == NO_DAY else int(day), prescription_id) for day, prescription_id in zip(days, ids)],
+            )
+
+    def close(self):
+        self.is_open = False
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+        self._local = threading.local()
+
+    def ping(self):
+        """True if the store is open and answering queries."""
+        return self.is_open and self.connection().execute("SELECT 1").fetchone() is not None
+
+    def connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA foreign_keys=ON")
+        conn.execute("PRAGMA busy_timeout=5000")
+        # Imports write five b-trees per prescription; the 2 MB default cache thrashes
+        conn.execute("PRAGMA cache_size=-32768")
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        """Run a block as one write transaction, rolling back on error."""
+        conn = self.connection()
+        touched = self._local.touched = set()
+        self._local.earliest_due = None
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+            if touched:
+                version = conn.execute(
+                    "INSERT INTO sync_meta (key, value) VALUES ('version_clock', 1) "
+                    "ON CONFLICT(key) DO UPDATE SET value = value + 1 RETURNING value"
+                ).fetchone()[0]
+                conn.executemany(
+                    "INSERT OR REPLACE INTO cache_versions (scope, version) VALUES (?, ?)",
+                    [(scope, version) for scope in touched],
+                )
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            self._local.touched = None
+        conn.execute("COMMIT")
+        # data_version does not change for this connection's own commits
+        self._local.versions = None
+        if self._local.earliest_due is not None and self.on_reminders_scheduled is not None:
+            self.on_reminders_scheduled(self._local.earliest_due)
+
+    def version(self, scope):
+        """Current version of a collection; changes after every committed write to it,
+        from any process."""
+        conn = self.connection()
+        data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+        cached = getattr(self._local, "versions", None)
+        if cached is None or cached[0] != data_version:
+            # Another connection committed since this one last looked
+            cached = self._local.versions = (data_version, {})
+        versions = cached[1]
+        if scope not in versions:
+            row = conn.execute("SELECT version FROM cache_versions WHERE scope = ?", (scope,)).fetchone()
+            versions[scope] = 0 if row is None else row[0]
+        return versions[scope]
+
+    def _touch(self, *scopes):
+        self._local.touched.update(scopes)
+
+    def _forget_scope(self, conn, scope):
+        """Drop a collection scope that no longer exists, e.g. a deleted member's list."""
+        conn.execute("DELETE FROM cache_versions WHERE scope = ?", (scope,))
+        self._local.touched.discard(scope)
+
+    @contextmanager
+    def _deferred_writes(self, conn):
+        """Collect counter and reminder writes made in the block and apply them
+        once at the end, instead of a few statements per row.
+
+        Nested blocks merge into the enclosing one when they succeed and are
+        dropped when they raise, so they pair with a savepoint.
+        """
+        outer = getattr(self._local, "pending", None)
+        pending = self._local.pending = PendingWrites()
+        try:
+            yield
+        finally:
+            self._local.pending = outer
+        if outer is not None:
+            outer.merge(pending)
+        else:
+            self._apply_pending(conn, pending)
+
+    @contextmanager
+    def snapshot(self):
+        """Run several reads against one consistent view of the database."""
+        conn = self.connection()
+        conn.execute("BEGIN")
+        try:
+            yield conn
+        finally:
+            conn.execute("COMMIT")
+
+    # ==================== Family Members ====================
+
+    def list_family_members(self):
+        return fetch_records(
+            self.connection(), FamilyMemberRecord,
+            f"SELECT {FamilyMemberRecord.columns()} FROM family_members ORDER BY created_at, id",
+        )
+
+    def get_family_member(self, member_id):
+        row = self.connection().execute(
+            "SELECT * FROM family_members WHERE id = ?", (member_id,)
+        ).fetchone()
+        return dict(row) if row else None
+
+    def create_family_member(self, name, relationship):
+        member = {
+            "id": generate_id(),
+            "name": name,
+            "relationship": relationship,
+            "created_at": utc_now(),
+        }
+        with self.transaction() as conn:
+            self._upsert_family_member(conn, member)
+        return member
+
+    def update_family_member(self, member_id, changes):
+        changes = {k: v for k, v in changes.items() if k in FAMILY_MEMBER_FIELDS}
+        with self.transaction() as conn:
+            row = conn.execute(
+                "SELECT * FROM family_members WHERE id = ?", (member_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            member = {**dict(row), **changes}
+            self._upsert_family_member(conn, member)
+        return member
+
+    def delete_family_member(self, member_id):
+        """Delete a member and their prescriptions.
+
+        Returns the number of prescriptions removed, or None if the member
+        does not exist.
+        """
+        with self.transaction() as conn:
+            return self._delete_family_member(conn, member_id)
+
+    def _upsert_family_member(self, conn, member):
+        self._upsert_family_members(conn, [member])
+
+    def _upsert_family_members(self, conn, members):
+        ids = [member["id"] for member in members]
+        new = set(ids) - self._existing_ids(conn, "family_members", ids)
+        if new:
+            self._bump(conn, TOTALS, {"family_members": len(new)})
+        conn.executemany(
+            "INSERT INTO family_members (id, name, relationship, created_at) "
+            "VALUES (:id, :name, :relationship, :created_at) ON CONFLICT(id) DO UPDATE "
+            "SET name = excluded.name, relationship = excluded.relationship",
+            members,
+        )
+        self._log_changes(conn, MEMBER, ids)
+        self._touch(MEMBERS_VERSION)
+
+    def _delete_family_member(self, conn, member_id):
+        image_refs = conn.execute(
+            "SELECT image_hash, count(*) FROM prescriptions "
+            "WHERE family_member_id = ? AND image_hash IS NOT NULL GROUP BY image_hash",
+            (member_id,),
+        ).fetchall()
+        removed = conn.execute(
+            "SELECT id, rx_type, expiry_day FROM prescriptions WHERE family_member_id = ?",
+            (member_id,),
+        ).fetchall()
+        conn.execute(
+            "INSERT OR REPLACE INTO change_log (entity, entity_id, deleted, changed_at) "
+            "SELECT ?, id, 1, ? FROM prescriptions WHERE family_member_id = ?",
+            (PRESCRIPTION, utc_now(), member_id),
+        )
+        conn.execute(
+            "DELETE FROM reminders WHERE prescription_id IN "
+            "(SELECT id FROM prescriptions WHERE family_member_id = ?)",
+            (member_id,),
+        )
+        self._unschedule_pending_reminders([row["id"] for row in removed])
+        deleted = conn.execute(
+            "DELETE FROM prescriptions WHERE family_member_id = ?", (member_id,)
+        ).rowcount
+        if not conn.execute(
+            "DELETE FROM family_members WHERE id = ?", (member_id,)
+        ).rowcount:
+            return None
+        for blob_hash, count in image_refs:
+            self._release_blob(conn, blob_hash, count)
+        self._discount_member(conn, member_id, removed)
+        self._log_change(conn, MEMBER, member_id, deleted=True)
+        self._touch(MEMBERS_VERSION, PRESCRIPTIONS_VERSION)
+        self._forget_scope(conn, MEMBER_PRESCRIPTIONS + member_id)
+        return deleted
+
+    # ==================== Prescriptions ====================
+
+    def list_prescriptions(
+        self, family_member_id=None, expired=None, expiring_within_days=None,
+        after=None, limit=None, columns=None,
+    ):
+        """List prescriptions in (created_at, id) order, optionally filtered by member and expiry.
+
+        `expired` selects prescriptions whose expiry day has passed (or, when
+        False, those that have not or have no expiry); `expiring_within_days`
+        selects ones expiring between today and that many days from now.
+        `after` is the (created_at, id) of the last row already seen, so a page
+        is an index seek however deep it is. Rows are PrescriptionRecords, or
+        dicts of just `columns` (a subset of LIST_COLUMNS) when given.
+        """
+        conditions, params = [], []
+        if family_member_id is not None:
+            conditions.append("family_member_id = ?")
+            params.append(family_member_id)
+        today = today_day()
+        if expired is True:
+            conditions.append("expiry_day < ?")
+            params.append(today)
+        elif expired is False:
+            conditions.append("(expiry_day IS NULL OR expiry_day >= ?)")
+            params.append(today)
+        if expiring_within_days is not None:
+            conditions.append("expiry_day BETWEEN ? AND ?")
+            params += [today, today + expiring_within_days]
+        if after is not None:
+            conditions.append("(created_at, id) > (?, ?)")
+            params += list(after)
+        where = f"WHERE {' AND '.join(conditions)} " if conditions else ""
+        selected = PrescriptionRecord.columns()
+        if columns is not None:
+            unknown = set(columns) - set(LIST_COLUMNS)
+            if unknown:
+                raise ValueError(f"Unknown columns: {', '.join(sorted(unknown))}")
+            selected = ", ".join(columns)
+        query = f"SELECT {selected} FROM prescriptions {where}ORDER BY created_at, id"
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+        if columns is None:
+            return fetch_records(self.connection(), PrescriptionRecord, query, params)
+        return [dict(row) for row in self.connection().execute(query, params)]
+
+    def get_prescription(self, prescription_id):
+        row = self.connection().execute(
+            "SELECT * FROM prescriptions WHERE id = ?", (prescription_id,)
+        ).fetchone()
+        return dict(row) if row else None
+
+    def create_prescription(self, data, image=None):
+        """Insert a prescription, or return None if its family member is missing.
+
+        `image` is an optional blobs.StagedBlob; it is published and retained
+        in the same transaction as the insert.
+        """
+        prescription = {field: data.get(field) for field in PRESCRIPTION_FIELDS}
+        prescription["id"] = generate_id()
+        prescription["created_at"] = utc_now()
+        with self.transaction() as conn:
+            if conn.execute(
+                "SELECT 1 FROM family_members WHERE id = ?",
+                (prescription["family_member_id"],),
+            ).fetchone() is None:
+                return None
+            if image is not None:
+                self._retain_blob(conn, image)
+                prescription["image_hash"] = image.hash
+            self._upsert_prescription(conn, prescription, None)
+        return prescription
+
+    def update_prescription(self, prescription_id, changes, image=None):
+        changes = {k: v for k, v in changes.items() if k in PRESCRIPTION_FIELDS}
+        with self.transaction() as conn:
+            row = conn.execute(
+                "SELECT * FROM prescriptions WHERE id = ?", (prescription_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            prescription = {**dict(row), **changes}
+            if image is not None:
+                self._retain_blob(conn, image)
+                prescription["image_hash"] = image.hash
+                if row["image_hash"] is not None:
+                    self._release_blob(conn, row["image_hash"])
+            self._upsert_prescription(conn, prescription, row)
+        return prescription
+
+    def delete_prescription(self, prescription_id):
+        with self.transaction() as conn:
+            return self._delete_prescription(conn, prescription_id)
+
+    def _upsert_prescription(self, conn, prescription, previous):
+        """Write a prescription; `previous` is its current row, or None if new."""
+        self._upsert_prescriptions(conn, [(prescription, previous)])
+
+    def _upsert_prescriptions(self, conn, writes):
+        """Write (prescription, previous row or None) pairs in order, one statement per kind of write.
+
+        A prescription written twice may name the earlier dict as its
+        previous row; it has its day columns filled in by then.
+        """
+        scheduled, rescheduled = [], []
+        for prescription, previous in writes:
+            for column, field in DAY_COLUMNS.items():
+                prescription[column] = parse_day(prescription[field])
+            if previous is not None:
+                self._count_prescription(conn, previous, -1)
+                self._touch(MEMBER_PRESCRIPTIONS + previous["family_member_id"])
+            self._count_prescription(conn, prescription, 1)
+            if previous is None:
+                scheduled.append((prescription["id"], prescription["expiry_day"]))
+            elif previous["expiry_day"] != prescription["expiry_day"]:
+                rescheduled.append((prescription["id"], prescription["expiry_day"]))
+            self._touch(MEMBER_PRESCRIPTIONS + prescription["family_member_id"])
+        self._schedule_reminders(conn, scheduled, replace=False)
+        self._schedule_reminders(conn, rescheduled)
+        conn.executemany(
+            "INSERT INTO prescriptions (id, family_member_id, rx_type, image_hash, notes, "
+            "date_taken, expiry_date, created_at, date_taken_day, expiry_day) VALUES (:id, "
+            ":family_member_id, :rx_type, :image_hash, :notes, :date_taken, :expiry_date, "
+            ":created_at, :date_taken_day, :expiry_day) "
+            "ON CONFLICT(id) DO UPDATE SET family_member_id = excluded.family_member_id, "
+            "rx_type = excluded.rx_type, image_hash = excluded.image_hash, "
+            "notes = excluded.notes, date_taken = excluded.date_taken, "
+            "expiry_date = excluded.expiry_date, date_taken_day = excluded.date_taken_day, "
+            "expiry_day = excluded.expiry_day",
+            [prescription for prescription, _ in writes],
+        )
+        self._log_changes(conn, PRESCRIPTION, [prescription["id"] for prescription, _ in writes])
+        self._touch(PRESCRIPTIONS_VERSION)
+
+    def _delete_prescription(self, conn, prescription_id):
+        row = conn.execute(
+            "DELETE FROM prescriptions WHERE id = ? "
+            "RETURNING family_member_id, rx_type, expiry_day, image_hash",
+            (prescription_id,),
+        ).fetchone()
+        if row is None:
+            return False
+        self._count_prescription(conn, row, -1)
+        conn.execute("DELETE FROM reminders WHERE prescription_id = ?", (prescription_id,))
+        self._unschedule_pending_reminders([prescription_id])
+        if row["image_hash"] is not None:
+            self._release_blob(conn, row["image_hash"])
+        self._log_change(conn, PRESCRIPTION, prescription_id, deleted=True)
+        self._touch(PRESCRIPTIONS_VERSION, MEMBER_PRESCRIPTIONS + row["family_member_id"])
+        return True
+
+    # ==================== Stats ====================
+
+    def get_stats(self, expiring_within_days, family_member_id=None):
+        """Counter-backed stats for everyone, or one family member.
+
+        Reads touch only the counter rows plus at most `expiring_within_days`
+        day buckets, independent of how many prescriptions exist.
+        """
+        scope = TOTALS if family_member_id is None else family_member_id
+        today = today_day()
+        with self.snapshot() as conn:
+            counters = dict(conn.execute(
+                "SELECT key, value FROM counters WHERE scope = ?", (scope,)
+            ).fetchall())
+            expiring = conn.execute(
+                "SELECT coalesce(sum(count), 0) FROM expiry_counts "
+                "WHERE scope = ? AND day BETWEEN ? AND ?",
+                (scope, today, today + expiring_within_days),
+            ).fetchone()[0]
+        stats = {
+            "total_prescriptions": counters.get("prescriptions", 0),
+            "eyeglass_prescriptions": counters.get("rx:eyeglass", 0),
+            "contact_prescriptions": counters.get("rx:contact", 0),
+            "expiring_soon": expiring,
+        }
+        if family_member_id is None:
+            stats["family_members"] = counters.get("family_members", 0)
+        return stats
+
+    def rebuild_counters(self):
+        """Recompute every counter from the tables (migration and repair)."""
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM counters")
+            conn.execute("DELETE FROM expiry_counts")
+            members = conn.execute("SELECT count(*) FROM family_members").fetchone()[0]
+            self._bump(conn, TOTALS, {"family_members": members})
+            with self._deferred_writes(conn):
+                for row in conn.execute("SELECT family_member_id, rx_type, expiry_day FROM prescriptions"):
+                    self._count_prescription(conn, row, 1)
+            conn.execute(
+                "INSERT OR REPLACE INTO sync_meta (key, value) VALUES ('counters_built', 1)"
+            )
+
+    def _count_prescription(self, conn, row, sign):
+        deltas = {"prescriptions": sign, f"rx:{row['rx_type']}": sign}
+        day = row["expiry_day"]
+        for scope in (TOTALS, row["family_member_id"]):
+            self._bump(conn, scope, deltas)
+            if day is not None:
+                self._bump_expiry(conn, scope, day, sign)
+
+    def _discount_member(self, conn, member_id, prescriptions):
+        """Remove a deleted member and their prescriptions from the counters."""
+        deltas = Counter({"family_members": -1})
+        days = Counter()
+        for row in prescriptions:
+            deltas["prescriptions"] -= 1
+            deltas[f"rx:{row['rx_type']}"] -= 1
+            day = row["expiry_day"]
+            if day is not None:
+                days[day] -= 1
+        self._bump(conn, TOTALS, deltas)
+        for day, delta in days.items():
+            self._bump_expiry(conn, TOTALS, day, delta)
+        conn.execute("DELETE FROM counters WHERE scope = ?", (member_id,))
+        conn.execute("DELETE FROM expiry_counts WHERE scope = ?", (member_id,))
+        pending = getattr(self._local, "pending", None)
+        if pending is not None:
+            pending.drop_scope(member_id)
+
+    def _bump(self, conn, scope, deltas):
+        pending = getattr(self._local, "pending", None)
+        if pending is not None:
+            for key, delta in deltas.items():
+                pending.counters[scope, key] += delta
+        else:
+            self._write_counters(conn, [(scope, key, delta) for key, delta in deltas.items()])
+
+    def _bump_expiry(self, conn, scope, day, delta):
+        pending = getattr(self._local, "pending", None)
+        if pending is not None:
+            pending.expiry[scope, day] += delta
+        else:
+            self._write_expiry_counts(conn, [(scope, day, delta)])
+
+    @staticmethod
+    def _write_counters(conn, rows):
+        conn.executemany(
+            "INSERT INTO counters (scope, key, value) VALUES (?, ?, ?) "
+            "ON CONFLICT(scope, key) DO UPDATE SET value = value + excluded.value",
+            rows,
+        )
+
+    @staticmethod
+    def _write_expiry_counts(conn, rows):
+        conn.executemany(
+            "INSERT INTO expiry_counts (scope, day, count) VALUES (?, ?, ?) "
+            "ON CONFLICT(scope, day) DO UPDATE SET count = count + excluded.count",
+            rows,
+        )
+        conn.executemany(
+            "DELETE FROM expiry_counts WHERE scope = ? AND day = ? AND count = 0",
+            [(scope, day) for scope, day, _ in rows],
+        )
+
+    def _apply_pending(self, conn, pending):
+        self._write_counters(conn, pending.totals(pending.counters))
+        self._write_expiry_counts(conn, pending.totals(pending.expiry))
+        conn.executemany(
+            "INSERT INTO reminders (prescription_id, days_before, due_at) VALUES (?, ?, ?)",
+            [row for rows in pending.reminders.values() for row in rows],
+        )
+
+    # ==================== Reminders ====================
+
+    def due_reminders(self, now, limit):
+        """Reminders due by `now` (epoch seconds), earliest first, with context."""
+        rows = self.connection().execute(
+            "SELECT r.id, r.prescription_id, r.days_before, r.due_at, p.family_member_id, "
+            "p.rx_type, p.expiry_date, m.name AS member_name FROM reminders r "
+            "JOIN prescriptions p ON p.id = r.prescription_id "
+            "JOIN family_members m ON m.id = p.family_member_id "
+            "WHERE r.due_at <= ? ORDER BY r.due_at LIMIT ?",
+            (now, limit),
+        )
+        return [dict(row) for row in rows]
+
+    def complete_reminders(self, reminder_ids):
+        with self.transaction() as conn:
+            conn.executemany("DELETE FROM reminders WHERE id = ?", [(i,) for i in reminder_ids])
+
+    def next_reminder_due(self):
+        # Joined like due_reminders, so a row it would never return cannot
+        # keep the scheduler waking up for it
+        row = self.connection().execute(
+            "SELECT r.due_at FROM reminders r JOIN prescriptions p ON p.id = r.prescription_id "
+            "ORDER BY r.due_at LIMIT 1"
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def rebuild_reminders(self):
+        """Reschedule reminders for every prescription (migration and repair)."""
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM reminders")
+            self._schedule_reminders(conn, conn.execute(
+                "SELECT id, expiry_day FROM prescriptions WHERE expiry_day IS NOT NULL"
+            ).fetchall(), replace=False)
+            conn.execute(
+                "INSERT OR REPLACE INTO sync_meta (key, value) VALUES ('reminders_built', 1)"
+            )
+
+    def _unschedule_pending_reminders(self, prescription_ids):
+        """Cancel reminders queued earlier in this transaction for deleted prescriptions.
+
+        An empty list rather than a missing key, so it also replaces what an
+        enclosing block queued when this one is merged into it.
+        """
+        pending = getattr(self._local, "pending", None)
+        if pending is not None:
+            for prescription_id in prescription_ids:
+                pending.reminders[prescription_id] = []
+
+    def _schedule_reminders(self, conn, expiry_days, replace=True):
+        """Schedule reminders for (prescription id, expiry day or None) pairs."""
+        if not expiry_days:
+            return
+        if replace:
+            conn.executemany(
+                "DELETE FROM reminders WHERE prescription_id = ?",
+                [(prescription_id,) for prescription_id, _ in expiry_days],
+            )
+        now = time.time()
+        pending = getattr(self._local, "pending", None)
+        rows = []
+        for prescription_id, day in expiry_days:
+            scheduled = [] if day is None else [
+                (prescription_id, days_before, due_at) for days_before, due_at in reminder_times(day, now)
+            ]
+            if pending is not None:
+                pending.reminders[prescription_id] = scheduled
+            else:
+                rows += scheduled
+            if scheduled:
+                earliest = getattr(self._local, "earliest_due", None)
+                due_at = min(row[2] for row in scheduled)
+                self._local.earliest_due = due_at if earliest is None else min(earliest, due_at)
+        conn.executemany(
+            "INSERT INTO reminders (prescription_id, days_before, due_at) VALUES (?, ?, ?)", rows
+        )
+
+    # ==================== Sync ====================
+
+    def pull_changes(self, cursor, limit):
+        """Return up to `limit` changes after `cursor`, oldest first.
+
+        Each entity appears at most once with its current state, or as a
+        tombstone if deleted. When `cursor` was handed out before tombstones
+        after it were pruned, the pull restarts from zero and `reset` tells
+        the client to reconcile against a full snapshot; the cursors of that
+        pass carry the current prune generation, so its later pages go on
+        from where they left off.
+        """
+        generation, seq = divmod(cursor, 1 << CURSOR_SEQ_BITS)
+        with self.snapshot() as conn:
+            meta = dict(conn.execute(
+                "SELECT key, value FROM sync_meta WHERE key IN ('pruned_through', 'prune_generation')"
+            ).fetchall())
+            current = meta.get("prune_generation", 0)
+            reset = generation < current and 0 < seq < meta.get("pruned_through", 0)
+            if reset:
+                seq = 0
+            entries = conn.execute(
+                "SELECT seq, entity, entity_id, deleted FROM change_log "
+                "WHERE seq > ? ORDER BY seq LIMIT ?",
+                (seq, limit + 1),
+            ).fetchall()
+            has_more = len(entries) > limit
+            entries = entries[:limit]
+            upserted = {MEMBER: [], PRESCRIPTION: []}
+            deleted = {MEMBER: [], PRESCRIPTION: []}
+            for entry in entries:
+                target = deleted if entry["deleted"] else upserted
+                target[entry["entity"]].append(entry["entity_id"])
+            changes = {
+                "family_members": self._rows_by_id(conn, "family_members", upserted[MEMBER]),
+                "prescriptions": self._rows_by_id(conn, "prescriptions", upserted[PRESCRIPTION]),
+                "deleted": {
+                    "family_members": deleted[MEMBER],
+                    "prescriptions": deleted[PRESCRIPTION],
+                },
+            }
+        return {
+            "changes": changes,
+            "cursor": (current << CURSOR_SEQ_BITS) + (entries[-1]["seq"] if entries else seq),
+            "has_more": has_more,
+            "reset": reset,
+        }
+
+    def apply_changes(self, members, prescriptions, deleted_members, deleted_prescriptions):
+        """Apply a client's pushed changes in one transaction.
+
+        Changes are last-writer-wins; ones that cannot be applied (unknown
+        family member or image) are skipped and returned as rejections.
+        """
+        rejected = []
+        with self.transaction() as conn:
+            for member in members:
+                member.setdefault("created_at", utc_now())
+                self._upsert_family_member(conn, member)
+            for prescription in prescriptions:
+                try:
+                    self._apply_prescription(conn, prescription)
+                except SyncRejected as exc:
+                    rejected.append({"entity": PRESCRIPTION, "id": prescription["id"], "reason": str(exc)})
+            for prescription_id in deleted_prescriptions:
+                self._delete_prescription(conn, prescription_id)
+            for member_id in deleted_members:
+                self._delete_family_member(conn, member_id)
+        return rejected
+
+    def prune_tombstones(self, deleted_before):
+        """Forget tombstones older than `deleted_before`; returns how many."""
+        with self.transaction() as conn:
+            row = conn.execute(
+                "SELECT count(*), max(seq) FROM change_log WHERE deleted = 1 AND changed_at < ?",
+                (deleted_before,),
+            ).fetchone()
+            if not row[0]:
+                return 0
+            conn.execute(
+                "DELETE FROM change_log WHERE deleted = 1 AND changed_at < ?", (deleted_before,)
+            )
+            conn.execute(
+                "INSERT INTO sync_meta (key, value) VALUES ('pruned_through', ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = max(value, excluded.value)",
+                (row[1],),
+            )
+            conn.execute(
+                "INSERT INTO sync_meta (key, value) VALUES ('prune_generation', 1) "
+                "ON CONFLICT(key) DO UPDATE SET value = value + 1"
+            )
+        return row[0]
+
+    def _apply_prescription(self, conn, prescription):
+        for _, reason in self._apply_prescriptions(conn, [prescription]):
+            raise SyncRejected(reason)
+
+    def _apply_prescriptions(self, conn, prescriptions):
+        """Upsert client-supplied prescriptions by id, keeping image refcounts in step.
+
+        Returns (index, reason) for each one that cannot be applied because
+        its family member or image does not exist; the others are written.
+        """
+        members = self._existing_ids(conn, "family_members", [p["family_member_id"] for p in prescriptions])
+        current = {row["id"]: row for row in self._fetch_by_id(conn, "prescriptions", [p["id"] for p in prescriptions])}
+        blobs = self._existing_ids(conn, "blobs", [p.get("image_hash") for p in prescriptions], column="hash")
+        now = utc_now()
+        refcounts = Counter()
+        writes, rejected = [], []
+        for index, prescription in enumerate(prescriptions):
+            if prescription["family_member_id"] not in members:
+                rejected.append((index, "Family member not found"))
+                continue
+            row = current.get(prescription["id"])
+            old_hash = row["image_hash"] if row else None
+            new_hash = prescription.get("image_hash")
+            if new_hash != old_hash:
+                if new_hash is not None and new_hash not in blobs:
+                    rejected.append((index, "Image blob not found"))
+                    continue
+                if new_hash is not None:
+                    refcounts[new_hash] += 1
+                if old_hash is not None:
+                    refcounts[old_hash] -= 1
+            created_at = row["created_at"] if row else now
+            prescription = {**{field: None for field in PRESCRIPTION_FIELDS}, "created_at": created_at, **prescription}
+            writes.append((prescription, row))
+            current[prescription["id"]] = prescription
+        conn.executemany(
+            "UPDATE blobs SET refcount = refcount + :delta, released_at = "
+            "CASE WHEN refcount + :delta <= 0 THEN :now END WHERE hash = :hash",
+            [{"delta": delta, "now": now, "hash": blob_hash} for blob_hash, delta in refcounts.items() if delta],
+        )
+        if writes:
+            self._upsert_prescriptions(conn, writes)
+        return rejected
+
+    def _log_change(self, conn, entity, entity_id, deleted=False):
+        self._log_changes(conn, entity, [entity_id], deleted)
+
+    def _log_changes(self, conn, entity, entity_ids, deleted=False):
+        changed_at = utc_now()
+        conn.executemany(
+            "INSERT OR REPLACE INTO change_log (entity, entity_id, deleted, changed_at) "
+            "VALUES (?, ?, ?, ?)",
+            [(entity, entity_id, int(deleted), changed_at) for entity_id in entity_ids],
+        )
+
+    @staticmethod
+    def _existing_ids(conn, table, ids, column="id"):
+        """The subset of `ids` (None allowed) present in `table`."""
+        ids = list({entity_id for entity_id in ids if entity_id is not None})
+        if not ids:
+            return set()
+        placeholders = ", ".join("?" * len(ids))
+        return {row[0] for row in conn.execute(
+            f"SELECT {column} FROM {table} WHERE {column} IN ({placeholders})", ids
+        )}
+
+    @staticmethod
+    def _fetch_by_id(conn, table, ids):
+        ids = list(set(ids))
+        if not ids:
+            return []
+        placeholders = ", ".join("?" * len(ids))
+        return conn.execute(f"SELECT * FROM {table} WHERE id IN ({placeholders})", ids).fetchall()
+
+    @staticmethod
+    def _rows_by_id(conn, table, ids):
+        if not ids:
+            return []
+        record_type = RECORD_TYPES[table]
+        placeholders = ", ".join("?" * len(ids))
+        rows = fetch_records(
+            conn, record_type, f"SELECT {record_type.columns()} FROM {table} WHERE id IN ({placeholders})", ids
+        )
+        by_id = {row.id: row for row in rows}
+        return [by_id[entity_id] for entity_id in ids if entity_id in by_id]
+
+    # ==================== Import / Export ====================
+
+    def export_rows(self, family_member_id=None):
+        """Yield (entity, row) for members, then their prescriptions.
+
+        Rows are read lazily from one snapshot on a private connection, so a
+        long export is consistent without holding a pooled connection or the
+        whole result in memory. Prescription rows carry the image's
+        content_type as image_content_type.
+        """
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN")
+            member_filter = "" if family_member_id is None else "WHERE id = ? "
+            rx_filter = "" if family_member_id is None else "WHERE p.family_member_id = ? "
+            params = () if family_member_id is None else (family_member_id,)
+            for row in conn.execute(
+                f"SELECT id, name, relationship, created_at FROM family_members {member_filter}"
+                "ORDER BY created_at, id",
+                params,
+            ):
+                yield MEMBER, dict(row)
+            for row in conn.execute(
+                "SELECT p.id, p.family_member_id, p.rx_type, p.image_hash, p.notes, p.date_taken, "
+                "p.expiry_date, p.created_at, b.content_type AS image_content_type "
+                f"FROM prescriptions p LEFT JOIN blobs b ON b.hash = p.image_hash {rx_filter}"
+                "ORDER BY p.created_at, p.id",
+                params,
+            ):
+                yield PRESCRIPTION, dict(row)
+        finally:
+            conn.close()
+
+    def import_batch(self, records):
+        """Upsert imported (line, entity, record, image) tuples in one transaction.
+
+        Rows whose family member or image does not exist are found up front
+        and reported as (line, reason); the rest are written with a few
+        statements for the whole batch. Should that fail, the batch is rolled
+        back to its savepoint and replayed a row at a time, so only the
+        offending rows are lost. `image` is an optional StagedBlob that
+        replaces the record's image_hash. Returns (members imported,
+        prescriptions imported, errors).
+        """
+        with self.transaction() as conn, self._deferred_writes(conn):
+            conn.execute("SAVEPOINT import_batch")
+            try:
+                with self._deferred_writes(conn):
+                    result = self._import_rows(conn, records)
+            except sqlite3.IntegrityError:
+                conn.execute("ROLLBACK TO import_batch")
+                result = self._import_rows_one_by_one(conn, records)
+            conn.execute("RELEASE import_batch")
+        return result
+
+    def _import_rows(self, conn, records):
+        members, prescriptions, lines = [], [], []
+        now = utc_now()
+        for line, entity, record, image in records:
+            if "id" not in record:
+                record["id"] = generate_id()
+            if entity == MEMBER:
+                record.setdefault("created_at", now)
+                members.append(record)
+            else:
+                if image is not None:
+                    self._record_blob(conn, image)
+                    record["image_hash"] = image.hash
+                prescriptions.append(record)
+                lines.append(line)
+        if members:
+            self._upsert_family_members(conn, members)
+        rejected = self._apply_prescriptions(conn, prescriptions) if prescriptions else []
+        errors = [(lines[index], reason) for index, reason in rejected]
+        return len(members), len(prescriptions) - len(rejected), errors
+
+    def _import_rows_one_by_one(self, conn, records):
+        members = prescriptions = 0
+        errors = []
+        for line, entity, record, image in records:
+            conn.execute("SAVEPOINT import_row")
+            try:
+                with self._deferred_writes(conn):
+                    record.setdefault("id", generate_id())
+                    if entity == MEMBER:
+                        record.setdefault("created_at", utc_now())
+                        self._upsert_family_member(conn, record)
+                    else:
+                        if image is not None:
+                            self._record_blob(conn, image)
+                            record["image_hash"] = image.hash
+                        self._apply_prescription(conn, record)
+                if entity == MEMBER:
+                    members += 1
+                else:
+                    prescriptions += 1
+            except (SyncRejected, sqlite3.IntegrityError) as exc:
+                conn.execute("ROLLBACK TO import_row")
+                errors.append((line, str(exc)))
+            conn.execute("RELEASE import_row")
+        return members, prescriptions, errors
+
+    # ==================== Batch ====================
+
+    def apply_batch(self, operations):
+        """Apply create/update/delete operations atomically in one transaction.
+
+        Each operation is a dict with `op`, `entity`, `data` and, for update
+        and delete, `id`. A create may name a `temp_id`; later operations
+        refer to the new record as "$<temp_id>" in `id` or
+        `data["family_member_id"]`. Returns (results, temp_ids mapping to the
+        real ids); if any operation fails everything is rolled back and
+        BatchFailed names it.
+        """
+        temp_ids = {}
+        results = []
+        with self.transaction() as conn, self._deferred_writes(conn):
+            for index, operation in enumerate(operations):
+                try:
+                    results.append(self._apply_operation(conn, operation, temp_ids))
+                except (SyncRejected, sqlite3.IntegrityError) as exc:
+                    raise BatchFailed(index, str(exc)) from None
+        return results, temp_ids
+
+    def _apply_operation(self, conn, operation, temp_ids):
+        op, entity = operation["op"], operation["entity"]
+        data = dict(operation.get("data") or {})
+        if "family_member_id" in data:
+            data["family_member_id"] = self._resolve_temp_id(data["family_member_id"], temp_ids)
+        target_id = self._resolve_temp_id(operation.get("id"), temp_ids)
+        result = {"op": op, "entity": entity, "id": target_id, "record": None}
+
+        if op == "delete":
+            if entity == MEMBER:
+                removed = self._delete_family_member(conn, target_id)
+                if removed is None:
+                    raise SyncRejected("Family member not found")
+                result["prescriptions_deleted"] = removed
+            elif not self._delete_prescription(conn, target_id):
+                raise SyncRejected("Prescription not found")
+            return result
+
+        table = "family_members" if entity == MEMBER else "prescriptions"
+        if op == "create":
+            record = {"id": generate_id(), **data}
+            if operation.get("temp_id") is not None:
+                temp_ids[operation["temp_id"]] = record["id"]
+        else:
+            row = conn.execute(f"SELECT * FROM {table} WHERE id = ?", (target_id,)).fetchone()
+            if row is None:
+                raise SyncRejected(f"{'Family member' if entity == MEMBER else 'Prescription'} not found")
+            record = {**dict(row), **data}
+
+        if entity == MEMBER:
+            record.setdefault("created_at", utc_now())
+            self._upsert_family_member(conn, record)
+            result["record"] = {column: record[column] for column in ("id", "name", "relationship", "created_at")}
+        else:
+            record = {column: record.get(column) for column in LIST_COLUMNS}
+            record["created_at"] = record["created_at"] or utc_now()
+            self._apply_prescription(conn, record)
+            result["record"] = record
+        result["id"] = record["id"]
+        return result
+
+    @staticmethod
+    def _resolve_temp_id(value, temp_ids):
+        if not isinstance(value, str) or not value.startswith("$"):
+            return value
+        try:
+            return temp_ids[value[1:]]
+        except KeyError:
+            raise SyncRejected(f"Unknown temporary id {value}") from None
+
+    # ==================== Blobs ====================
+
+    def get_blob(self, blob_hash):
+        row = self.connection().execute(
+            "SELECT * FROM blobs WHERE hash = ? AND refcount > 0", (blob_hash,)
+        ).fetchone()
+        return dict(row) if row else None
+
+    def add_blob(self, image):
+        """Record an uploaded blob that nothing references yet.
+
+        It is kept for the garbage collection grace period, giving a client
+        time to attach it to a prescription.
+        """
+        with self.transaction() as conn:
+            self._record_blob(conn, image)
+
+    def collect_blobs(self, released_before, delete_file):
+        """Drop blobs unreferenced since `released_before` and unlink their files.
+
+        Files are removed while the write lock is held so a concurrent upload
+        of the same content cannot publish into a path being deleted.
+        """
+        with self.transaction() as conn:
+            hashes = [row[0] for row in conn.execute(
+                "DELETE FROM blobs WHERE refcount <= 0 AND released_at < ? RETURNING hash",
+                (released_before,),
+            )]
+            for blob_hash in hashes:
+                delete_file(blob_hash)
+        return len(hashes)
+
+    @staticmethod
+    def _record_blob(conn, image):
+        conn.execute(
+            "INSERT INTO blobs (hash, size, content_type, refcount, released_at) "
+            "VALUES (:hash, :size, :content_type, 0, :now) ON CONFLICT(hash) DO UPDATE "
+            "SET released_at = CASE WHEN refcount <= 0 THEN :now END",
+            {"hash": image.hash, "size": image.size, "content_type": image.content_type, "now": utc_now()},
+        )
+        Store._record_phash(conn, image)
+        image.publish()
+
+    def _retain_blob(self, conn, image):
+        conn.execute(
+            "INSERT INTO blobs (hash, size, content_type, refcount) VALUES (?, ?, ?, 1) "
+            "ON CONFLICT(hash) DO UPDATE SET refcount = refcount + 1, released_at = NULL",
+            (image.hash, image.size, image.content_type),
+        )
+        self._record_phash(conn, image)
+        image.publish()
+
+    @staticmethod
+    def _record_phash(conn, image):
+        if image.phash is not None:
+            conn.execute(
+                "INSERT OR REPLACE INTO blob_phashes (hash, phash) VALUES (?, ?)",
+                (image.hash, image.phash),
+            )
+
+    def _release_blob(self, conn, blob_hash, count=1):
+        conn.execute(
+            "UPDATE blobs SET refcount = refcount - :count, released_at = "
+            "CASE WHEN refcount - :count <= 0 THEN :now END WHERE hash = :hash",
+            {"count": count, "now": utc_now(), "hash": blob_hash},
+        )
+
+    # ==================== Perceptual Hashes ====================
+
+    def phashes_since(self, seq):
+        """(seq, blob hash, phash) of perceptual hashes stored after `seq`, in order."""
+        return [tuple(row) for row in self.connection().execute(
+            "SELECT seq, hash, phash FROM blob_phashes WHERE seq > ? AND phash IS NOT NULL ORDER BY seq",
+            (seq,),
+        )]
+
+    def blobs_without_phash(self, limit):
+        """Hashes of live blobs that have not been perceptually hashed yet."""
+        return [row[0] for row in self.connection().execute(
+            "SELECT b.hash FROM blobs b LEFT JOIN blob_phashes p ON p.hash = b.hash "
+            "WHERE p.hash IS NULL AND b.refcount > 0 LIMIT ?",
+            (limit,),
+        )]
+
+    def set_phashes(self, phashes):
+        """Store (blob hash, phash or None) pairs, skipping blobs removed meanwhile."""
+        with self.transaction() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO blob_phashes (hash, phash) SELECT hash, ? FROM blobs WHERE hash = ?",
+                [(phash, blob_hash) for blob_hash, phash in phashes],
+            )
+
+    def prescriptions_with_images(self, blob_hashes):
+        """Ids of prescriptions showing any of the given blobs, oldest first."""
+        if not blob_hashes:
+            return []
+        placeholders = ", ".join("?" * len(blob_hashes))
+        return [row[0] for row in self.connection().execute(
+            f"SELECT id FROM prescriptions WHERE image_hash IN ({placeholders}) ORDER BY created_at, id",
+            blob_hashes,
+        )]
+
+    def prescription_phashes(self, family_member_id=None):
+        """(prescription id, image hash, phash) of prescriptions with a hashed image, oldest first."""
+        query = (
+            "SELECT r.id, r.image_hash, p.phash FROM prescriptions r "
+            "JOIN blob_phashes p ON p.hash = r.image_hash WHERE p.phash IS NOT NULL"
+        )
+        params = ()
+        if family_member_id is not None:
+            query += " AND r.family_member_id = ?"
+            params = (family_member_id,)
+        return [tuple(row) for row in self.connection().execute(query + " ORDER BY r.created_at, r.id", params)]
+
+    # ==================== Analytics Events ====================
+
+    def record_events(self, events):
+        """Append event rows and add them to the daily rollups in one transaction.
+
+        Rows are (device_id, event_type, partner, day, occurred_at, metadata).
+        """
+        rollups = Counter((day, event_type, partner) for _, event_type, partner, day, _, _ in events)
+        with self.transaction() as conn:
+            conn.executemany(
+                "INSERT INTO events (device_id, event_type, partner, day, occurred_at, metadata) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                events,
+            )
+            conn.executemany(
+                "INSERT INTO event_rollups (day, event_type, partner, count) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(day, event_type, partner) DO UPDATE SET count = count + excluded.count",
+                [(*key, count) for key, count in rollups.items()],
+            )
+
+    def event_rollups(self, first_day=None, last_day=None, event_type=None):
+        """Daily event counts per type and partner, oldest first."""
+        conditions, params = [], []
+        if first_day is not None:
+            conditions.append("day >= ?")
+            params.append(first_day)
+        if last_day is not None:
+            conditions.append("day <= ?")
+            params.append(last_day)
+        if event_type is not None:
+            conditions.append("event_type = ?")
+            params.append(event_type)
+        where = f"WHERE {' AND '.join(conditions)} " if conditions else ""
+        rows = self.connection().execute(
+            f"SELECT day, event_type, partner, count FROM event_rollups {where}"
+            "ORDER BY day, event_type, partner",
+            params,
+        )
+        return [{**dict(row), "day": day_to_iso(row["day"])} for row in rows]
+
+    def prune_events(self, before_day):
+        """Delete raw events from before `before_day`; rollups are kept. Returns how many."""
+        with self.transaction() as conn:
+            return conn.execute("DELETE FROM events WHERE day < ?", (before_day,)).rowcount
@@ -0,0 +1,161 @@
+"""
+Resized image variants: thumbnails and screen-sized derivatives.
+
+Rendering runs in a process pool so Pillow's CPU work never blocks the event
+loop. Rendered variants live in a byte-bounded in-memory LRU keyed by
+(blob hash, width) and are spilled to disk, so each variant is rendered once
+and concurrent requests for the same variant share a single render.
+"""
+
+import asyncio
+import io
+import multiprocessing
+import os
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+
+VARIANT_WIDTHS = (160, 320, 640, 1280)
+VARIANT_CONTENT_TYPE = "image/jpeg"
+JPEG_QUALITY = 80
+# A render whose worker dies is retried once on a fresh pool
+RENDER_ATTEMPTS = 2
+
+
+class VariantError(Exception):
+    """The source blob could not be decoded or resized as an image."""
+
+
+def pick_width(requested):
+    """Smallest variant at least `requested` wide, or None to serve the original."""
+    for width in VARIANT_WIDTHS:
+        if requested <= width:
+            return width
+    return None
+
+
+def render_variant(source_path, width, dest_path):
+    """Process pool entry point: resize `source_path` to `width` as a JPEG.
+
+    Writes the result to `dest_path` and returns its bytes.
+    """
+    from PIL import Image, ImageOps
+
+    try:
+        with Image.open(source_path) as image:
+            # Let the JPEG decoder downscale by 1/2..1/8 while decoding
+            image.draft("RGB", (width, width))
+            image = ImageOps.exif_transpose(image)
+            if image.mode in ("RGBA", "LA") or "transparency" in image.info:
+                rgba = image.convert("RGBA")
+                image = Image.new("RGB", rgba.size, "white")
+                image.paste(rgba, mask=rgba.getchannel("A"))
+            else:
+                image = image.convert("RGB")
+            image.thumbnail((width, width * 4), Image.Resampling.LANCZOS)
+            buffer = io.BytesIO()
+            image.save(buffer, "JPEG", quality=JPEG_QUALITY, optimize=True, progressive=True)
+    except Exception as exc:
+        raise VariantError(str(exc)) from None
+
+    data = buffer.getvalue()
+    dest_path = Path(dest_path)
+    dest_path.parent.mkdir(parents=True, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=dest_path.parent)
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.replace(temp_path, dest_path)
+    return data
+
+
+def _read_if_exists(path):
+    try:
+        return path.read_bytes()
+    except FileNotFoundError:
+        return None
+
+
+class VariantCache:
+    """In-memory LRU of rendered variants backed by an on-disk spill directory."""
+
+    def __init__(self, root, max_bytes, workers=None):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.workers = workers
+        self._entries = OrderedDict()
+        self._size = 0
+        self._inflight = {}
+        self._pool = None
+
+    def path(self, blob_hash, width):
+        return self.root / blob_hash[:2] / f"{blob_hash}-{width}.jpg"
+
+    async def get(self, blob_hash, width, source_path):
+        """Return JPEG bytes for the variant, rendering it if necessary."""
+        key = (blob_hash, width)
+        data = self._entries.get(key)
+        if data is not None:
+            self._entries.move_to_end(key)
+            return data
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._load(key, source_path))
+            self._inflight[key] = future
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(future)
+
+    def delete_files(self, blob_hash):
+        """Remove spilled variants of a blob that is being garbage collected."""
+        for width in VARIANT_WIDTHS:
+            try:
+                os.unlink(self.path(blob_hash, width))
+            except FileNotFoundError:
+                pass
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    async def _load(self, key, source_path):
+        loop = asyncio.get_running_loop()
+        path = self.path(*key)
+        data = await loop.run_in_executor(None, _read_if_exists, path)
+        if data is None:
+            data = await self._render(loop, source_path, key[1], path)
+        self._remember(key, data)
+        return data
+
+    async def _render(self, loop, source_path, width, path):
+        for _ in range(RENDER_ATTEMPTS):
+            pool = self._executor()
+            try:
+                return await loop.run_in_executor(pool, render_variant, str(source_path), width, str(path))
+            except BrokenProcessPool:
+                # One dead worker breaks the whole pool; replace it for this and later renders
+                self._drop_pool(pool)
+        raise VariantError("Rendering crashed the worker process")
+
+    def _executor(self):
+        if self._pool is None:
+            # spawn keeps workers independent of the server's threads and sockets
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._pool
+
+    def _drop_pool(self, pool):
+        if self._pool is pool:
+            self._pool = None
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def _remember(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        self._entries[key] = data
+        self._size += len(data)
+        while self._size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._size -= len(evicted)
@@ -0,0 +1,264 @@
+"""
+Bulk import and export of family members and prescriptions.
+
+Both directions stream: export reads rows lazily from one database snapshot
+and emits them in ~64 KB chunks, and import parses the request body line by
+line and commits it in batched transactions. Records are NDJSON objects or
+CSV rows sharing one column layout, with a `type` column naming the entity.
+Images travel by blob hash or inline as a base64 data URI.
+"""
+
+import base64
+import codecs
+import csv
+import io
+import json
+
+from pydantic import ValidationError
+
+from ingest import stage_image_text
+from storage import MEMBER, PRESCRIPTION
+
+FORMATS = ("ndjson", "csv")
+MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+CSV_COLUMNS = (
+    "type", "id", "family_member_id", "name", "relationship", "rx_type", "image_hash",
+    "notes", "date_taken", "expiry_date", "created_at",
+)
+IMAGE_COLUMN = "image_base64"
+
+EXPORT_CHUNK_BYTES = 64 * 1024
+# Multiple of 3 so each slice base64-encodes without padding
+IMAGE_READ_BYTES = 3 * 64 * 1024
+IMPORT_BATCH_SIZE = 5000
+MAX_REPORTED_ERRORS = 1000
+
+
+class ImportAborted(ValueError):
+    """The body could not be read as records at all (as opposed to a bad row)."""
+
+
+def format_for(content_type):
+    return "csv" if content_type.split(";")[0].strip().lower() == "text/csv" else "ndjson"
+
+
+# ==================== Export ====================
+
+def export_chunks(store, blob_store, fmt, family_member_id=None, include_images=False):
+    """Yield the export as byte chunks of roughly EXPORT_CHUNK_BYTES."""
+    parts, size = [], 0
+    for part in _export_parts(store, blob_store, fmt, family_member_id, include_images):
+        parts.append(part)
+        size += len(part)
+        if size >= EXPORT_CHUNK_BYTES:
+            yield "".join(parts).encode("utf-8")
+            parts, size = [], 0
+    if parts:
+        yield "".join(parts).encode("utf-8")
+
+
+def _export_parts(store, blob_store, fmt, family_member_id, include_images):
+    if fmt == "csv":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        header = CSV_COLUMNS + (IMAGE_COLUMN,) if include_images else CSV_COLUMNS
+        writer.writerow(header)
+        yield buffer.getvalue()
+    for entity, row in store.export_rows(family_member_id):
+        content_type = row.pop("image_content_type", None)
+        image_path = None
+        if include_images and row.get("image_hash") and content_type:
+            image_path = blob_store.path(row["image_hash"])
+            if not image_path.exists():
+                image_path = None
+
+        if fmt == "ndjson":
+            line = json.dumps({"type": entity, **row}, ensure_ascii=False)
+            if image_path is None:
+                yield line + "\n"
+                continue
+            yield f'{line[:-1]}, "{IMAGE_COLUMN}": "data:{content_type};base64,'
+            yield from _base64_file(image_path)
+            yield '"}\n'
+        else:
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerow([entity] + [row.get(column) for column in CSV_COLUMNS[1:]])
+            line = buffer.getvalue()
+            if not include_images:
+                yield line
+                continue
+            # The data URI has no quotes to escape, so the cell is streamed as-is
+            yield line.rstrip("\r\n") + ","
+            if image_path is not None:
+                yield f'"data:{content_type};base64,'
+                yield from _base64_file(image_path)
+                yield '"'
+            yield "\r\n"
+
+
+def _base64_file(path):
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(IMAGE_READ_BYTES)
+            if not data:
+                return
+            yield base64.b64encode(data).decode("ascii")
+
+
+# ==================== Import ====================
+
+def iter_lines(chunks, max_line_bytes):
+    """Split an iterable of byte chunks into text lines, keeping the newline.
+
+    Only "\n" ends a line: NDJSON strings may contain other Unicode line
+    separators, and csv handles the "\r" of CRLF itself.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    pending = ""
+    for chunk in chunks:
+        lines = (pending + decoder.decode(chunk)).split("\n")
+        pending = lines.pop()
+        for line in lines:
+            yield line + "\n"
+        if len(pending) > max_line_bytes:
+            raise ImportAborted(f"Record exceeds {max_line_bytes} bytes")
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield pending
+
+
+class Importer:
+    """Parse, validate and apply an import stream in batched transactions.
+
+    `validate(entity, record)` returns the cleaned record dict or raises
+    pydantic's ValidationError. Bad rows are reported by line number and
+    skipped; only the first MAX_REPORTED_ERRORS are kept. If the body itself
+    is unreadable, rows before that point stay imported and `completed` is
+    False.
+    """
+
+    def __init__(self, store, blob_store, validate, max_image_bytes, max_line_bytes, batch_size=IMPORT_BATCH_SIZE):
+        self.store = store
+        self.blob_store = blob_store
+        self.validate = validate
+        self.max_image_bytes = max_image_bytes
+        self.max_line_bytes = max_line_bytes
+        self.batch_size = batch_size
+        self.family_members = 0
+        self.prescriptions = 0
+        self.completed = True
+        self.error_count = 0
+        self.errors = []
+
+    def run(self, chunks, fmt):
+        lines = iter_lines(chunks, self.max_line_bytes)
+        records = self._csv_records(lines) if fmt == "csv" else self._ndjson_records(lines)
+        batch = []
+        try:
+            try:
+                for line, raw in records:
+                    prepared = self._prepare(line, raw)
+                    if prepared is not None:
+                        batch.append(prepared)
+                    if len(batch) >= self.batch_size:
+                        self._flush(batch)
+            except ImportAborted as exc:
+                self.completed = False
+                self._error(None, str(exc))
+            self._flush(batch)
+        finally:
+            for _, _, _, image in batch:
+                if image is not None:
+                    image.discard()
+        return self.summary()
+
+    def summary(self):
+        return {
+            "imported": {"family_members": self.family_members, "prescriptions": self.prescriptions},
+            "completed": self.completed,
+            "error_count": self.error_count,
+            "errors": sorted(self.errors, key=lambda error: error["line"] or 0),
+        }
+
+    def _error(self, line, reason):
+        self.error_count += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({"line": line, "error": reason})
+
+    def _prepare(self, line, raw):
+        entity = raw.pop("type", None) or (PRESCRIPTION if "rx_type" in raw else MEMBER)
+        if entity not in (MEMBER, PRESCRIPTION):
+            self._error(line, f"Unknown record type {entity!r}")
+            return None
+        try:
+            record = self.validate(entity, raw)
+        except ValidationError as exc:
+            self._error(line, "; ".join(
+                f"{'.'.join(str(part) for part in error['loc'])}: {error['msg']}" for error in exc.errors()
+            ))
+            return None
+        image = None
+        image_text = record.pop(IMAGE_COLUMN, None)
+        if image_text:
+            try:
+                image = stage_image_text(self.blob_store, image_text, self.max_image_bytes)
+            except ValueError as exc:
+                self._error(line, str(exc))
+                return None
+        return line, entity, record, image
+
+    def _flush(self, batch):
+        if not batch:
+            return
+        try:
+            members, prescriptions, errors = self.store.import_batch(batch)
+        finally:
+            for _, _, _, image in batch:
+                if image is not None:
+                    image.discard()
+            batch.clear()
+        self.family_members += members
+        self.prescriptions += prescriptions
+        for line, reason in errors:
+            self._error(line, reason)
+
+    def _ndjson_records(self, lines):
+        for number, text in enumerate(lines, start=1):
+            if not text.strip():
+                continue
+            try:
+                raw = json.loads(text)
+            except ValueError as exc:
+                self._error(number, f"Invalid JSON: {exc}")
+                continue
+            if not isinstance(raw, dict):
+                self._error(number, "Expected a JSON object")
+                continue
+            yield number, raw
+
+    def _csv_records(self, lines):
+        # Inline images make for cells far larger than csv's default limit
+        csv.field_size_limit(max(csv.field_size_limit(), self.max_line_bytes))
+        reader = csv.reader(lines)
+        try:
+            header = next(reader)
+        except StopIteration:
+            return
+        except csv.Error as exc:
+            raise ImportAborted(f"Invalid CSV header: {exc}") from None
+        header = [column.strip() for column in header]
+        while True:
+            try:
+                row = next(reader)
+            except StopIteration:
+                return
+            except csv.Error as exc:
+                self._error(reader.line_num, f"Invalid CSV: {exc}")
+                continue
+            if not row:
+                continue
+            if len(row) != len(header):
+                self._error(reader.line_num, f"Expected {len(header)} columns, got {len(row)}")
+                continue
+            yield reader.line_num, {column: value for column, value in zip(header, row) if value != ""}
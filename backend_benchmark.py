@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+"""
+Load test and benchmark for the Vision Rx Vault backend.
+
+Runs the CRUD, stats and cascade-delete scenarios from backend_test.py with
+many concurrent virtual users, and reports throughput and p50/p95/p99
+latency per endpoint. By default the app runs in-process behind an ASGI
+transport against a throwaway data directory; --uvicorn starts a local
+server instead (--workers N runs it under serve.py with N worker
+processes), and --base-url targets one that is already running.
+
+    python backend_benchmark.py --concurrency 32 --iterations 20
+    python backend_benchmark.py --uvicorn --compare test_reports/benchmark_baseline.json
+    python backend_benchmark.py --uvicorn --workers 4
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+from pathlib import Path
+
+import httpx
+
+ROOT_DIR = Path(__file__).parent
+BACKEND_DIR = ROOT_DIR / "backend"
+SCENARIOS = ("crud", "stats", "cascade")
+PERCENTILES = (50, 95, 99)
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, -(-pct * len(sorted_values) // 100))
+    return sorted_values[rank - 1]
+
+
+def summarize(samples, errors, duration):
+    latencies = sorted(samples)
+    stats = {
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput_rps": round(len(latencies) / duration, 1) if duration else 0.0,
+        "mean_ms": round(sum(latencies) / len(latencies) * 1000, 3) if latencies else 0.0,
+        "max_ms": round(latencies[-1] * 1000, 3) if latencies else 0.0,
+    }
+    for pct in PERCENTILES:
+        stats[f"p{pct}_ms"] = round(percentile(latencies, pct) * 1000, 3)
+    return stats
+
+
+class VisionRxBenchmark:
+    def __init__(self, client, concurrency, iterations, prescriptions, image_bytes):
+        self.client = client
+        self.concurrency = concurrency
+        self.iterations = iterations
+        self.prescriptions = prescriptions
+        self.image_bytes = image_bytes
+        self.samples = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def log(self, message, level="INFO"):
+        """Log benchmark messages"""
+        print(f"[{level}] {message}", file=sys.stderr)
+
+    async def call(self, endpoint, method, url, expect=200, **kwargs):
+        """Issue one request, recording its latency under `endpoint`."""
+        started = time.perf_counter()
+        try:
+            response = await self.client.request(method, url, **kwargs)
+        except httpx.HTTPError as exc:
+            self.samples[endpoint].append(time.perf_counter() - started)
+            self.errors[endpoint] += 1
+            self.log(f"{endpoint}: {exc}", "ERROR")
+            return None
+        self.samples[endpoint].append(time.perf_counter() - started)
+        if response.status_code != expect:
+            self.errors[endpoint] += 1
+            return None
+        return response
+
+    def image(self):
+        return "data:image/jpeg;base64," + base64.b64encode(os.urandom(self.image_bytes)).decode()
+
+    def prescription(self, member_id, index, with_image=True):
+        return {
+            "family_member_id": member_id,
+            "rx_type": "eyeglass" if index % 2 else "contact",
+            "image_base64": self.image() if with_image and self.image_bytes else "",
+            "notes": f"Benchmark prescription {index}",
+            "date_taken": "2025-01-15",
+            "expiry_date": f"2027-{index % 12 + 1:02d}-15",
+        }
+
+    async def create_member(self, name):
+        response = await self.call(
+            "POST /family-members", "POST", "/family-members", json={"name": name, "relationship": "Self"}
+        )
+        return response.json()["id"] if response else None
+
+    # ----- scenarios: each runs one iteration for one virtual user
+
+    async def crud(self, user, iteration):
+        """The family member and prescription CRUD flow from backend_test.py."""
+        member_id = await self.create_member(f"User {user}-{iteration}")
+        if member_id is None:
+            return
+        await self.call("GET /family-members", "GET", "/family-members")
+        await self.call("GET /family-members/{id}", "GET", f"/family-members/{member_id}")
+        await self.call(
+            "PUT /family-members/{id}", "PUT", f"/family-members/{member_id}", json={"name": f"Updated {user}"}
+        )
+        prescription_ids = []
+        for index in range(self.prescriptions):
+            response = await self.call(
+                "POST /prescriptions", "POST", "/prescriptions", json=self.prescription(member_id, index)
+            )
+            if response:
+                prescription_ids.append(response.json()["id"])
+        await self.call(
+            "GET /prescriptions?family_member_id", "GET", "/prescriptions", params={"family_member_id": member_id}
+        )
+        for prescription_id in prescription_ids:
+            await self.call("GET /prescriptions/{id}", "GET", f"/prescriptions/{prescription_id}")
+            await self.call(
+                "PUT /prescriptions/{id}", "PUT", f"/prescriptions/{prescription_id}",
+                json={"notes": "Updated notes", "expiry_date": "2028-01-01"},
+            )
+        for prescription_id in prescription_ids:
+            await self.call("DELETE /prescriptions/{id}", "DELETE", f"/prescriptions/{prescription_id}")
+        await self.call("DELETE /family-members/{id}", "DELETE", f"/family-members/{member_id}")
+
+    async def stats(self, user, iteration):
+        await self.call("GET /stats", "GET", "/stats")
+        await self.call("GET /stats?expiring_within_days", "GET", "/stats", params={"expiring_within_days": 90})
+        await self.call("GET /prescriptions", "GET", "/prescriptions")
+
+    async def cascade(self, user, iteration):
+        """Delete a member with prescriptions and check none survive."""
+        member_id = await self.create_member(f"Cascade {user}-{iteration}")
+        if member_id is None:
+            return
+        for index in range(self.prescriptions):
+            await self.call("POST /prescriptions", "POST", "/prescriptions", json=self.prescription(member_id, index))
+        await self.call("DELETE /family-members/{id}", "DELETE", f"/family-members/{member_id}")
+        response = await self.call(
+            "GET /prescriptions?family_member_id", "GET", "/prescriptions", params={"family_member_id": member_id}
+        )
+        if response is not None and response.json():
+            self.errors["cascade_delete_leftovers"] += 1
+
+    async def seed(self, members):
+        """Preload members with prescriptions through /import so lists and stats have data."""
+        lines = []
+        for member in range(members):
+            member_id = f"benchmark-seed-{member}"
+            lines.append({"type": "family_member", "id": member_id, "name": f"Seed {member}", "relationship": "Self"})
+            for index in range(self.prescriptions):
+                lines.append({"type": "prescription", **self.prescription(member_id, index, with_image=False)})
+        body = "".join(json.dumps(line) + "\n" for line in lines)
+        response = await self.client.post(
+            "/import", content=body, headers={"content-type": "application/x-ndjson"}, timeout=None
+        )
+        response.raise_for_status()
+        self.log(f"Seeded {response.json()['imported']}")
+
+    async def run_scenario(self, name):
+        self.samples.clear()
+        self.errors.clear()
+        scenario = getattr(self, name)
+
+        async def user(number):
+            for iteration in range(self.iterations):
+                await scenario(number, iteration)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(user(number) for number in range(self.concurrency)))
+        duration = time.perf_counter() - started
+        endpoints = {
+            endpoint: summarize(samples, self.errors.get(endpoint, 0), duration)
+            for endpoint, samples in sorted(self.samples.items())
+        }
+        total = sum(len(samples) for samples in self.samples.values())
+        self.log(f"{name}: {total} requests in {duration:.2f}s ({total / duration:.0f} req/s)")
+        return {
+            "duration_s": round(duration, 3),
+            "requests": total,
+            "errors": sum(self.errors.values()),
+            "throughput_rps": round(total / duration, 1),
+            "checks_failed": {k: v for k, v in self.errors.items() if k not in self.samples},
+            "endpoints": endpoints,
+        }
+
+
+def print_report(results):
+    for name, scenario in results["scenarios"].items():
+        print(f"\n== {name}: {scenario['throughput_rps']} req/s, {scenario['errors']} errors ==")
+        print(f"{'endpoint':40} {'count':>7} {'err':>5} {'rps':>9} {'p50':>8} {'p95':>8} {'p99':>8}")
+        for endpoint, stats in scenario["endpoints"].items():
+            print(
+                f"{endpoint:40} {stats['requests']:>7} {stats['errors']:>5} {stats['throughput_rps']:>9} "
+                f"{stats['p50_ms']:>8} {stats['p95_ms']:>8} {stats['p99_ms']:>8}"
+            )
+
+
+def compare(results, baseline, max_regression):
+    """Print p95 changes against a saved run; return endpoints that regressed."""
+    regressions = []
+    print(f"\n== Compared with {baseline['meta']['started_at']} (p95 ms) ==")
+    if baseline["meta"]["target"] != results["meta"]["target"]:
+        print(f"Note: baseline ran against {baseline['meta']['target']}, not {results['meta']['target']}")
+    for name, scenario in results["scenarios"].items():
+        previous = baseline["scenarios"].get(name, {}).get("endpoints", {})
+        for endpoint, stats in scenario["endpoints"].items():
+            if endpoint not in previous or not previous[endpoint]["p95_ms"]:
+                continue
+            before, after = previous[endpoint]["p95_ms"], stats["p95_ms"]
+            change = (after - before) / before
+            flag = "  REGRESSION" if change > max_regression else ""
+            print(f"{name:8} {endpoint:40} {before:>8} -> {after:>8} ({change:+.0%}){flag}")
+            if flag:
+                regressions.append(f"{name} {endpoint}")
+    return regressions
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def wait_until_ready(base_url, process):
+    async with httpx.AsyncClient() as client:
+        for _ in range(100):
+            if process.poll() is not None:
+                raise RuntimeError("uvicorn exited during startup")
+            try:
+                if (await client.get(f"{base_url}/readyz")).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.1)
+    raise RuntimeError("uvicorn did not become ready")
+
+
+async def run(args):
+    data_dir = tempfile.mkdtemp(prefix="rx-benchmark-")
+    # Every virtual user shares one client address, so a per-client rate
+    # limit would only measure the limiter
+    os.environ.setdefault("RATE_LIMIT_PER_SECOND", "0")
+    process = None
+    lifespan = None
+    if args.base_url:
+        target = args.base_url
+        client = httpx.AsyncClient(base_url=args.base_url.rstrip("/") + "/api", timeout=args.timeout)
+    elif args.uvicorn:
+        port = free_port()
+        target = f"http://127.0.0.1:{port}"
+        if args.workers > 1:
+            command = ["serve.py", "--host", "127.0.0.1", "--workers", str(args.workers)]
+        else:
+            command = ["-m", "uvicorn", "server:app"]
+        process = subprocess.Popen(
+            [sys.executable, *command, "--port", str(port), "--log-level", "warning"],
+            cwd=BACKEND_DIR, env={**os.environ, "DATA_DIR": data_dir},
+        )
+        await wait_until_ready(target, process)
+        limits = httpx.Limits(max_connections=args.concurrency)
+        client = httpx.AsyncClient(base_url=f"{target}/api", timeout=args.timeout, limits=limits)
+    else:
+        target = "asgi"
+        os.environ["DATA_DIR"] = data_dir
+        sys.path.insert(0, str(BACKEND_DIR))
+        import server
+
+        lifespan = server.app.router.lifespan_context(server.app)
+        await lifespan.__aenter__()
+        client = httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=server.app), base_url="http://benchmark/api", timeout=args.timeout
+        )
+
+    benchmark = VisionRxBenchmark(client, args.concurrency, args.iterations, args.prescriptions, args.image_bytes)
+    results = {
+        "meta": {
+            "started_at": datetime.now(timezone.utc).isoformat(),
+            "target": target,
+            "workers": args.workers if args.uvicorn else None,
+            "concurrency": args.concurrency,
+            "iterations": args.iterations,
+            "prescriptions_per_member": args.prescriptions,
+            "image_bytes": args.image_bytes,
+            "seed_members": args.seed_members,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "git_commit": git_commit(),
+        },
+        "scenarios": {},
+    }
+    try:
+        if args.seed_members:
+            await benchmark.seed(args.seed_members)
+        for name in args.scenarios:
+            results["scenarios"][name] = await benchmark.run_scenario(name)
+    finally:
+        await client.aclose()
+        if lifespan is not None:
+            await lifespan.__aexit__(None, None, None)
+        if process is not None:
+            process.terminate()
+            process.wait()
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument("--base-url", help="benchmark a running server, e.g. http://localhost:8001")
+    target.add_argument("--uvicorn", action="store_true", help="start a local uvicorn on a free port")
+    parser.add_argument("--scenarios", type=lambda s: s.split(","), default=list(SCENARIOS),
+                        help=f"comma-separated subset of {','.join(SCENARIOS)}")
+    parser.add_argument("--workers", type=int, default=1, help="server worker processes with --uvicorn")
+    parser.add_argument("--concurrency", type=int, default=16, help="concurrent virtual users")
+    parser.add_argument("--iterations", type=int, default=10, help="scenario iterations per user")
+    parser.add_argument("--prescriptions", type=int, default=3, help="prescriptions per member")
+    parser.add_argument("--image-bytes", type=int, default=4096, help="size of each uploaded image")
+    parser.add_argument("--seed-members", type=int, default=100, help="members preloaded before the run")
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--output", type=Path, help="JSON results path (default test_reports/benchmark_<time>.json)")
+    parser.add_argument("--compare", type=Path, help="earlier results JSON to compare p95 latency against")
+    parser.add_argument("--max-regression", type=float, default=0.2,
+                        help="fail when a p95 grows by more than this fraction (default 0.2)")
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    results = asyncio.run(run(args))
+    print_report(results)
+
+    output = args.output or ROOT_DIR / "test_reports" / f"benchmark_{datetime.now():%Y%m%d-%H%M%S}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(results, indent=2))
+    print(f"\nResults saved to {output}")
+
+    failed = any(scenario["errors"] for scenario in results["scenarios"].values())
+    if args.compare:
+        regressions = compare(results, json.loads(args.compare.read_text()), args.max_regression)
+        failed = failed or bool(regressions)
+    sys.exit(1 if failed else 0)
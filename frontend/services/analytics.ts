@@ -1,12 +1,12 @@
-// Analytics service - no-op implementation (frontend-only app)
-// All analytics methods are kept for API compatibility but don't send data anywhere
+// Analytics service - events are batched to the backend's /api/events when
+// EXPO_PUBLIC_BACKEND_URL is set, and are a no-op otherwise (frontend-only app)
 
 import { Platform } from "react-native";
 import AsyncStorage from "@react-native-async-storage/async-storage";
 
 const DEVICE_ID_KEY = "@optical_rx_device_id";
 
-// Generate or retrieve a persistent device ID (kept for potential future use)
+// Generate or retrieve a persistent device ID (events are keyed by it)
 export const getDeviceId = async (): Promise<string> => {
   try {
     let deviceId = await AsyncStorage.getItem(DEVICE_ID_KEY);
@@ -20,13 +20,65 @@ export const getDeviceId = async (): Promise<string> => {
   }
 };
 
-// Track analytics event - no-op (no backend)
+type EventType = "app_open" | "ad_click" | "affiliate_click";
+
+interface QueuedEvent {
+  type: EventType;
+  occurred_at: string;
+  metadata: Record<string, any>;
+}
+
+// Events are only sent when a backend is configured; otherwise tracking is a no-op
+const EVENTS_URL = process.env.EXPO_PUBLIC_BACKEND_URL
+  ? `${process.env.EXPO_PUBLIC_BACKEND_URL}/api/events`
+  : null;
+const FLUSH_DELAY_MS = 10000;
+const FLUSH_BATCH_SIZE = 20;
+// Oldest events are dropped past this while the backend is unreachable
+const MAX_QUEUED_EVENTS = 500;
+
+let queue: QueuedEvent[] = [];
+let flushTimer: ReturnType<typeof setTimeout> | null = null;
+
+// Send queued events in one request; they are kept for the next flush on failure
+const flushEvents = async () => {
+  flushTimer = null;
+  if (!EVENTS_URL || queue.length === 0) return;
+  const batch = queue;
+  queue = [];
+  try {
+    const deviceId = await getDeviceId();
+    const response = await fetch(EVENTS_URL, {
+      method: "POST",
+      // The backend rate-limits per X-Device-Id
+      headers: { "Content-Type": "application/json", "X-Device-Id": deviceId },
+      body: JSON.stringify({ device_id: deviceId, events: batch }),
+    });
+    // Rate-limited and overloaded responses are retried on the next flush
+    if (!response.ok && (response.status === 429 || response.status >= 500)) {
+      throw new Error(`HTTP ${response.status}`);
+    }
+  } catch {
+    queue = [...batch, ...queue].slice(-MAX_QUEUED_EVENTS);
+  }
+};
+
+// Track analytics event - batched and sent to the backend when one is configured
 export const trackEvent = async (
-  eventType: "app_open" | "ad_click" | "affiliate_click",
+  eventType: EventType,
   metadata?: Record<string, any>
 ) => {
-  // No-op - frontend only app, no analytics backend
-  console.log(`Analytics event (not sent): ${eventType}`, metadata);
+  if (!EVENTS_URL) {
+    console.log(`Analytics event (not sent): ${eventType}`, metadata);
+    return;
+  }
+  queue.push({ type: eventType, occurred_at: new Date().toISOString(), metadata: metadata ?? {} });
+  if (queue.length > MAX_QUEUED_EVENTS) queue.shift();
+  if (queue.length >= FLUSH_BATCH_SIZE) {
+    await flushEvents();
+  } else if (!flushTimer) {
+    flushTimer = setTimeout(flushEvents, FLUSH_DELAY_MS);
+  }
 };
 
 // Track app open
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark of list response serialization in the backend.
+
+Encodes the same prescriptions to JSON bytes the way each path does it and
+reports the best per-record cost over several rounds:
+
+- fastapi: dict rows validated into models, jsonable_encoder, json.dumps
+  (FastAPI's default handling of a response_model route)
+- pydantic: dict rows through a List[Prescription] TypeAdapter
+- orjson: PrescriptionRecords (records.py) encoded by orjson directly
+
+    python serialization_benchmark.py --records 10000 --rounds 5
+"""
+
+import argparse
+import json
+import sys
+import time
+import uuid
+from dataclasses import asdict
+from pathlib import Path
+from typing import List
+
+ROOT_DIR = Path(__file__).parent
+sys.path.insert(0, str(ROOT_DIR / "backend"))
+
+import orjson  # noqa: E402
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+from pydantic import BaseModel, TypeAdapter  # noqa: E402
+
+from records import PrescriptionRecord  # noqa: E402
+
+
+class Prescription(BaseModel):
+    # Mirrors server.Prescription without importing the app and its data dir
+    id: str
+    family_member_id: str
+    rx_type: str
+    image_hash: str | None = None
+    notes: str
+    date_taken: str
+    expiry_date: str | None = None
+    created_at: str
+
+
+def make_records(count):
+    member_id = str(uuid.uuid4())
+    return [
+        PrescriptionRecord(
+            id=str(uuid.uuid4()),
+            family_member_id=member_id,
+            rx_type="contact" if index % 3 == 0 else "eyeglass",
+            image_hash=f"{index:064x}" if index % 2 else None,
+            notes=f"Prescription {index} - anti-glare coating",
+            date_taken="01/15/2024",
+            expiry_date="01/15/2026" if index % 4 else None,
+            created_at=f"2024-01-15T10:{index // 60 % 60:02d}:{index % 60:02d}.000000+00:00",
+        )
+        for index in range(count)
+    ]
+
+
+def fastapi_default(rows):
+    return json.dumps(jsonable_encoder([Prescription.model_validate(row) for row in rows])).encode("utf-8")
+
+
+def pydantic_adapter(rows, adapter=TypeAdapter(List[Prescription])):
+    return adapter.dump_json(adapter.validate_python(rows))
+
+
+def orjson_records(records):
+    return orjson.dumps(records)
+
+
+def best_time(encode, rows, rounds):
+    best = float("inf")
+    for _ in range(rounds):
+        started = time.perf_counter()
+        encode(rows)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--records", type=int, default=10000, help="items per list")
+    parser.add_argument("--rounds", type=int, default=5, help="rounds per path; the fastest is reported")
+    args = parser.parse_args()
+
+    records = make_records(args.records)
+    dicts = [asdict(record) for record in records]
+    if json.loads(orjson_records(records)) != json.loads(pydantic_adapter(dicts)):
+        sys.exit("orjson and pydantic outputs differ")
+
+    paths = (
+        ("fastapi", fastapi_default, dicts),
+        ("pydantic", pydantic_adapter, dicts),
+        ("orjson", orjson_records, records),
+    )
+    baseline = None
+    print(f"{args.records} records, best of {args.rounds} rounds")
+    print(f"{'path':<10} {'total ms':>10} {'us/record':>10} {'speedup':>8}")
+    for name, encode, rows in paths:
+        seconds = best_time(encode, rows, args.rounds)
+        baseline = baseline or seconds
+        print(f"{name:<10} {seconds * 1000:>10.2f} {seconds / args.records * 1e6:>10.3f} {baseline / seconds:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent / "backend"
+sys.path.insert(0, str(BACKEND_DIR))
+
+# server reads its settings at import time; point it at a throwaway data
+# directory and turn off the per-client rate limit every test would share
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="rx-tests-"))
+os.environ.setdefault("RATE_LIMIT_PER_SECOND", "0")
+
+from blobs import BlobStore  # noqa: E402
+from dates import day_to_iso, today_day  # noqa: E402
+from storage import Store  # noqa: E402
+
+
+def days_from_now(days):
+    """ISO date `days` after today, by the UTC day the store buckets expiry on."""
+    return day_to_iso(today_day() + days)
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = Store(tmp_path / "rx.db")
+    store.open()
+    yield store
+    store.close()
+
+
+@pytest.fixture
+def blob_store(tmp_path):
+    blob_store = BlobStore(tmp_path / "blobs")
+    blob_store.open()
+    return blob_store
+
+
+@pytest.fixture(scope="session")
+def client():
+    from fastapi.testclient import TestClient
+
+    import server
+
+    with TestClient(server.app) as client:
+        yield client
+
+
+@pytest.fixture
+def member(store):
+    return store.create_family_member("Alex", "Self")
+
+
+@pytest.fixture
+def add_prescription(store, member):
+    """Create a prescription for `member` (or another member) with defaults filled in."""
+
+    def add(image=None, member=member, **fields):
+        data = {"family_member_id": member["id"], "rx_type": "eyeglass", "notes": "", "date_taken": "", **fields}
+        return store.create_prescription(data, image)
+
+    return add
@@ -0,0 +1,68 @@
+import asyncio
+
+from uvicorn.middleware.proxy_headers import ProxyHeadersMiddleware
+
+from admission import AdmissionMiddleware, TokenBuckets
+from metrics import Registry
+
+INGRESS = ("10.0.0.5", 40000)
+
+
+async def ok(scope, receive, send):
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": b""})
+
+
+def statuses(app, requests):
+    """Status of each (headers, peer) request, sent one after another."""
+
+    async def run():
+        results = []
+        for headers, client in requests:
+            sent = []
+
+            async def send(message):
+                sent.append(message)
+
+            scope = {
+                "type": "http", "path": "/api/stats", "scheme": "http", "client": client,
+                "headers": [(name.encode(), value.encode()) for name, value in headers.items()],
+            }
+            await app(scope, None, send)
+            results.append(sent[0]["status"])
+        return results
+
+    return asyncio.run(run())
+
+
+def admission(app=ok):
+    return AdmissionMiddleware(
+        app, Registry(), rate=0.001, burst=1, max_keys=100, max_concurrent=0, max_queued=0, queue_timeout=1,
+    )
+
+
+def test_buckets_refill_and_evict_the_idlest_key():
+    buckets = TokenBuckets(rate=2, burst=1, max_keys=2)
+    assert buckets.take("a", 0) == 0
+    assert buckets.take("a", 0) == 0.5
+    assert buckets.take("a", 0.5) == 0
+    buckets.take("b", 1)
+    buckets.take("c", 1)
+    assert len(buckets) == 2
+    assert buckets.take("a", 1) == 0
+
+
+def test_device_id_is_the_key():
+    app = admission()
+    assert statuses(app, [
+        ({"x-device-id": "phone"}, INGRESS),
+        ({"x-device-id": "phone"}, ("10.0.0.6", 1)),
+        ({"x-device-id": "tablet"}, INGRESS),
+    ]) == [200, 429, 200]
+
+
+def test_keyless_clients_behind_a_trusted_proxy_get_their_own_buckets():
+    requests = [({"x-forwarded-for": "203.0.113.1"}, INGRESS), ({"x-forwarded-for": "203.0.113.2"}, INGRESS)]
+    # Untrusted, the ingress address is all there is to go on
+    assert statuses(ProxyHeadersMiddleware(admission(), trusted_hosts="127.0.0.1"), requests) == [200, 429]
+    assert statuses(ProxyHeadersMiddleware(admission(), trusted_hosts=INGRESS[0]), requests) == [200, 200]
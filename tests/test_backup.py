@@ -0,0 +1,169 @@
+import hashlib
+import io
+import json
+import tarfile
+
+import pytest
+
+from backup import BackupError, ChunkedUploads, backup_chunks, restore_archive
+from blobs import BlobStore
+from storage import Store
+from transfer import Importer
+
+PNG = bytes.fromhex(
+    "89504e470d0a1a0a0000000d4948445200000001000000010806000000"
+    "1f15c4890000000d49444154789c63f8cf50030003860180"
+    "5a347d6b0000000049454e44ae426082"
+)
+
+
+@pytest.fixture
+def archive(tmp_path, store, blob_store, member, add_prescription):
+    add_prescription(blob_store.stage(PNG, "image/png"), expiry_date="2030-01-02")
+    add_prescription(rx_type="contact", notes="no photo")
+    path = tmp_path / "backup.tar"
+    path.write_bytes(b"".join(backup_chunks(store, blob_store, tmp_path)))
+    return path
+
+
+@pytest.fixture
+def target(tmp_path):
+    from server import validate_import_record
+
+    store = Store(tmp_path / "target.db")
+    store.open()
+    blob_store = BlobStore(tmp_path / "target-blobs")
+    blob_store.open()
+    importer = Importer(store, blob_store, validate_import_record, len(PNG), 1024 * 1024)
+    yield store, blob_store, importer
+    store.close()
+
+
+def rows(store):
+    return sorted(store.export_rows(), key=lambda item: (item[0], item[1]["id"]))
+
+
+def rewrite(path, transform):
+    """Rebuild the archive at `path` with (name, data) entries passed through `transform`."""
+    with tarfile.open(path) as source:
+        entries = [(member.name, source.extractfile(member).read()) for member in source]
+    with tarfile.open(path, "w") as archive:
+        for name, data in transform(entries):
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+
+
+def test_backup_restores_into_an_empty_store(archive, store, blob_store, target):
+    target_store, target_blobs, importer = target
+    with tarfile.open(archive) as tar:
+        assert tar.getnames()[0] == "manifest.json"
+        assert tar.getnames()[-1] == "records.ndjson"
+
+    result = restore_archive(archive, target_store, target_blobs, importer, len(PNG))
+    assert result["images"] == 1
+    assert result["imported"] == {"family_members": 1, "prescriptions": 2}
+    assert rows(target_store) == rows(store)
+    image_hash = hashlib.sha256(PNG).hexdigest()
+    assert target_blobs.path(image_hash).read_bytes() == PNG
+    assert target_store.get_blob(image_hash)["refcount"] == 1
+
+    again = restore_archive(archive, target_store, target_blobs, importer, len(PNG))
+    assert again["images"] == 0
+    assert rows(target_store) == rows(store)
+    assert target_store.get_blob(image_hash)["refcount"] == 1
+
+
+@pytest.mark.parametrize("transform, message", [
+    (lambda entries: entries[1:], "missing manifest"),
+    (lambda entries: entries[:-1], "missing records"),
+    (lambda entries: [(name, b"{}" if name == "manifest.json" else data) for name, data in entries],
+     "Not a backup archive"),
+    (lambda entries: [(name, data + b"\0" if name.startswith("images/") else data) for name, data in entries],
+     "does not match its checksum"),
+    (lambda entries: entries[:1] + [("extra.txt", b"")] + entries[1:], "Unexpected archive entry"),
+])
+def test_bad_archives_are_rejected(archive, target, transform, message):
+    rewrite(archive, transform)
+    target_store, target_blobs, importer = target
+    with pytest.raises(BackupError, match=message):
+        restore_archive(archive, target_store, target_blobs, importer, 2 * len(PNG))
+    assert list(target_blobs.tmp_dir.iterdir()) == []
+
+
+def test_restore_rejects_non_image_types(archive, target):
+    def relabel(entries):
+        for name, data in entries:
+            if name == "manifest.json":
+                manifest = json.loads(data)
+                manifest["images"] = {image_hash: "text/html" for image_hash in manifest["images"]}
+                data = json.dumps(manifest).encode()
+            yield name, data
+
+    rewrite(archive, relabel)
+    with pytest.raises(BackupError, match="unsupported type"):
+        restore_archive(archive, *target, len(PNG))
+
+
+def test_chunked_upload_resumes_in_any_order(tmp_path, archive):
+    data = archive.read_bytes()
+    uploads = ChunkedUploads(tmp_path / "uploads", 4096, len(data), 60)
+    uploads.open()
+    status = uploads.create(len(data), hashlib.sha256(data).hexdigest())
+    upload_id = status["upload_id"]
+    chunks = [data[start:start + 4096] for start in range(0, len(data), 4096)]
+    assert status["missing"] == list(range(len(chunks)))
+
+    for index in reversed(range(1, len(chunks))):
+        writer = uploads.chunk_writer(uploads.get(upload_id), index, hashlib.sha256(chunks[index]).hexdigest())
+        writer.write(chunks[index])
+        status = writer.finish()
+    assert status["missing"] == [0]
+    with pytest.raises(BackupError, match="missing"):
+        uploads.complete(upload_id)
+
+    writer = uploads.chunk_writer(uploads.get(upload_id), 0, hashlib.sha256(chunks[0]).hexdigest())
+    writer.write(b"x" + chunks[0][1:])
+    with pytest.raises(BackupError, match="checksum"):
+        writer.finish()
+    assert uploads.status(uploads.get(upload_id))["missing"] == [0]
+
+    writer = uploads.chunk_writer(uploads.get(upload_id), 0, hashlib.sha256(chunks[0]).hexdigest())
+    writer.write(chunks[0])
+    assert writer.finish()["missing"] == []
+    assert uploads.complete(upload_id).read_bytes() == data
+    with pytest.raises(BackupError, match="already being restored"):
+        uploads.complete(upload_id)
+    assert uploads.delete(upload_id)
+    assert uploads.get(upload_id) is None
+
+
+def test_upload_sizes_are_bounded(tmp_path):
+    uploads = ChunkedUploads(tmp_path / "uploads", 4, 10, 60)
+    uploads.open()
+    with pytest.raises(BackupError):
+        uploads.create(11)
+    state = uploads.get(uploads.create(10)["upload_id"])
+    with pytest.raises(BackupError, match="between 0 and 2"):
+        uploads.chunk_writer(state, 3, "0" * 64)
+    writer = uploads.chunk_writer(state, 2, "0" * 64)
+    with pytest.raises(BackupError, match="must be 2 bytes"):
+        writer.write(b"abc")
+    writer.abort()
+    assert uploads.get("../etc") is None
+
+
+def test_backup_restore_endpoints(client):
+    member = client.post("/api/family-members", json={"name": "Sam", "relationship": "Self"}).json()
+    data = client.get("/api/backup").content
+    status = client.post("/api/restore/uploads", json={"size": len(data)}).json()
+    url = f"/api/restore/uploads/{status['upload_id']}"
+    for index in range(status["chunk_count"]):
+        chunk = data[index * status["chunk_size"]:(index + 1) * status["chunk_size"]]
+        response = client.put(f"{url}/chunks/{index}", content=chunk,
+                              headers={"x-chunk-sha256": hashlib.sha256(chunk).hexdigest()})
+        assert response.status_code == 200
+    result = client.post(f"{url}/complete").json()
+    assert result["completed"] and result["error_count"] == 0
+    assert client.get(f"/api/family-members/{member['id']}").json()["name"] == "Sam"
+    assert client.get(url).status_code == 404
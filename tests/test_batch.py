@@ -0,0 +1,81 @@
+import pytest
+
+from storage import BatchFailed
+from tests.conftest import days_from_now
+
+
+def create_rx(temp_id, member_id, **data):
+    return {
+        "op": "create", "entity": "prescription", "temp_id": temp_id,
+        "data": {"family_member_id": member_id, "rx_type": "contact", "notes": "", "date_taken": "", **data},
+    }
+
+
+def reminder_count(store):
+    return store.connection().execute("SELECT count(*) FROM reminders").fetchone()[0]
+
+
+def test_creating_then_deleting_in_one_batch_leaves_no_reminders(store, member):
+    store.apply_batch([
+        create_rx("a", member["id"], expiry_date=days_from_now(10)),
+        {"op": "delete", "entity": "prescription", "id": "$a"},
+    ])
+    assert reminder_count(store) == 0
+    assert store.next_reminder_due() is None
+    assert store.get_stats(30)["total_prescriptions"] == 0
+
+
+def test_deleting_a_member_created_in_the_same_batch(store):
+    results, temp_ids = store.apply_batch([
+        {"op": "create", "entity": "family_member", "temp_id": "m", "data": {"name": "Robin", "relationship": "Child"}},
+        create_rx("a", "$m", expiry_date=days_from_now(5)),
+        {"op": "update", "entity": "prescription", "id": "$a", "data": {"expiry_date": days_from_now(50)}},
+        {"op": "delete", "entity": "family_member", "id": "$m"},
+    ])
+    assert results[-1]["prescriptions_deleted"] == 1
+    assert reminder_count(store) == 0
+    assert store.get_stats(30) == {
+        "total_prescriptions": 0, "eyeglass_prescriptions": 0, "contact_prescriptions": 0,
+        "expiring_soon": 0, "family_members": 0,
+    }
+    assert store.get_stats(30, temp_ids["m"])["total_prescriptions"] == 0
+
+
+def test_failed_batch_rolls_everything_back(store, member, add_prescription):
+    kept = add_prescription(expiry_date=days_from_now(20))
+    before = store.get_stats(30), reminder_count(store)
+    with pytest.raises(BatchFailed) as failure:
+        store.apply_batch([
+            create_rx("a", member["id"], expiry_date=days_from_now(3)),
+            {"op": "delete", "entity": "prescription", "id": kept["id"]},
+            {"op": "update", "entity": "prescription", "id": "missing", "data": {"notes": "x"}},
+        ])
+    assert failure.value.index == 2
+    assert store.get_prescription(kept["id"]) is not None
+    assert (store.get_stats(30), reminder_count(store)) == before
+
+
+def test_orphaned_reminders_are_ignored_and_purged_once(store, add_prescription):
+    live = add_prescription(expiry_date=days_from_now(60))
+    live_due = store.next_reminder_due()
+    with store.transaction() as conn:
+        conn.execute("INSERT INTO reminders (prescription_id, days_before, due_at) VALUES ('gone', 1, 0)")
+    assert store.next_reminder_due() == live_due
+
+    # Opening an older database purges them once
+    with store.transaction() as conn:
+        conn.execute("DELETE FROM sync_meta WHERE key = 'orphan_reminders_purged'")
+    store.close()
+    store.open()
+    assert store.connection().execute(
+        "SELECT count(*) FROM reminders WHERE prescription_id <> ?", (live["id"],)
+    ).fetchone()[0] == 0
+
+
+def test_orphan_purge_does_not_run_on_every_open(store):
+    statements = []
+    store.close()
+    store.connection().set_trace_callback(statements.append)
+    store.open()
+    store.connection().set_trace_callback(None)
+    assert not [sql for sql in statements if sql.startswith("DELETE FROM reminders")]
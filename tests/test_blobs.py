@@ -0,0 +1,133 @@
+import base64
+import io
+
+import pytest
+
+from backup import BackupError, _restore_image
+from ingest import stage_image_text
+
+PNG = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk+M9QDwADhgGAWjR9awAAAABJRU5ErkJggg=="
+)
+
+
+def data_uri(data, content_type="image/png"):
+    return f"data:{content_type};base64,{base64.b64encode(data).decode()}"
+
+
+def refcount(store, blob_hash):
+    row = store.connection().execute("SELECT refcount FROM blobs WHERE hash = ?", (blob_hash,)).fetchone()
+    return None if row is None else row[0]
+
+
+def create(store, member, image=None, **fields):
+    prescription = {"family_member_id": member["id"], "rx_type": "eyeglass", "notes": "", "date_taken": "", **fields}
+    return store.create_prescription(prescription, image)
+
+
+def test_identical_images_share_one_blob(store, blob_store, member):
+    first = create(store, member, blob_store.stage(PNG, "image/png"))
+    second = create(store, member, blob_store.stage(PNG, "image/png"))
+    assert first["image_hash"] == second["image_hash"]
+    assert refcount(store, first["image_hash"]) == 2
+    assert blob_store.path(first["image_hash"]).read_bytes() == PNG
+    assert list(blob_store.tmp_dir.iterdir()) == []
+
+
+def test_refcount_follows_updates_and_deletes(store, blob_store, member):
+    old = create(store, member, blob_store.stage(PNG, "image/png"))
+    other = create(store, member, blob_store.stage(PNG, "image/png"))
+    replacement = blob_store.stage(PNG + b"\0", "image/png")
+    store.update_prescription(other["id"], {}, replacement)
+    assert refcount(store, old["image_hash"]) == 1
+    assert refcount(store, replacement.hash) == 1
+
+    assert store.delete_prescription(old["id"])
+    assert refcount(store, old["image_hash"]) == 0
+    assert store.get_blob(old["image_hash"]) is None
+
+    store.delete_family_member(member["id"])
+    assert refcount(store, replacement.hash) == 0
+
+
+def test_collect_blobs_removes_only_released_blobs(store, blob_store, member):
+    kept = create(store, member, blob_store.stage(PNG, "image/png"))
+    dropped = create(store, member, blob_store.stage(PNG + b"\0", "image/png"))
+    store.delete_prescription(dropped["id"])
+
+    assert store.collect_blobs("0000", blob_store.delete) == 0
+    assert store.collect_blobs("9999", blob_store.delete) == 1
+    assert refcount(store, dropped["image_hash"]) is None
+    assert not blob_store.exists(dropped["image_hash"])
+    assert blob_store.exists(kept["image_hash"])
+
+
+def test_unreferenced_upload_is_kept_until_collected(store, blob_store, member):
+    image = blob_store.stage(PNG, "image/png")
+    store.add_blob(image)
+    assert refcount(store, image.hash) == 0
+    store.apply_changes([], [{
+        "id": "rx-1", "family_member_id": member["id"], "rx_type": "contact", "image_hash": image.hash,
+        "notes": "", "date_taken": "",
+    }], [], [])
+    assert refcount(store, image.hash) == 1
+    assert store.collect_blobs("9999", blob_store.delete) == 0
+
+
+@pytest.mark.parametrize("content_type", ["image/png", "image/jpeg", "image/webp", "image/heic"])
+def test_data_uri_accepts_app_image_types(blob_store, content_type):
+    with stage_image_text(blob_store, data_uri(PNG, content_type)) as image:
+        assert image.content_type == content_type
+
+
+@pytest.mark.parametrize("content_type", ["text/html", "image/svg+xml", "application/javascript"])
+def test_data_uri_rejects_other_types(blob_store, content_type):
+    with pytest.raises(ValueError, match="Unsupported image type"):
+        stage_image_text(blob_store, data_uri(b"<script>alert(1)</script>", content_type))
+    assert list(blob_store.tmp_dir.iterdir()) == []
+
+
+def test_bare_base64_defaults_to_jpeg(blob_store):
+    with stage_image_text(blob_store, base64.b64encode(PNG).decode()) as image:
+        assert image.content_type == "image/jpeg"
+
+
+def test_restore_rejects_unsupported_image_type(store, blob_store):
+    with pytest.raises(BackupError, match="unsupported type"):
+        _restore_image(store, blob_store, io.BytesIO(b"<svg/>"), "0" * 64, "image/svg+xml")
+
+
+def api_member(client):
+    return client.post("/api/family-members", json={"name": "Sam", "relationship": "Child"}).json()
+
+
+def test_api_rejects_html_data_uri(client):
+    response = client.post("/api/prescriptions", json={
+        "family_member_id": api_member(client)["id"], "rx_type": "eyeglass",
+        "image_base64": data_uri(b"<script>alert(1)</script>", "text/html"),
+    })
+    assert response.status_code == 400
+
+
+def test_api_rejects_raw_upload_of_other_types(client):
+    response = client.post("/api/blobs", content=b"<svg/>", headers={"content-type": "image/svg+xml"})
+    assert response.status_code == 415
+
+
+def test_api_serves_blobs_with_nosniff(client):
+    prescription = client.post("/api/prescriptions", json={
+        "family_member_id": api_member(client)["id"], "rx_type": "eyeglass", "image_base64": data_uri(PNG),
+    }).json()
+    response = client.get(f"/api/blobs/{prescription['image_hash']}")
+    assert response.content == PNG
+    assert response.headers["content-type"] == "image/png"
+    assert response.headers["x-content-type-options"] == "nosniff"
+
+
+def test_api_serves_legacy_unsafe_types_as_bytes(client):
+    import server
+
+    image = server.blob_store.stage(b"<html></html>", "text/html")
+    create(server.store, api_member(client), image)
+    response = client.get(f"/api/blobs/{image.hash}")
+    assert response.headers["content-type"] == "application/octet-stream"
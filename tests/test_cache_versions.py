@@ -0,0 +1,61 @@
+import threading
+
+from storage import MEMBER_PRESCRIPTIONS, MEMBERS_VERSION, PRESCRIPTIONS_VERSION, Store
+
+
+def in_thread(function, *args):
+    result = []
+    thread = threading.Thread(target=lambda: result.append(function(*args)))
+    thread.start()
+    thread.join()
+    return result[0]
+
+
+def test_versions_follow_writes_from_this_and_other_connections(tmp_path, store, member, add_prescription):
+    scope = MEMBER_PRESCRIPTIONS + member["id"]
+    before = store.version(PRESCRIPTIONS_VERSION), store.version(scope), store.version(MEMBERS_VERSION)
+    add_prescription()
+    after = store.version(PRESCRIPTIONS_VERSION), store.version(scope), store.version(MEMBERS_VERSION)
+    assert after[0] > before[0] and after[1] > before[1]
+    assert after[2] == before[2]
+
+    # Another thread has its own connection, like another worker process
+    in_thread(store.update_family_member, member["id"], {"name": "Alexandra"})
+    assert store.version(MEMBERS_VERSION) > after[2]
+    assert store.version(scope) == after[1]
+
+    other = Store(tmp_path / "rx.db")
+    other.open()
+    try:
+        other.create_prescription(
+            {"family_member_id": member["id"], "rx_type": "contact", "notes": "", "date_taken": ""}
+        )
+        assert store.version(scope) > after[1]
+        assert store.version(scope) == other.version(scope)
+    finally:
+        other.close()
+
+
+def test_version_reads_only_the_requested_scope(store, member, add_prescription):
+    add_prescription()
+    in_thread(add_prescription)
+    statements = []
+    store.connection().set_trace_callback(statements.append)
+    try:
+        store.version(PRESCRIPTIONS_VERSION)
+        store.version(PRESCRIPTIONS_VERSION)
+    finally:
+        store.connection().set_trace_callback(None)
+    lookups = [sql for sql in statements if "cache_versions" in sql]
+    assert len(lookups) == 1 and "WHERE scope" in lookups[0]
+
+
+def test_deleting_a_member_drops_their_scope(store, member, add_prescription):
+    scope = MEMBER_PRESCRIPTIONS + member["id"]
+    add_prescription()
+    assert store.version(scope) > 0
+    store.delete_family_member(member["id"])
+    assert store.connection().execute(
+        "SELECT count(*) FROM cache_versions WHERE scope = ?", (scope,)
+    ).fetchone()[0] == 0
+    assert store.version(scope) == 0
@@ -0,0 +1,42 @@
+import pytest
+
+from dates import NO_DAY, day_to_iso, parse_day, parse_days
+
+# Expected results follow frontend/services/dateUtils.ts parseDate
+CASES = [
+    ("2025-06-15", "2025-06-15"),
+    ("06/15/2025", "2025-06-15"),
+    ("6/5/2025", "2025-06-05"),
+    ("  06/15/2025 ", "2025-06-15"),
+    # new Date(year, month - 1, day) rolls an overflowing day into the next month
+    ("02/31/2025", "2025-03-03"),
+    ("2024-02-30", "2024-03-01"),
+    ("04/31/2025", "2025-05-01"),
+    ("2025-06-15T10:30:00Z", "2025-06-15"),
+    ("2025-06-15T23:30:00-02:00", "2025-06-16"),
+    ("2025-06-15T10:30:00.123456", "2025-06-15"),
+    ("June 15, 2025", "2025-06-15"),
+    ("Jun 15, 2025", "2025-06-15"),
+    ("13/01/2025", None),
+    ("00/10/2025", None),
+    ("01/32/2025", None),
+    ("2025-13-01", None),
+    ("2025-00-10", None),
+    ("2025/06/15x", None),
+    ("not a date", None),
+    ("", None),
+    (None, None),
+]
+
+
+@pytest.mark.parametrize("value, expected", CASES)
+def test_parse_day_matches_the_frontend(value, expected):
+    day = parse_day(value)
+    assert (None if day is None else day_to_iso(day)) == expected
+
+
+def test_parse_days_agrees_with_parse_day():
+    values = [value for value, _ in CASES]
+    expected = [NO_DAY if day is None else day for day in map(parse_day, values)]
+    assert parse_days(values).tolist() == expected
+    assert parse_days([]).tolist() == []
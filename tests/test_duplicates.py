@@ -0,0 +1,37 @@
+import base64
+import io
+
+from PIL import Image
+
+
+def photo_uri(color, quality):
+    buffer = io.BytesIO()
+    image = Image.new("RGB", (320, 240), color)
+    image.paste((255, 255, 255), (0, 0, 160, 240))
+    image.save(buffer, "JPEG", quality=quality)
+    return "data:image/jpeg;base64," + base64.b64encode(buffer.getvalue()).decode()
+
+
+def test_duplicates_are_clustered_and_bounded(client, monkeypatch):
+    import server
+
+    member = client.post("/api/family-members", json={"name": "Dana", "relationship": "Self"}).json()
+    created = [
+        client.post("/api/prescriptions", json={
+            "family_member_id": member["id"], "rx_type": "eyeglass", "image_base64": photo_uri((20, 20, 20), quality),
+        }).json()
+        for quality in (95, 60)
+    ]
+    assert created[1]["duplicates"] == [created[0]["id"]]
+
+    params = {"family_member_id": member["id"]}
+    clusters = client.get("/api/prescriptions/duplicates", params=params).json()
+    assert [found["prescription_ids"] for found in clusters] == [[created[0]["id"], created[1]["id"]]]
+
+    monkeypatch.setattr(server, "MAX_DUPLICATE_PHOTOS", 1)
+    response = client.get("/api/prescriptions/duplicates", params=params)
+    assert response.status_code == 400
+    assert "filter by family_member_id" not in response.json()["detail"]
+    response = client.get("/api/prescriptions/duplicates")
+    assert response.status_code == 400
+    assert "filter by family_member_id" in response.json()["detail"]
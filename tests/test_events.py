@@ -0,0 +1,116 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from dates import parse_day
+from events import EventIngestor, EventQueueFull, event_row
+from metrics import Registry
+
+NOW = datetime(2025, 6, 15, 12, 0, tzinfo=timezone.utc)
+
+
+def row(event_type="app_open", occurred_at=NOW, **metadata):
+    return event_row("phone", event_type, metadata, occurred_at, NOW)
+
+
+@pytest.fixture
+def batches(store, monkeypatch):
+    """Sizes of the batches written to the store, in order."""
+    written = []
+    record_events = store.record_events
+
+    def record(events):
+        written.append(len(events))
+        record_events(events)
+
+    monkeypatch.setattr(store, "record_events", record)
+    return written
+
+
+def run(ingestor, scenario):
+    async def main():
+        ingestor.start()
+        try:
+            return await scenario()
+        finally:
+            await ingestor.stop()
+
+    return asyncio.run(main())
+
+
+async def until(condition):
+    while not condition():
+        await asyncio.sleep(0.01)
+
+
+def test_a_full_batch_is_written_without_waiting(store, batches):
+    ingestor = EventIngestor(store, Registry(), batch_size=3, flush_interval=60)
+
+    async def scenario():
+        ingestor.submit([row()] * 7)
+        await asyncio.wait_for(until(lambda: len(batches) == 2), 5)
+        return list(batches)
+
+    # Two full batches go straight out; the straggler waits for the interval
+    assert run(ingestor, scenario) == [3, 3]
+    assert batches == [3, 3, 1]
+
+
+def test_a_partial_batch_is_written_after_the_interval(store, batches):
+    ingestor = EventIngestor(store, Registry(), batch_size=100, flush_interval=0.2)
+
+    async def scenario():
+        ingestor.submit([row()] * 2)
+        await asyncio.sleep(0.05)
+        pending = list(batches)
+        ingestor.submit([row()])
+        await asyncio.wait_for(until(lambda: batches), 5)
+        return pending
+
+    assert run(ingestor, scenario) == []
+    assert batches == [3]
+
+
+def test_a_full_queue_refuses_the_whole_batch(store, batches):
+    ingestor = EventIngestor(store, Registry(), max_queued=3, flush_interval=60)
+
+    async def scenario():
+        ingestor.submit([row()] * 2)
+        with pytest.raises(EventQueueFull):
+            ingestor.submit([row()] * 2)
+        ingestor.submit([row()])
+
+    run(ingestor, scenario)
+    assert batches == [3]
+
+
+def test_rollups_count_per_day_type_and_partner(store):
+    yesterday = NOW - timedelta(days=1)
+    store.record_events([
+        row(), row(), row(occurred_at=yesterday),
+        row("ad_click", ad_id="a1"), row("ad_click", ad_id="a1"), row("ad_click", ad_id="a2"),
+        row("affiliate_click", partner_id="p1", ad_id="a1"),
+        # Clocks ahead of the server count on the day the event arrived
+        row(occurred_at=NOW + timedelta(days=3)),
+    ])
+    store.record_events([row("ad_click", ad_id="a1")])
+    assert store.event_rollups() == [
+        {"day": "2025-06-14", "event_type": "app_open", "partner": "", "count": 1},
+        {"day": "2025-06-15", "event_type": "ad_click", "partner": "a1", "count": 3},
+        {"day": "2025-06-15", "event_type": "ad_click", "partner": "a2", "count": 1},
+        {"day": "2025-06-15", "event_type": "affiliate_click", "partner": "p1", "count": 1},
+        {"day": "2025-06-15", "event_type": "app_open", "partner": "", "count": 3},
+    ]
+    assert store.event_rollups(parse_day("2025-06-15"), event_type="app_open") == [
+        {"day": "2025-06-15", "event_type": "app_open", "partner": "", "count": 3},
+    ]
+
+
+def test_unknown_event_types_are_rejected(client):
+    response = client.post("/api/events", json={
+        "device_id": "phone", "events": [{"type": "app_open"}, {"type": "purchase"}],
+    })
+    assert response.status_code == 422
+    response = client.get("/api/events/rollups", params={"event_type": "purchase"})
+    assert response.status_code == 422
@@ -0,0 +1,131 @@
+import base64
+import json
+
+import pytest
+
+from ingest import MAX_FIELD_BYTES, TEXT_SLICE_CHARS, ImageTooLarge, PrescriptionStreamParser, stage_image_text
+
+IMAGE = bytes(range(256)) * 40
+
+
+def body(**fields):
+    return json.dumps(fields).encode()
+
+
+def parse(data, chunk_size=None, max_image_bytes=None, blob_store=None):
+    parser = PrescriptionStreamParser(blob_store, max_image_bytes)
+    chunk_size = chunk_size or len(data) or 1
+    try:
+        for start in range(0, len(data), chunk_size):
+            parser.feed(data[start:start + chunk_size])
+        return parser.close()
+    except BaseException:
+        parser.abort()
+        raise
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, 64, None])
+def test_chunk_boundaries_do_not_change_the_result(blob_store, chunk_size):
+    data = body(
+        family_member_id="m-1", rx_type="eyeglass", notes="tab\there \"quoted\" \\ é☃",
+        image_base64="data:image/png;base64," + base64.b64encode(IMAGE).decode(), expiry_date=None,
+    )
+    fields, image = parse(data, chunk_size, blob_store=blob_store)
+    with image:
+        assert fields == {
+            "family_member_id": "m-1", "rx_type": "eyeglass",
+            "notes": "tab\there \"quoted\" \\ é☃", "expiry_date": None,
+        }
+        assert image.content_type == "image/png"
+        assert image.size == len(IMAGE)
+        assert open(image.temp_path, "rb").read() == IMAGE
+
+
+def test_unicode_escapes_split_across_chunks(blob_store):
+    fields, image = parse(b'{"notes": "snow \\u2603 and \\ud83d\\ude00"}', 1, blob_store=blob_store)
+    assert fields == {"notes": "snow ☃ and \U0001f600"}
+    assert image is None
+
+
+def test_escaped_solidus_in_image_data(blob_store):
+    encoded = base64.b64encode(b"\xff\xff\xff" * 10).decode()
+    assert "/" in encoded
+    data = ('{"image_base64": "' + encoded.replace("/", "\\/") + '"}').encode()
+    fields, image = parse(data, 5, blob_store=blob_store)
+    with image:
+        assert open(image.temp_path, "rb").read() == b"\xff\xff\xff" * 10
+
+
+def test_other_escapes_in_image_data_are_rejected(blob_store):
+    with pytest.raises(ValueError, match="unexpected escape"):
+        parse(b'{"image_base64": "QUJD\\nRA=="}', blob_store=blob_store)
+    assert list(blob_store.tmp_dir.iterdir()) == []
+
+
+def test_unknown_fields_and_literals_are_collected():
+    fields, image = parse(b'{"extra": 1.5, "flag": true, "empty": null, "rx_type": "contact"}', 1)
+    assert fields == {"extra": 1.5, "flag": True, "empty": None, "rx_type": "contact"}
+    assert image is None
+
+
+def test_null_and_empty_image(blob_store):
+    assert parse(b'{"image_base64": null}', blob_store=blob_store) == ({}, None)
+    # An empty string means no image, as in the non-streaming path
+    assert parse(b'{"image_base64": ""}', blob_store=blob_store) == ({}, None)
+    with pytest.raises(ValueError, match="empty"):
+        parse(b'{"image_base64": "data:image/png;base64,"}', blob_store=blob_store)
+
+
+def test_oversize_image_is_rejected_and_cleaned_up(blob_store):
+    data = body(image_base64=base64.b64encode(IMAGE).decode())
+    with pytest.raises(ImageTooLarge):
+        parse(data, 100, max_image_bytes=len(IMAGE) - 1, blob_store=blob_store)
+    assert list(blob_store.tmp_dir.iterdir()) == []
+    with parse(data, 100, max_image_bytes=len(IMAGE), blob_store=blob_store)[1]:
+        pass
+
+
+@pytest.mark.parametrize("image_base64", [
+    "QUJD!A==",
+    "QUJDRA",
+    "QUJDRA==QUJD",
+    "data:image/png;charset=utf-8,QUJD",
+    "data:text/html;base64,PHNjcmlwdD4=",
+])
+def test_invalid_image_data(blob_store, image_base64):
+    with pytest.raises(ValueError):
+        parse(body(image_base64=image_base64), 3, blob_store=blob_store)
+    assert list(blob_store.tmp_dir.iterdir()) == []
+
+
+def test_duplicate_image_field(blob_store):
+    with pytest.raises(ValueError, match="Duplicate"):
+        parse(b'{"image_base64": "QUJD", "image_base64": "QUJD"}', blob_store=blob_store)
+
+
+@pytest.mark.parametrize("data, message", [
+    (b'[1]', "Expected a JSON object"),
+    (b'{"notes": {"a": 1}}', "scalar"),
+    (b'{"notes" 1}', "':'"),
+    (b'{"notes": 1 "x": 2}', "',' or '}'"),
+    (b'{"notes": 1} {}', "after JSON object"),
+    (b'{"notes": "unterminated', "Unexpected end"),
+    (b'{"image_base64": 1}', "must be a string"),
+])
+def test_malformed_json(data, message):
+    with pytest.raises(ValueError, match=message):
+        parse(data, 2)
+
+
+def test_oversize_field():
+    with pytest.raises(ValueError, match="too large"):
+        parse(body(notes="x" * (MAX_FIELD_BYTES + 1)), 4096)
+
+
+def test_stage_image_text_spans_slices(blob_store):
+    data = bytes(range(256)) * (TEXT_SLICE_CHARS // 100)
+    text = "data:image/png;base64," + base64.b64encode(data).decode()
+    assert len(text) > 2 * TEXT_SLICE_CHARS
+    with stage_image_text(blob_store, text) as image:
+        assert image.content_type == "image/png"
+        assert open(image.temp_path, "rb").read() == data
@@ -0,0 +1,64 @@
+import server
+import storage
+from dates import today_day
+from tests.conftest import days_from_now
+
+
+def member_list(client, member_id, **params):
+    return client.get("/api/prescriptions", params={"family_member_id": member_id, **params})
+
+
+def test_unchanged_lists_are_answered_with_304(client):
+    member = client.post("/api/family-members", json={"name": "Noa", "relationship": "Self"}).json()
+    client.post("/api/prescriptions", json={"family_member_id": member["id"], "rx_type": "eyeglass"})
+    first = member_list(client, member["id"])
+    etag = first.headers["etag"]
+    assert first.status_code == 200 and len(first.json()) == 1
+
+    again = client.get(
+        "/api/prescriptions", params={"family_member_id": member["id"]}, headers={"if-none-match": etag}
+    )
+    assert again.status_code == 304
+    assert again.headers["etag"] == etag and again.content == b""
+
+    members = client.get("/api/family-members")
+    assert client.get("/api/family-members", headers={"if-none-match": members.headers["etag"]}).status_code == 304
+
+
+def test_a_write_changes_only_its_members_etag(client):
+    ids = [
+        client.post("/api/family-members", json={"name": name, "relationship": "Child"}).json()["id"]
+        for name in ("Ari", "Bo")
+    ]
+    before = {member_id: member_list(client, member_id).headers["etag"] for member_id in ids}
+    everyone = client.get("/api/prescriptions").headers["etag"]
+
+    created = client.post("/api/prescriptions", json={"family_member_id": ids[0], "rx_type": "contact"}).json()
+    after = {member_id: member_list(client, member_id) for member_id in ids}
+    assert after[ids[0]].headers["etag"] != before[ids[0]]
+    assert [row["id"] for row in after[ids[0]].json()] == [created["id"]]
+    assert after[ids[1]].headers["etag"] == before[ids[1]]
+    assert client.get("/api/prescriptions").headers["etag"] != everyone
+
+
+def test_date_filters_roll_over_with_the_day(client, monkeypatch):
+    member = client.post("/api/family-members", json={"name": "Cy", "relationship": "Self"}).json()
+    client.post("/api/prescriptions", json={
+        "family_member_id": member["id"], "rx_type": "eyeglass", "expiry_date": days_from_now(1),
+    })
+    unfiltered = member_list(client, member["id"]).headers["etag"]
+    current = member_list(client, member["id"], expired="true")
+    assert current.json() == []
+
+    # Two days on, nothing was written but the prescription has expired
+    later = today_day() + 2
+    monkeypatch.setattr(server, "today_day", lambda: later)
+    monkeypatch.setattr(storage, "today_day", lambda: later)
+    assert member_list(client, member["id"]).headers["etag"] == unfiltered
+    rolled = client.get(
+        "/api/prescriptions", params={"family_member_id": member["id"], "expired": "true"},
+        headers={"if-none-match": current.headers["etag"]},
+    )
+    assert rolled.status_code == 200
+    assert rolled.headers["etag"] != current.headers["etag"]
+    assert len(rolled.json()) == 1
@@ -0,0 +1,68 @@
+import storage
+
+TIED = "2025-01-01T00:00:00+00:00"
+
+
+def add(client, member_id, **fields):
+    response = client.post("/api/prescriptions", json={"family_member_id": member_id, "rx_type": "contact", **fields})
+    assert response.status_code == 200
+    return response.json()
+
+
+def key(row):
+    return row["created_at"], row["id"]
+
+
+def test_pages_walk_ties_and_rows_created_mid_walk(client, monkeypatch):
+    member = client.post("/api/family-members", json={"name": "Kim", "relationship": "Self"}).json()
+    monkeypatch.setattr(storage, "utc_now", lambda: TIED)
+    created = [add(client, member["id"], notes=str(i)) for i in range(7)]
+
+    seen, cursor, mid_walk = [], None, []
+    while True:
+        params = {"family_member_id": member["id"], "limit": 3}
+        if cursor is not None:
+            params["cursor"] = cursor
+        response = client.get("/api/prescriptions", params=params)
+        assert response.status_code == 200
+        page = response.json()
+        assert 0 < len(page) <= 3
+        seen.extend(page)
+        cursor = response.headers.get("x-next-cursor")
+        if cursor is None:
+            break
+        if not mid_walk:
+            # One tied with the rows already listed, one created after them
+            mid_walk.append(add(client, member["id"], notes="tied"))
+            monkeypatch.setattr(storage, "utc_now", lambda: "2025-01-02T00:00:00+00:00")
+            mid_walk.append(add(client, member["id"], notes="later"))
+            boundary = key(page[-1])
+
+    tied, later = mid_walk
+    expected = [*created, later] + ([tied] if key(tied) > boundary else [])
+    assert [row["id"] for row in seen] == [row["id"] for row in sorted(expected, key=key)]
+    assert len({row["id"] for row in seen}) == len(seen)
+
+
+def test_malformed_cursors_are_rejected(client):
+    for cursor in ("not base64!", "bm90IGpzb24", "WzEsMl0", "WyJhIl0"):
+        response = client.get("/api/prescriptions", params={"limit": 2, "cursor": cursor})
+        assert response.status_code == 400
+        assert response.json()["detail"] == "Invalid cursor"
+
+
+def test_fields_limits_the_returned_columns(client):
+    member = client.post("/api/family-members", json={"name": "Lee", "relationship": "Self"}).json()
+    for _ in range(3):
+        add(client, member["id"], expiry_date="2030-01-01")
+    params = {"family_member_id": member["id"], "fields": "rx_type,expiry_date", "limit": 2}
+    response = client.get("/api/prescriptions", params=params)
+    assert response.json() == [{"rx_type": "contact", "expiry_date": "2030-01-01"}] * 2
+    # The cursor still comes from created_at and id, though neither was requested
+    response = client.get("/api/prescriptions", params={**params, "cursor": response.headers["x-next-cursor"]})
+    assert response.json() == [{"rx_type": "contact", "expiry_date": "2030-01-01"}]
+    assert "x-next-cursor" not in response.headers
+
+    response = client.get("/api/prescriptions", params={"fields": "id,password"})
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Unknown fields: password"
@@ -0,0 +1,50 @@
+import asyncio
+
+import pytest
+
+
+@pytest.fixture
+def server(client):
+    import server
+
+    yield server
+    # Leave the cached readiness as the other tests expect it
+    asyncio.run(server.readiness_probe.check_now())
+
+
+def test_readyz_reports_each_check(client, server, monkeypatch):
+    response = client.get("/readyz")
+    assert response.status_code == 200
+    assert response.json()["status"] == "ok"
+    assert set(response.json()["checks"]) == {"storage", "blob_store", "reminder_scheduler", "maintenance"}
+
+    monkeypatch.setitem(server.readiness_probe.checks, "storage", lambda: False)
+    asyncio.run(server.readiness_probe.check_now())
+    response = client.get("/readyz")
+    assert response.status_code == 503
+    assert response.json()["status"] == "unavailable"
+    assert response.json()["checks"]["storage"] is False
+    assert response.json()["checks"]["maintenance"] is True
+
+
+def test_maintenance_check_before_the_leader_jobs_start(server, monkeypatch):
+    check = server.readiness_probe.checks["maintenance"]
+    monkeypatch.setattr(server.leader_election, "is_leader", True)
+    monkeypatch.delattr(server.app.state, "maintenance")
+    assert check() is False
+    monkeypatch.setattr(server.app.state, "maintenance", None, raising=False)
+    assert check() is False
+    monkeypatch.setattr(server.leader_election, "is_leader", False)
+    assert check() is True
+
+
+def test_metrics_are_scraped_in_the_text_format(client):
+    client.get("/api/health")
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "text/plain; version=0.0.4; charset=utf-8"
+    lines = response.text.splitlines()
+    assert "# TYPE http_requests_total counter" in lines
+    assert any(line.startswith("http_requests_total{") and 'route="/api/health"' in line for line in lines)
+    assert any(line.startswith("http_request_duration_seconds_bucket{") for line in lines)
+    assert "worker_is_leader 1" in lines
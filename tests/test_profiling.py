@@ -0,0 +1,31 @@
+import time
+
+import pytest
+
+from profiling import PROFILES_PATH, sign_token, verify_token
+
+
+def test_tokens_expire_and_are_bound_to_the_secret():
+    token = sign_token("s3cret", time.time() + 60)
+    assert verify_token("s3cret", token)
+    assert not verify_token("other", token)
+    assert not verify_token("s3cret", sign_token("s3cret", time.time() - 1))
+    assert not verify_token("s3cret", "garbage")
+
+
+@pytest.mark.parametrize("secret, header, status_code", [
+    ("", None, 404),
+    ("s3cret", None, 403),
+    ("s3cret", "wrong", 403),
+    ("s3cret", "valid", 200),
+])
+def test_profiles_need_the_secret(client, monkeypatch, secret, header, status_code):
+    import server
+
+    # Sampling alone turns profiling on, but must not expose the profiles
+    monkeypatch.setattr(server, "PROFILING_ENABLED", True)
+    monkeypatch.setattr(server, "PROFILE_SECRET", secret)
+    headers = {}
+    if header is not None:
+        headers["x-profile"] = sign_token(secret, time.time() + 60) if header == "valid" else header
+    assert client.get(PROFILES_PATH, headers=headers).status_code == status_code
@@ -0,0 +1,79 @@
+import json
+import math
+import random
+
+import numpy as np
+import pytest
+
+from providers import CELL_DEGREES, EARTH_RADIUS_KM, ProviderIndex
+
+# Query points on cell borders, at the antimeridian and close to a pole
+QUERIES = [
+    (40.0, -74.0),
+    (40.5, 0.0),
+    (-33.9, 151.2),
+    (0.0, 180.0),
+    (12.3, -179.95),
+    (-8.7, 179.9),
+    (88.4, 10.0),
+]
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def scattered_points(count=4000, seed=7):
+    rng = random.Random(seed)
+    points = []
+    for lat, lon in QUERIES:
+        for _ in range(count // len(QUERIES)):
+            # Some points sit exactly on grid lines, the rest scatter up to ~3 cells away
+            if rng.random() < 0.2:
+                point = (round(lat / CELL_DEGREES) * CELL_DEGREES + rng.choice((-1, 0, 1)) * CELL_DEGREES,
+                         lon + rng.uniform(-1.5, 1.5))
+            else:
+                point = (lat + rng.uniform(-1.5, 1.5), lon + rng.uniform(-1.5, 1.5))
+            plat = min(90.0, max(-90.0, point[0]))
+            plon = (point[1] + 180.0) % 360.0 - 180.0
+            points.append((plat, plon))
+    points += [(0.0, -180.0), (0.0, 179.999), (0.01, -179.999)]
+    return points
+
+
+@pytest.fixture(scope="module")
+def index_and_points(tmp_path_factory):
+    points = scattered_points()
+    path = tmp_path_factory.mktemp("providers") / "providers.ndjson"
+    with open(path, "w") as f:
+        for i, (lat, lon) in enumerate(points):
+            f.write(json.dumps({"id": str(i), "name": f"Clinic {i}", "lat": lat, "lng": lon}) + "\n")
+    return ProviderIndex.load(path), points
+
+
+@pytest.mark.parametrize("lat, lon", QUERIES)
+@pytest.mark.parametrize("radius_km", [5, 40, 150])
+def test_search_matches_a_brute_force_scan(index_and_points, lat, lon, radius_km):
+    index, points = index_and_points
+    distances = [(haversine(lat, lon, plat, plon), str(i)) for i, (plat, plon) in enumerate(points)]
+    expected = sorted((distance, i) for distance, i in distances if distance <= radius_km)
+
+    results = index.search(lat, lon, radius_km, limit=len(points))
+    assert [found["id"] for found in results] == [i for _, i in expected]
+    assert [found["distance_km"] for found in results] == pytest.approx(
+        [distance for distance, _ in expected], abs=1e-3
+    )
+
+    limited = index.search(lat, lon, radius_km, limit=5)
+    assert [found["id"] for found in limited] == [i for _, i in expected[:5]]
+
+
+def test_the_antimeridian_is_one_neighbourhood():
+    index = ProviderIndex(
+        [("east",) + (None,) * 7, ("west",) + (None,) * 7],
+        np.array([0.0, 0.0]), np.array([179.99, -179.99]),
+    )
+    assert [found["id"] for found in index.search(0.0, 179.998, 5, 10)] == ["east", "west"]
+    assert [found["id"] for found in index.search(0.0, -179.995, 5, 10)] == ["west", "east"]
@@ -0,0 +1,111 @@
+import asyncio
+import time
+
+import pytest
+
+import storage
+from dates import parse_day
+from reminders import QueueSink, ReminderScheduler, reminder_times
+from tests.conftest import days_from_now
+
+LATER = 10 ** 12
+
+
+def scheduled(store, prescription_id):
+    return store.connection().execute(
+        "SELECT days_before, due_at FROM reminders WHERE prescription_id = ? ORDER BY due_at", (prescription_id,)
+    ).fetchall()
+
+
+def dispatch(scheduler, now=LATER):
+    async def run():
+        sent = await scheduler.dispatch_due(now)
+        batches = []
+        while not scheduler.sink.queue.empty():
+            batches.append(scheduler.sink.queue.get_nowait())
+        return sent, batches
+
+    return asyncio.run(run())
+
+
+def test_due_reminders_are_delivered_once(store, member, add_prescription):
+    prescription = add_prescription(expiry_date=days_from_now(10))
+    expected = reminder_times(parse_day(prescription["expiry_date"]), time.time())
+    assert [tuple(row) for row in scheduled(store, prescription["id"])] == expected
+
+    scheduler = ReminderScheduler(store, QueueSink(), batch_size=2)
+    sent, batches = dispatch(scheduler)
+    assert sent == len(expected)
+    assert [len(batch) for batch in batches] == [2] * (sent // 2) + [1] * (sent % 2)
+    first = batches[0][0]
+    assert (first["prescription_id"], first["member_name"]) == (prescription["id"], member["name"])
+    assert prescription["expiry_date"] in first["body"]
+    assert dispatch(scheduler) == (0, [])
+
+
+def test_changing_the_expiry_reschedules(store, add_prescription):
+    prescription = add_prescription(expiry_date=days_from_now(10))
+    store.update_prescription(prescription["id"], {"expiry_date": days_from_now(40)})
+    day = parse_day(days_from_now(40))
+    assert [tuple(row) for row in scheduled(store, prescription["id"])] == reminder_times(day, time.time())
+    store.update_prescription(prescription["id"], {"expiry_date": None})
+    assert scheduled(store, prescription["id"]) == []
+
+
+def test_deletes_cancel_reminders(store, member, add_prescription):
+    deleted = add_prescription(expiry_date=days_from_now(10))
+    cascaded = add_prescription(expiry_date=days_from_now(10))
+    other = store.create_family_member("Robin", "Spouse")
+    kept = add_prescription(member=other, expiry_date=days_from_now(10))
+    store.delete_prescription(deleted["id"])
+    store.delete_family_member(member["id"])
+    assert scheduled(store, deleted["id"]) == scheduled(store, cascaded["id"]) == []
+
+    _, batches = dispatch(ReminderScheduler(store, QueueSink()))
+    assert {reminder["prescription_id"] for batch in batches for reminder in batch} == {kept["id"]}
+
+
+class FlakySink(QueueSink):
+    def __init__(self, failures):
+        super().__init__()
+        self.failures = failures
+
+    async def deliver(self, reminders):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("sink unavailable")
+        await super().deliver(reminders)
+
+
+def test_failed_delivery_is_retried(store, add_prescription):
+    prescription = add_prescription(expiry_date=days_from_now(10))
+    count = len(scheduled(store, prescription["id"]))
+    scheduler = ReminderScheduler(store, FlakySink(failures=1))
+    with pytest.raises(ConnectionError):
+        dispatch(scheduler)
+    assert len(scheduled(store, prescription["id"])) == count
+    sent, batches = dispatch(scheduler)
+    assert sent == count and len(batches[0]) == count
+    assert scheduled(store, prescription["id"]) == []
+
+
+def test_scheduling_a_reminder_wakes_the_scheduler(store, member, monkeypatch):
+    # Due a moment from now, far sooner than the scheduler's next poll
+    monkeypatch.setattr(storage, "reminder_times", lambda day, now: [(0, now + 0.2)])
+    scheduler = ReminderScheduler(store, QueueSink(), poll_interval=60)
+    store.on_reminders_scheduled = scheduler.reminder_scheduled
+
+    async def run():
+        scheduler.start()
+        try:
+            await asyncio.sleep(0.1)
+            await asyncio.to_thread(store.create_prescription, {
+                "family_member_id": member["id"], "rx_type": "contact", "notes": "", "date_taken": "",
+                "expiry_date": days_from_now(1),
+            })
+            return await asyncio.wait_for(scheduler.sink.queue.get(), 5)
+        finally:
+            await scheduler.stop()
+
+    batch = asyncio.run(run())
+    assert [reminder["days_before"] for reminder in batch] == [0]
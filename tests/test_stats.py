@@ -0,0 +1,83 @@
+import random
+
+from tests.conftest import days_from_now
+
+
+def all_stats(store, member_ids, within=30):
+    return [store.get_stats(within)] + [store.get_stats(within, member_id) for member_id in member_ids]
+
+
+def test_stats_follow_each_mutation(store, member, add_prescription):
+    assert store.get_stats(30) == {
+        "total_prescriptions": 0, "eyeglass_prescriptions": 0, "contact_prescriptions": 0,
+        "expiring_soon": 0, "family_members": 1,
+    }
+    glasses = add_prescription(expiry_date=days_from_now(10))
+    add_prescription(rx_type="contact", expiry_date=days_from_now(90))
+    assert store.get_stats(30) == {
+        "total_prescriptions": 2, "eyeglass_prescriptions": 1, "contact_prescriptions": 1,
+        "expiring_soon": 1, "family_members": 1,
+    }
+    assert store.get_stats(100, member["id"])["expiring_soon"] == 2
+
+    store.update_prescription(glasses["id"], {"rx_type": "contact", "expiry_date": days_from_now(-5)})
+    stats = store.get_stats(30, member["id"])
+    assert (stats["eyeglass_prescriptions"], stats["contact_prescriptions"], stats["expiring_soon"]) == (0, 2, 0)
+
+    store.delete_prescription(glasses["id"])
+    assert store.get_stats(30)["total_prescriptions"] == 1
+
+
+def test_deleting_a_member_clears_their_counters(store, member, add_prescription):
+    other = store.create_family_member("Robin", "Spouse")
+    add_prescription(expiry_date=days_from_now(3))
+    add_prescription(member=other, expiry_date=days_from_now(3))
+    store.delete_family_member(member["id"])
+    assert store.get_stats(30) == {
+        "total_prescriptions": 1, "eyeglass_prescriptions": 1, "contact_prescriptions": 0,
+        "expiring_soon": 1, "family_members": 1,
+    }
+    assert store.connection().execute(
+        "SELECT count(*) FROM counters WHERE scope = ?", (member["id"],)
+    ).fetchone()[0] == 0
+
+
+def test_counters_match_a_rebuild_after_random_changes(store):
+    rng = random.Random(7)
+    members = [store.create_family_member(f"M{i}", "Child")["id"] for i in range(4)]
+    prescriptions = []
+    for _ in range(300):
+        action = rng.random()
+        if action < 0.5 or not prescriptions:
+            created = store.create_prescription({
+                "family_member_id": rng.choice(members), "rx_type": rng.choice(["eyeglass", "contact"]),
+                "notes": "", "date_taken": "", "expiry_date": rng.choice([None, days_from_now(rng.randint(-20, 60))]),
+            })
+            prescriptions.append(created["id"])
+        elif action < 0.75:
+            store.update_prescription(rng.choice(prescriptions), {
+                "family_member_id": rng.choice(members), "rx_type": rng.choice(["eyeglass", "contact"]),
+                "expiry_date": days_from_now(rng.randint(-20, 60)),
+            })
+        elif action < 0.95:
+            store.delete_prescription(prescriptions.pop(rng.randrange(len(prescriptions))))
+        else:
+            store.apply_changes([], [], [rng.choice(members)], [])
+            members = [row[0] for row in store.connection().execute("SELECT id FROM family_members")]
+            prescriptions = [row[0] for row in store.connection().execute("SELECT id FROM prescriptions")]
+            members.append(store.create_family_member("New", "Child")["id"])
+
+    maintained = all_stats(store, members)
+    store.rebuild_counters()
+    assert all_stats(store, members) == maintained
+    assert maintained[0]["total_prescriptions"] == len(prescriptions)
+
+
+def test_stats_endpoint(client):
+    member = client.post("/api/family-members", json={"name": "Lee", "relationship": "Self"}).json()
+    client.post("/api/prescriptions", json={
+        "family_member_id": member["id"], "rx_type": "contact", "expiry_date": days_from_now(1),
+    })
+    stats = client.get("/api/stats", params={"family_member_id": member["id"]}).json()
+    assert stats["total_prescriptions"] == stats["contact_prescriptions"] == stats["expiring_soon"] == 1
+    assert "family_members" not in stats
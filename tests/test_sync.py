@@ -0,0 +1,124 @@
+def ids(records):
+    return [record.id for record in records]
+
+
+def pull_all(store, cursor=0, limit=2):
+    """Follow has_more from `cursor`; returns (members, prescriptions, deleted, cursor)."""
+    members, prescriptions = [], []
+    deleted = {"family_members": [], "prescriptions": []}
+    while True:
+        page = store.pull_changes(cursor, limit)
+        assert not page["reset"]
+        changes = page["changes"]
+        members += ids(changes["family_members"])
+        prescriptions += ids(changes["prescriptions"])
+        for entity in deleted:
+            deleted[entity] += changes["deleted"][entity]
+        cursor = page["cursor"]
+        if not page["has_more"]:
+            return members, prescriptions, deleted, cursor
+
+
+def test_pull_pages_through_every_change(store, member, add_prescription):
+    first = add_prescription()
+    second = add_prescription(rx_type="contact")
+    members, prescriptions, deleted, cursor = pull_all(store)
+    assert members == [member["id"]]
+    assert prescriptions == [first["id"], second["id"]]
+    assert deleted == {"family_members": [], "prescriptions": []}
+    assert store.pull_changes(cursor, 10)["changes"]["prescriptions"] == []
+
+
+def test_each_entity_appears_once_with_its_latest_state(store, member, add_prescription):
+    prescription = add_prescription(notes="v1")
+    _, _, _, cursor = pull_all(store)
+    store.update_prescription(prescription["id"], {"notes": "v2"})
+    store.update_prescription(prescription["id"], {"notes": "v3"})
+    page = store.pull_changes(cursor, 10)
+    assert [record.notes for record in page["changes"]["prescriptions"]] == ["v3"]
+    assert store.connection().execute("SELECT count(*) FROM change_log").fetchone()[0] == 2
+
+
+def test_deleting_a_member_tombstones_their_prescriptions(store, member, add_prescription):
+    prescription = add_prescription()
+    _, _, _, cursor = pull_all(store)
+    assert store.delete_family_member(member["id"]) == 1
+    members, prescriptions, deleted, _ = pull_all(store, cursor)
+    assert members == prescriptions == []
+    assert deleted == {"family_members": [member["id"]], "prescriptions": [prescription["id"]]}
+
+
+def test_pruned_tombstones_reset_stale_cursors(store, member, add_prescription):
+    prescription = add_prescription()
+    _, _, _, stale = pull_all(store)
+    store.delete_prescription(prescription["id"])
+    _, _, _, current = pull_all(store)
+    assert store.prune_tombstones("9999") == 1
+
+    page = store.pull_changes(stale, 10)
+    assert page["reset"] and page["changes"]["deleted"]["prescriptions"] == []
+    assert ids(page["changes"]["family_members"]) == [member["id"]]
+    assert not store.pull_changes(current, 10)["reset"]
+
+
+def test_reset_pass_pages_through_to_the_end(store, member, add_prescription):
+    live = [add_prescription()["id"] for _ in range(9)]
+    gone = add_prescription()
+    _, _, _, stale = pull_all(store)
+    store.delete_prescription(gone["id"])
+    assert store.prune_tombstones("9999") == 1
+
+    page = store.pull_changes(stale, 3)
+    assert page["reset"] and page["has_more"]
+    members, prescriptions, deleted, _ = pull_all(store, page["cursor"], 3)
+    assert members + ids(page["changes"]["family_members"]) == [member["id"]]
+    assert ids(page["changes"]["prescriptions"]) + prescriptions == live
+    assert deleted == {"family_members": [], "prescriptions": []}
+
+
+def test_push_applies_changes_and_rejects_unknown_references(store, member):
+    rejected = store.apply_changes(
+        [{"id": "m-2", "name": "Robin", "relationship": "Spouse"}],
+        [
+            {"id": "rx-1", "family_member_id": "m-2", "rx_type": "contact", "notes": "", "date_taken": ""},
+            {"id": "rx-2", "family_member_id": "missing", "rx_type": "contact", "notes": "", "date_taken": ""},
+            {"id": "rx-3", "family_member_id": "m-2", "rx_type": "contact", "notes": "", "date_taken": "",
+             "image_hash": "0" * 64},
+        ],
+        [], [],
+    )
+    assert rejected == [
+        {"entity": "prescription", "id": "rx-2", "reason": "Family member not found"},
+        {"entity": "prescription", "id": "rx-3", "reason": "Image blob not found"},
+    ]
+    assert store.get_prescription("rx-1")["family_member_id"] == "m-2"
+    assert store.get_prescription("rx-3") is None
+
+
+def test_push_updates_and_deletes(store, member, add_prescription):
+    prescription = add_prescription(notes="local")
+    store.apply_changes(
+        [{**member, "name": "Alexandra"}],
+        [{**prescription, "notes": "remote"}],
+        [], [],
+    )
+    assert store.get_family_member(member["id"])["name"] == "Alexandra"
+    assert store.get_prescription(prescription["id"])["notes"] == "remote"
+    assert store.get_prescription(prescription["id"])["created_at"] == prescription["created_at"]
+
+    store.apply_changes([], [], [member["id"]], [prescription["id"]])
+    assert store.get_family_member(member["id"]) is None
+    assert store.get_prescription(prescription["id"]) is None
+
+
+def test_sync_endpoint_round_trip(client):
+    cursor = client.get("/api/sync", params={"cursor": 0, "limit": 1000}).json()["cursor"]
+    response = client.post("/api/sync", json={
+        "cursor": cursor,
+        "family_members": [{"id": "sync-m", "name": "Jo", "relationship": "Self"}],
+        "prescriptions": [{"id": "sync-rx", "family_member_id": "sync-m", "rx_type": "eyeglass"}],
+    }).json()
+    assert response["rejected"] == []
+    assert [m["id"] for m in response["changes"]["family_members"]] == ["sync-m"]
+    assert [p["id"] for p in response["changes"]["prescriptions"]] == ["sync-rx"]
+    assert client.get("/api/sync", params={"cursor": response["cursor"]}).json()["changes"]["prescriptions"] == []
@@ -0,0 +1,81 @@
+import asyncio
+import base64
+import io
+import os
+import signal
+
+import pytest
+from PIL import Image
+
+from thumbnails import VariantCache, VariantError, pick_width
+
+
+def photo(path, size=(800, 600)):
+    buffer = io.BytesIO()
+    Image.new("RGB", size, (200, 80, 40)).save(buffer, "JPEG")
+    path.write_bytes(buffer.getvalue())
+    return path
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = VariantCache(tmp_path / "variants", 10 * 1024 * 1024, workers=1)
+    yield cache
+    cache.close()
+
+
+def test_pick_width():
+    assert pick_width(1) == 160
+    assert pick_width(160) == 160
+    assert pick_width(161) == 320
+    assert pick_width(5000) is None
+
+
+def test_renders_once_and_serves_from_memory(cache, tmp_path):
+    source = photo(tmp_path / "source.jpg")
+
+    async def run():
+        first, second = await asyncio.gather(cache.get("ab" * 32, 160, source), cache.get("ab" * 32, 160, source))
+        source.unlink()
+        return first, second, await cache.get("ab" * 32, 160, source)
+
+    first, second, third = asyncio.run(run())
+    assert first == second == third
+    assert Image.open(io.BytesIO(first)).size == (160, 120)
+    assert cache.path("ab" * 32, 160).read_bytes() == first
+
+
+def test_undecodable_source(cache, tmp_path):
+    source = tmp_path / "source.jpg"
+    source.write_bytes(b"not an image")
+    with pytest.raises(VariantError):
+        asyncio.run(cache.get("cd" * 32, 160, source))
+
+
+def test_recovers_after_a_worker_dies(cache, tmp_path):
+    source = photo(tmp_path / "source.jpg")
+
+    async def run():
+        await cache.get("ab" * 32, 160, source)
+        for pid in list(cache._pool._processes):
+            os.kill(pid, signal.SIGKILL)
+        await asyncio.sleep(0.5)
+        return await cache.get("ab" * 32, 320, source)
+
+    data = asyncio.run(run())
+    assert Image.open(io.BytesIO(data)).size == (320, 240)
+
+
+def test_variant_etag_uses_if_none_match_rules(client):
+    buffer = io.BytesIO()
+    Image.new("RGB", (400, 300)).save(buffer, "JPEG")
+    member = client.post("/api/family-members", json={"name": "Kim", "relationship": "Self"}).json()
+    prescription = client.post("/api/prescriptions", json={
+        "family_member_id": member["id"], "rx_type": "contact",
+        "image_base64": "data:image/jpeg;base64," + base64.b64encode(buffer.getvalue()).decode(),
+    }).json()
+    url = f"/api/blobs/{prescription['image_hash']}/variant?width=160"
+    etag = client.get(url).headers["etag"]
+    assert client.get(url, headers={"if-none-match": f'"other", W/{etag}'}).status_code == 304
+    assert client.get(url, headers={"if-none-match": "*"}).status_code == 304
+    assert client.get(url, headers={"if-none-match": f"x{etag}x"}).status_code == 200
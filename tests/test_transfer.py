@@ -0,0 +1,90 @@
+import json
+
+import pytest
+
+from storage import Store
+from transfer import Importer, export_chunks
+
+
+@pytest.fixture
+def importer(store, blob_store):
+    from server import validate_import_record
+
+    def make(validate=validate_import_record, batch_size=100):
+        return Importer(store, blob_store, validate, 10 * 1024 * 1024, 1024 * 1024, batch_size)
+
+    return make
+
+
+def ndjson(*records):
+    return ("\n".join(json.dumps(record) for record in records) + "\n").encode()
+
+
+def snapshot(store):
+    return sorted(store.export_rows(), key=lambda item: (item[0], item[1]["id"]))
+
+
+@pytest.mark.parametrize("fmt", ["ndjson", "csv"])
+def test_export_then_import_round_trips(tmp_path, store, blob_store, member, add_prescription, importer, fmt):
+    add_prescription(notes='say "hi", then\nleave', expiry_date="2030-01-02")
+    add_prescription(rx_type="contact", date_taken="2024-05-06")
+    exported = b"".join(export_chunks(store, blob_store, fmt))
+    other = Store(tmp_path / "other.db")
+    other.open()
+    try:
+        summary = Importer(other, blob_store, importer().validate, 1024, 1024 * 1024).run([exported], fmt)
+        assert summary["imported"] == {"family_members": 1, "prescriptions": 2}
+        assert summary["error_count"] == 0
+        assert snapshot(other) == snapshot(store)
+        assert other.get_stats(3650) == store.get_stats(3650)
+    finally:
+        other.close()
+
+
+def test_reimport_is_idempotent(store, blob_store, member, add_prescription, importer):
+    add_prescription(expiry_date="2030-01-02")
+    exported = b"".join(export_chunks(store, blob_store, "ndjson"))
+    before = snapshot(store), store.get_stats(3650)
+    reminders = store.connection().execute("SELECT count(*) FROM reminders").fetchone()[0]
+
+    summary = importer().run([exported], "ndjson")
+    assert summary["imported"] == {"family_members": 1, "prescriptions": 1}
+    assert (snapshot(store), store.get_stats(3650)) == before
+    assert store.connection().execute("SELECT count(*) FROM reminders").fetchone()[0] == reminders
+
+
+def test_bad_rows_are_reported_by_line(store, importer):
+    data = ndjson(
+        {"type": "family_member", "id": "m-1", "name": "Jo", "relationship": "Self"},
+        {"type": "prescription", "id": "rx-1", "family_member_id": "m-1", "rx_type": "contact"},
+        {"type": "prescription", "id": "rx-2", "family_member_id": "nobody", "rx_type": "contact"},
+        {"type": "prescription", "id": "rx-3", "family_member_id": "m-1", "rx_type": "monocle"},
+        {"type": "pet", "id": "p-1"},
+    ) + b"not json\n"
+    summary = importer(batch_size=2).run([data[:7], data[7:]], "ndjson")
+    assert summary["imported"] == {"family_members": 1, "prescriptions": 1}
+    assert [(error["line"], error["error"].split(":")[0]) for error in summary["errors"]] == [
+        (3, "Family member not found"), (4, "rx_type"), (5, "Unknown record type 'pet'"), (6, "Invalid JSON"),
+    ]
+    assert store.get_prescription("rx-1") is not None
+    assert store.get_prescription("rx-2") is None
+
+
+def test_failed_batch_is_replayed_row_by_row(store, importer):
+    # Without validation a member with a null name only fails inside SQLite,
+    # after the rest of the batch has been written
+    data = ndjson(
+        {"type": "family_member", "id": "m-1", "name": "Jo", "relationship": "Self", "created_at": "2024"},
+        {"type": "family_member", "id": "m-2", "name": None, "relationship": "Self", "created_at": "2024"},
+        {"type": "prescription", "id": "rx-1", "family_member_id": "m-1", "rx_type": "contact",
+         "notes": "", "date_taken": "", "expiry_date": "2030-01-02"},
+    )
+    summary = importer(validate=lambda entity, record: record).run([data], "ndjson")
+    assert summary["imported"] == {"family_members": 1, "prescriptions": 1}
+    assert [error["line"] for error in summary["errors"]] == [2]
+    assert store.get_family_member("m-2") is None
+    assert store.get_stats(3650) == {
+        "total_prescriptions": 1, "eyeglass_prescriptions": 0, "contact_prescriptions": 1,
+        "expiring_soon": 1, "family_members": 1,
+    }
+    assert store.connection().execute("SELECT count(*) FROM reminders").fetchone()[0] > 0
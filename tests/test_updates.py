@@ -0,0 +1,69 @@
+import base64
+import io
+
+import pytest
+from PIL import Image
+
+
+@pytest.fixture
+def member(client):
+    return client.post("/api/family-members", json={"name": "Ari", "relationship": "Self"}).json()
+
+
+@pytest.fixture
+def prescription(client, member):
+    return client.post("/api/prescriptions", json={
+        "family_member_id": member["id"], "rx_type": "eyeglass", "notes": "n", "date_taken": "2024-01-02",
+    }).json()
+
+
+@pytest.mark.parametrize("field", ["name", "relationship"])
+def test_member_update_rejects_null(client, member, field):
+    response = client.put(f"/api/family-members/{member['id']}", json={field: None})
+    assert response.status_code == 422
+    assert client.get(f"/api/family-members/{member['id']}").json() == member
+
+
+@pytest.mark.parametrize("field", ["rx_type", "notes", "date_taken"])
+def test_prescription_update_rejects_null(client, prescription, field):
+    response = client.put(f"/api/prescriptions/{prescription['id']}", json={field: None})
+    assert response.status_code == 422
+    assert client.get(f"/api/prescriptions/{prescription['id']}").json()[field] == prescription[field]
+
+
+def test_omitted_and_nullable_fields_still_update(client, member, prescription):
+    response = client.put(f"/api/prescriptions/{prescription['id']}", json={"expiry_date": None, "notes": "new"})
+    assert response.status_code == 200
+    assert (response.json()["notes"], response.json()["date_taken"]) == ("new", "2024-01-02")
+    response = client.put(f"/api/family-members/{member['id']}", json={"name": "Arielle"})
+    assert response.json() == {**member, "name": "Arielle"}
+
+
+@pytest.mark.parametrize("entity, field", [
+    ("family_member", "name"), ("prescription", "notes"), ("prescription", "family_member_id"),
+])
+def test_batch_update_rejects_null(client, member, prescription, entity, field):
+    target = member if entity == "family_member" else prescription
+    response = client.post("/api/batch", json={"operations": [
+        {"op": "update", "entity": entity, "id": target["id"], "data": {field: None}},
+    ]})
+    assert response.status_code == 422
+    assert response.json()["detail"]["index"] == 0
+    assert field in response.json()["detail"]["error"]
+
+
+def test_prescription_update_streams_a_new_image(client, prescription):
+    buffer = io.BytesIO()
+    Image.new("RGB", (64, 48), (10, 120, 200)).save(buffer, "PNG")
+    uri = "data:image/png;base64," + base64.b64encode(buffer.getvalue()).decode()
+    url = f"/api/prescriptions/{prescription['id']}"
+    response = client.put(url, json={"image_base64": uri, "notes": "photo"})
+    assert response.status_code == 200
+    updated = response.json()
+    assert updated["notes"] == "photo" and updated["image_hash"]
+    assert client.get(f"/api/blobs/{updated['image_hash']}").content == buffer.getvalue()
+
+    assert client.put(url, json={"image_base64": "data:text/html;base64,PHA+"}).status_code == 400
+    assert client.put(url, content=b'{"notes": ').status_code == 400
+    assert client.put("/api/prescriptions/missing", json={"notes": "x"}).status_code == 404
+    assert client.get(url).json()["image_hash"] == updated["image_hash"]